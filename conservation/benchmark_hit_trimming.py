@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compare MUSCLE runtime with and without hit trimming.
+#
+# For each input sequence the similar sequences are searched once, then
+# clustering and alignment are executed for the full-length sequences
+# and for the sequences trimmed to the aligned region. Use long queries
+# to see the effect. Requires the same environment as conservation.py.
+#
+# Example:
+#   python3 benchmark_hit_trimming.py --input 1.fasta 2.fasta --working ./bench
+#
+
+import os
+import typing
+import logging
+import argparse
+import json
+import time
+
+import conservation
+import multiple_sequence_alignment as msa
+import fasta
+import sequence_store
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(
+        description="Compare MUSCLE runtime with and without hit trimming."
+    )
+    parser.add_argument("--input", required=True, nargs="+", help="Input FASTA files.")
+    parser.add_argument("--working", required=True, help="Working directory.")
+    parser.add_argument(
+        "--database",
+        metavar="D",
+        default=["swissprot", "uniref50", "uniref90"],
+        type=str,
+        nargs="+",
+        help="BLAST databases used for MSA computation.",
+    )
+    parser.add_argument(
+        "--trim-flank",
+        default=20,
+        type=int,
+        help="Number of residues kept around the aligned region.",
+    )
+    parser.add_argument("--output", help="Optional JSON file with results.")
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+    )
+    config = conservation.ConservationConfiguration()
+    config.blast_databases = arguments["database"]
+    config.msa_trim_hits = True
+    config.msa_trim_flank = arguments["trim_flank"]
+    config.sequence_store_dir = sequence_store.SEQUENCE_STORE_DIR
+    config.execute_command = conservation._default_execute_command
+    results = []
+    for index, input_file in enumerate(arguments["input"]):
+        working_dir = os.path.join(arguments["working"], str(index))
+        os.makedirs(working_dir, exist_ok=True)
+        results.extend(benchmark(input_file, working_dir, config))
+    print("input\tvariant\tquery_length\tsequences\tresidues\tmuscle_seconds")
+    for item in results:
+        print(
+            f"{item['input']}\t{item['variant']}\t{item['query_length']}\t"
+            f"{item['sequences']}\t{item['residues']}\t{item['muscle_seconds']:.2f}"
+        )
+    if arguments["output"] is not None:
+        with open(arguments["output"], "w", encoding="utf-8") as stream:
+            json.dump(results, stream, indent=2)
+
+
+def benchmark(
+    input_file: str, working_dir: str, config: conservation.ConservationConfiguration
+) -> typing.List[typing.Dict]:
+    msa_config = conservation.create_msa_configuration(working_dir, config)
+    blast_input = msa._prepare_blast_input(input_file, msa_config)
+    query_length = len(fasta.read_fasta_file(blast_input)[0][1])
+    database, search_result = _search(blast_input, msa_config)
+    sequences_file = search_result.sequences_file
+    if sequences_file is None:
+        sequences_file = os.path.join(working_dir, "sequences")
+        msa._retrieve_sequences(
+            search_result.filtered_file,
+            sequences_file,
+            msa_config,
+            database,
+        )
+    trimmed_file = os.path.join(working_dir, "sequences-trimmed")
+    msa._trim_sequences(
+        sequences_file, search_result.ranges_file, trimmed_file, msa_config
+    )
+    result = []
+    for variant, file in (("full", sequences_file), ("trimmed", trimmed_file)):
+        logging.info("Aligning %s sequences for '%s' ...", variant, input_file)
+        cdhit_file = os.path.join(working_dir, "cd-hit-" + variant)
+        msa_config.execute_cdhit(file, cdhit_file, cdhit_file + ".log")
+        selected_file = os.path.join(working_dir, "selected-" + variant)
+        msa._select_sequences(
+            cdhit_file, selected_file, msa_config.maximum_sequences_for_msa
+        )
+        muscle_input = os.path.join(working_dir, "muscle-input-" + variant)
+        msa._merge_files([selected_file, blast_input], muscle_input)
+        start = time.perf_counter()
+        msa_config.execute_muscle(
+            muscle_input, os.path.join(working_dir, "muscle-output-" + variant), None
+        )
+        duration = time.perf_counter() - start
+        records = fasta.read_fasta_file(muscle_input)
+        result.append(
+            {
+                "input": input_file,
+                "variant": variant,
+                "query_length": query_length,
+                "sequences": len(records),
+                "residues": sum(len(sequence) for _, sequence in records),
+                "muscle_seconds": duration,
+            }
+        )
+    return result
+
+
+def _search(
+    input_file: str, config: msa.MsaConfiguration
+) -> typing.Tuple[str, msa.SearchResult]:
+    """Return name of the first usable database and the search result."""
+    for database in config.blast_databases:
+        search_result = msa._search_database(
+            input_file, config, database, "-" + database, None
+        )
+        if search_result.count >= config.minimum_sequence_count:
+            return database, search_result
+    raise Exception("Not enough similar sequences found!")
+
+
+if __name__ == "__main__":
+    main(_read_arguments())
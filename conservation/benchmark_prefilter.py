@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compare prefiltered PSI-BLAST search with search of the whole database.
+#
+# For each input sequence and database both searches are executed and
+# the filtered hits are compared. Recall is the fraction of filtered hits
+# of the full search found by the prefiltered search. Use a fixed set of
+# queries to decide whether the prefilter is safe for a database.
+# Requires the same environment as conservation.py and the k-mer index,
+# see kmer_index.py.
+#
+# Example:
+#   python3 benchmark_prefilter.py --input 1.fasta 2.fasta --working ./bench
+#
+
+import os
+import typing
+import logging
+import argparse
+import json
+import time
+
+import conservation
+import multiple_sequence_alignment as msa
+import kmer_index
+import sequence_store
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(
+        description="Compare prefiltered and full PSI-BLAST search."
+    )
+    parser.add_argument("--input", required=True, nargs="+", help="Input FASTA files.")
+    parser.add_argument("--working", required=True, help="Working directory.")
+    parser.add_argument(
+        "--database",
+        metavar="D",
+        default=["swissprot", "uniref50"],
+        type=str,
+        nargs="+",
+        help="BLAST databases to evaluate.",
+    )
+    parser.add_argument(
+        "--kmer-index",
+        default=kmer_index.KMER_INDEX_DIR,
+        help="Directory with k-mer indexes.",
+    )
+    parser.add_argument("--output", help="Optional JSON file with results.")
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+    )
+    if arguments["kmer_index"] is None:
+        raise Exception("Missing k-mer index directory.")
+    config = conservation.ConservationConfiguration()
+    config.blast_databases = arguments["database"]
+    config.kmer_index_dir = arguments["kmer_index"]
+    config.msa_prefilter_databases = arguments["database"]
+    config.sequence_store_dir = sequence_store.SEQUENCE_STORE_DIR
+    config.execute_command = conservation._default_execute_command
+    results = []
+    for index, input_file in enumerate(arguments["input"]):
+        working_dir = os.path.join(arguments["working"], str(index))
+        os.makedirs(working_dir, exist_ok=True)
+        results.extend(benchmark(input_file, working_dir, config))
+    print("input\tdatabase\tfull_hits\tprefilter_hits\trecall\tspeedup")
+    for item in results:
+        print(
+            f"{item['input']}\t{item['database']}\t{item['full_hits']}\t"
+            f"{item['prefilter_hits']}\t{item['recall']:.3f}\t"
+            f"{item['full_seconds'] / item['prefilter_seconds']:.1f}"
+        )
+    print("database\tqueries\tmean_recall\tmin_recall\ttotal_speedup")
+    for database, summary in summarize(results).items():
+        print(
+            f"{database}\t{summary['queries']}\t{summary['mean_recall']:.3f}\t"
+            f"{summary['min_recall']:.3f}\t{summary['speedup']:.1f}"
+        )
+    if arguments["output"] is not None:
+        with open(arguments["output"], "w", encoding="utf-8") as stream:
+            json.dump(
+                {"results": results, "summary": summarize(results)}, stream, indent=2
+            )
+
+
+def benchmark(
+    input_file: str, working_dir: str, config: conservation.ConservationConfiguration
+) -> typing.List[typing.Dict]:
+    msa_config = conservation.create_msa_configuration(working_dir, config)
+    blast_input = msa._prepare_blast_input(input_file, msa_config)
+    result = []
+    for database in config.blast_databases:
+        logging.info("Searching '%s' for '%s' ...", database, input_file)
+        start = time.perf_counter()
+        full_output = os.path.join(working_dir, f"psiblast-full-{database}")
+        msa_config.execute_psiblast(blast_input, full_output, database, None)
+        full_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        prefilter_output = msa._execute_prefiltered_psiblast(
+            blast_input, msa_config, database, "-" + database, None
+        )
+        prefilter_seconds = time.perf_counter() - start
+        if prefilter_output is None:
+            raise Exception(f"Missing k-mer index for '{database}'.")
+        full_hits = _filtered_hits(full_output, working_dir, msa_config)
+        prefilter_hits = _filtered_hits(prefilter_output, working_dir, msa_config)
+        found = len(full_hits & prefilter_hits)
+        result.append(
+            {
+                "input": input_file,
+                "database": database,
+                "full_hits": len(full_hits),
+                "prefilter_hits": len(prefilter_hits),
+                "recall": found / len(full_hits) if len(full_hits) > 0 else 1.0,
+                "full_seconds": full_seconds,
+                "prefilter_seconds": prefilter_seconds,
+            }
+        )
+    return result
+
+
+def _filtered_hits(
+    psiblast_file: str, working_dir: str, config: msa.MsaConfiguration
+) -> typing.Set[str]:
+    filtered_file = os.path.join(working_dir, "psiblast-filtered-benchmark")
+    msa._filter_psiblast_file(psiblast_file, filtered_file, config)
+    with open(filtered_file) as stream:
+        return {line.strip() for line in stream if len(line.strip()) > 0}
+
+
+def summarize(results: typing.List[typing.Dict]) -> typing.Dict[str, typing.Dict]:
+    """Return recall and speedup for each database."""
+    result = {}
+    for database in dict.fromkeys(item["database"] for item in results):
+        items = [item for item in results if item["database"] == database]
+        recalls = [item["recall"] for item in items]
+        result[database] = {
+            "queries": len(items),
+            "mean_recall": sum(recalls) / len(recalls),
+            "min_recall": min(recalls),
+            "speedup": sum(item["full_seconds"] for item in items)
+            / sum(item["prefilter_seconds"] for item in items),
+        }
+    return result
+
+
+if __name__ == "__main__":
+    main(_read_arguments())
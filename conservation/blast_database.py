@@ -5,16 +5,52 @@
 #
 
 import os
+import re
+import math
+import collections
 import typing
 import logging
+import subprocess
+import heapq
+import concurrent.futures
+import hashlib
+import json
+import shutil
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
 BLASTDMAKEDB_CMD = os.environ.get("BLASTDMAKEDB_CMD", None)
 
+BLASTDBCMD_CMD = os.environ.get("BLASTDBCMD_CMD", None)
+
 BLASTDB = os.environ.get("BLASTDB", None)
 
 # Comma separated list of databases to used.
 BLASTDB_USED = os.environ.get("BLASTDB_USED", None)
 
+# When greater than 1, new databases are created with given number
+# of volumes of similar size, so they can be searched in parallel.
+BLASTDB_SHARDS = int(os.environ.get("BLASTDB_SHARDS", "1"))
+
+# Base URL of a mirror with the database files, for example
+# file:///data/mirror/, used instead of DATABASE_NAME_TO_URL.
+BLASTDB_MIRROR = os.environ.get("BLASTDB_MIRROR", None)
+
+# Maximum number of databases built at the same time.
+BLASTDB_BUILD_WORKERS = int(os.environ.get("BLASTDB_BUILD_WORKERS", "3"))
+
+# Command used to decompress downloaded files, must support -dc.
+DECOMPRESS_CMD = os.environ.get(
+    "DECOMPRESS_CMD", "pigz" if shutil.which("pigz") is not None else "gzip"
+)
+
+# Timeout in seconds for connecting to and reading from the source.
+BLASTDB_DOWNLOAD_TIMEOUT = float(os.environ.get("BLASTDB_DOWNLOAD_TIMEOUT", "60"))
+
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
 # For selected databases we store download URL.
 DATABASE_NAME_TO_URL = {
     "swissprot": "https://p2rank.cz/www/conservation/current/uniprot_sprot.fasta.gz",
@@ -24,6 +60,9 @@ DATABASE_NAME_TO_URL = {
 
 DATABASE_FILE_EXTENSIONS = [".phr", ".pin", ".pog", ".psd", ".psi", ".psq"]
 
+# Suffix of a symbolic link to the current version of a database.
+CURRENT_SUFFIX = ".current"
+
 
 def get_databases_to_use() -> typing.List[str]:
     """Return name of databases to use."""
@@ -36,14 +75,20 @@ def get_available_databases() -> typing.List[str]:
     """Return names of all available databases."""
     result = []
     for file_name in os.listdir(BLASTDB):
+        if file_name.endswith(CURRENT_SUFFIX):
+            # Versioned database, see database_manager.py .
+            name = file_name[: -len(CURRENT_SUFFIX)]
+            if is_database_available(name):
+                result.append(name)
+            continue
         if not file_name.endswith(".psi"):
             continue
         path = os.path.join(BLASTDB, file_name)
         if not os.path.isfile(path):
             continue
         name = file_name[:-4]
-        # Name can be file.00, so we remove the number.
-        if name[-3] == ".":
+        # Name can be file.00 or file.00.00, so we remove the numbers.
+        while len(name) > 3 and name[-3] == ".":
             name = name[:-3]
         if is_database_available(name):
             result.append(name)
@@ -55,10 +100,14 @@ def is_database_available(name: str) -> bool:
     Basic check for available files, does not recognize if some files
     are missing.
     """
-    base_name = os.path.join(BLASTDB, name)
-    # It may be from multiple files, so check for the first one.
-    return are_database_files_available(base_name) or are_database_files_available(
-        base_name + ".00"
+    base_name = os.path.join(get_database_directory(name), name)
+    # It may be from multiple files, so check for the first one. A sharded
+    # database may have its shards split by makeblastdb again, so the first
+    # volume is name.00.00 with an alias file name.00.pal .
+    return (
+        are_database_files_available(base_name)
+        or are_database_files_available(base_name + ".00")
+        or os.path.exists(base_name + ".00.pal")
     )
 
 
@@ -70,35 +119,552 @@ def are_database_files_available(base_name: str) -> bool:
     return True
 
 
+def get_database_directory(name: str) -> str:
+    """
+    Return directory with files of the database. For versioned database
+    it is a symbolic link to the current version, else it is BLASTDB.
+    """
+    current = os.path.join(BLASTDB, name + CURRENT_SUFFIX)
+    if os.path.islink(current):
+        return current
+    return BLASTDB
+
+
+# region Build
+
+
 def prepare_databases(
     execute_command: typing.Callable[[str], None], names: typing.List[str]
 ):
+    """Build databases that are not available."""
+    build_databases(
+        execute_command, [name for name in names if not is_database_available(name)]
+    )
+
+
+def prepare_database(execute_command: typing.Callable[[str], None], name: str):
+    build_databases(execute_command, [name])
+
+
+def get_changed_databases(names: typing.List[str]) -> typing.List[str]:
+    """Return databases that are not available or have changed source."""
+    result = []
     for name in names:
-        if is_database_available(name):
+        if not is_database_available(name):
+            result.append(name)
+            continue
+        built = load_database_source(get_database_directory(name), name)
+        if built is None:
+            logging.info("Unknown source of %s, use rebuild to update it.", name)
+            continue
+        try:
+            source = _get_source_version(get_database_url(name))
+        except (OSError, urllib.error.URLError):
+            logging.warning("Can't check source of %s.", name)
             continue
-        prepare_database(execute_command, name)
+        if built["source"] != source:
+            result.append(name)
+    return result
 
 
-def prepare_database(execute_command: typing.Callable[[str], None], name: str):
+def build_databases(
+    execute_command: typing.Callable[[str], None],
+    names: typing.List[str],
+    target_dirs: typing.Optional[typing.Dict[str, str]] = None,
+) -> typing.Dict[str, typing.Dict]:
+    """
+    Build the databases concurrently, return report for each database.
+    Databases are built into BLASTDB unless given a target directory.
+    """
+    if len(names) == 0:
+        return {}
     if BLASTDMAKEDB_CMD is None:
         raise RuntimeError(
             "Can't create database as environment variable "
             "BLASTDMAKEDB_CMD is not set."
         )
-    #
+    max_workers = min(BLASTDB_BUILD_WORKERS, len(names))
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = {
+            name: executor.submit(
+                build_database,
+                execute_command,
+                name,
+                (target_dirs or {}).get(name, BLASTDB),
+            )
+            for name in names
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def build_database(
+    execute_command: typing.Callable[[str], None], name: str, target_dir: str = BLASTDB
+) -> typing.Dict:
+    """
+    Download, verify and format the database. All files are kept in a build
+    directory till the database is complete, so interrupted build continues
+    from the last completed stage.
+    """
     logging.info("Preparing database: %s ...", name)
+    url = get_database_url(name)
+    build_dir = os.path.join(BLASTDB, "build", name)
+    os.makedirs(build_dir, exist_ok=True)
+    state_file = os.path.join(build_dir, "state.json")
+    state = _load_json(state_file) or {}
+    source = _get_source_version(url)
+    if state.get("source") != source:
+        # The source has changed, start from scratch.
+        shutil.rmtree(build_dir)
+        os.makedirs(build_dir)
+        state = {"source": source, "stages": []}
+        _save_json(state_file, state)
+    report = {}
+    archive = os.path.join(build_dir, os.path.basename(urllib.parse.urlparse(url).path))
+    # The archive is renamed into place once complete.
+    if not os.path.exists(archive):
+        report["download"] = _measure(_download, url, archive)
+    if "verify" not in state["stages"]:
+        report["verify"] = _measure(_verify_checksum, url, archive)
+        state["stages"].append("verify")
+        _save_json(state_file, state)
+    database_dir = os.path.join(build_dir, "database")
+    os.makedirs(database_dir, exist_ok=True)
+    if BLASTDB_SHARDS > 1:
+        _format_sharded_database(
+            execute_command, name, archive, database_dir, state, state_file, report
+        )
+    elif "format" not in state["stages"]:
+        report["format"] = _measure(
+            _format_database, execute_command, name, archive, database_dir
+        )
+        state["stages"].append("format")
+        _save_json(state_file, state)
+    # Move the database files into place, and keep source for updates.
+    os.makedirs(target_dir, exist_ok=True)
+    _remove_database_files(target_dir, name)
+    for file_name in os.listdir(database_dir):
+        os.replace(
+            os.path.join(database_dir, file_name), os.path.join(target_dir, file_name)
+        )
+    _save_json(_source_file(target_dir, name), {"url": url, "source": source})
+    shutil.rmtree(build_dir)
+    for stage, stage_report in report.items():
+        logging.info(
+            "Stage %s of %s: %.1f MB in %.1f s (%.1f MB/s)",
+            stage,
+            name,
+            stage_report["bytes"] / 1024 / 1024,
+            stage_report["seconds"],
+            stage_report["throughput"] / 1024 / 1024,
+        )
+    logging.info("Preparing database: %s ... done", name)
+    return report
+
+
+def get_database_url(name: str) -> str:
     url = DATABASE_NAME_TO_URL[name]
-    path = os.path.join(BLASTDB, name)
+    if BLASTDB_MIRROR is None:
+        return url
+    file_name = os.path.basename(urllib.parse.urlparse(url).path)
+    return BLASTDB_MIRROR.rstrip("/") + "/" + file_name
+
+
+def _measure(callback, *args) -> typing.Dict:
+    """Execute callback returning number of processed bytes."""
+    start = time.perf_counter()
+    size = callback(*args)
+    seconds = time.perf_counter() - start
+    return {
+        "bytes": size,
+        "seconds": seconds,
+        "throughput": size / seconds if seconds > 0 else 0,
+    }
+
+
+def _download(url: str, target: str) -> int:
+    """Download to a partial file first, continue with existing partial file."""
+    partial = target + ".part"
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if offset > 0:
+        logging.info("Resuming download of %s from %s bytes.", url, offset)
+    local_path = _local_path(url)
+    if local_path is not None:
+        in_stream = open(local_path, "rb")
+        in_stream.seek(offset)
+    else:
+        request = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"})
+        in_stream = urllib.request.urlopen(request, timeout=BLASTDB_DOWNLOAD_TIMEOUT)
+        if offset > 0 and in_stream.status != 206:
+            logging.info("Server does not support resume, downloading again.")
+            offset = 0
+    with in_stream, open(partial, "ab" if offset > 0 else "wb") as out_stream:
+        shutil.copyfileobj(in_stream, out_stream, DOWNLOAD_BLOCK_SIZE)
+    size = os.path.getsize(partial)
+    os.replace(partial, target)
+    return size - offset
+
+
+def _verify_checksum(url: str, archive: str) -> int:
+    """Compare with MD5 checksum published next to the file, if available."""
+    size = os.path.getsize(archive)
+    expected = _fetch_checksum(url)
+    if expected is None:
+        logging.warning("Missing checksum for %s, skipping verification.", url)
+        return size
+    digest = hashlib.md5()
+    with open(archive, "rb") as stream:
+        for block in iter(lambda: stream.read(DOWNLOAD_BLOCK_SIZE), b""):
+            digest.update(block)
+    if digest.hexdigest() != expected:
+        # Remove the file, so it is downloaded again.
+        os.remove(archive)
+        raise Exception(f"Checksum mismatch for {url}.")
+    return size
+
+
+def _fetch_checksum(url: str) -> typing.Optional[str]:
+    try:
+        local_path = _local_path(url + ".md5")
+        if local_path is not None:
+            with open(local_path) as stream:
+                content = stream.read()
+        else:
+            with urllib.request.urlopen(
+                url + ".md5", timeout=BLASTDB_DOWNLOAD_TIMEOUT
+            ) as stream:
+                content = stream.read().decode("utf-8")
+    except (OSError, urllib.error.URLError):
+        return None
+    # Format of md5sum output: checksum file_name
+    return content.split()[0].lower()
+
+
+def _get_source_version(url: str) -> typing.Dict:
+    """Return size and modification time of the source."""
+    local_path = _local_path(url)
+    if local_path is not None:
+        stat = os.stat(local_path)
+        return {"size": stat.st_size, "modified": stat.st_mtime}
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request, timeout=BLASTDB_DOWNLOAD_TIMEOUT) as response:
+        return {
+            "size": int(response.headers.get("Content-Length", "0")),
+            "modified": response.headers.get("Last-Modified"),
+        }
+
+
+def _local_path(url: str) -> typing.Optional[str]:
+    """Return path for file:// URL or local path, None for other URLs."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        return urllib.request.url2pathname(parsed.path)
+    if parsed.scheme == "":
+        return url
+    return None
+
+
+def _decompress_command(archive: str) -> str:
+    return f"{DECOMPRESS_CMD} -dc {archive}"
+
+
+def _format_database(
+    execute_command: typing.Callable[[str], None],
+    name: str,
+    archive: str,
+    database_dir: str,
+) -> int:
     command = (
-        "curl "
-        + url
-        + " | gunzip | "
+        _decompress_command(archive)
+        + " | "
         + BLASTDMAKEDB_CMD
         + " -out "
-        + path
+        + os.path.join(database_dir, name)
         + " -title "
         + name
         + " -dbtype prot -parse_seqids"
     )
     execute_command(command)
-    logging.info("Preparing database: %s ... done", name)
+    return os.path.getsize(archive)
+
+
+def _format_sharded_database(
+    execute_command: typing.Callable[[str], None],
+    name: str,
+    archive: str,
+    database_dir: str,
+    state: typing.Dict,
+    state_file: str,
+    report: typing.Dict,
+):
+    """
+    Create database from volumes with similar number of residues, the
+    volumes are formatted in parallel and joined by an alias file.
+    """
+    shard_names = [f"{name}.{index:02d}" for index in range(BLASTDB_SHARDS)]
+    shard_files = [
+        os.path.join(os.path.dirname(archive), shard + ".fasta")
+        for shard in shard_names
+    ]
+    if "split" not in state["stages"]:
+        report["split"] = _measure(_split_archive, archive, shard_files)
+        state["stages"].append("split")
+        _save_json(state_file, state)
+
+    def format_shard(shard: str, shard_file: str):
+        command = (
+            BLASTDMAKEDB_CMD
+            + " -in "
+            + shard_file
+            + " -out "
+            + os.path.join(database_dir, shard)
+            + " -title "
+            + name
+            + " -dbtype prot -parse_seqids -max_file_sz 4GB"
+        )
+        execute_command(command)
+        return os.path.getsize(shard_file)
+
+    pending = [
+        (shard, shard_file)
+        for shard, shard_file in zip(shard_names, shard_files)
+        if "format-" + shard not in state["stages"]
+    ]
+    start = time.perf_counter()
+    size = 0
+    with concurrent.futures.ThreadPoolExecutor(max(1, len(pending))) as executor:
+        futures = {
+            shard: executor.submit(format_shard, shard, shard_file)
+            for shard, shard_file in pending
+        }
+        for shard, future in futures.items():
+            size += future.result()
+            state["stages"].append("format-" + shard)
+            _save_json(state_file, state)
+    seconds = time.perf_counter() - start
+    report["format"] = {
+        "bytes": size,
+        "seconds": seconds,
+        "throughput": size / seconds if seconds > 0 else 0,
+    }
+    with open(os.path.join(database_dir, name + ".pal"), "w") as stream:
+        stream.write(f"TITLE {name}\n")
+        stream.write("DBLIST " + " ".join(shard_names) + "\n")
+
+
+def _split_archive(archive: str, shard_files: typing.List[str]) -> int:
+    process = subprocess.Popen(
+        _decompress_command(archive), shell=True, stdout=subprocess.PIPE
+    )
+    try:
+        size = _split_fasta(process.stdout, shard_files)
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return size
+
+
+def _split_fasta(in_stream: typing.BinaryIO, output_files: typing.List[str]) -> int:
+    """Each record is written to the file with least residues, return size."""
+    out_streams = [open(file, "wb") for file in output_files]
+    # Number of residues and index of the output.
+    sizes = [(0, index) for index in range(len(output_files))]
+    total_size = 0
+    try:
+        record = []
+        record_size = 0
+        for line in in_stream:
+            total_size += len(line)
+            if line.startswith(b">") and len(record) > 0:
+                size, index = heapq.heappop(sizes)
+                out_streams[index].writelines(record)
+                heapq.heappush(sizes, (size + record_size, index))
+                record = []
+                record_size = 0
+            record.append(line)
+            if not line.startswith(b">"):
+                record_size += len(line.strip())
+        if len(record) > 0:
+            out_streams[heapq.heappop(sizes)[1]].writelines(record)
+    finally:
+        for stream in out_streams:
+            stream.close()
+    return total_size
+
+
+def _remove_database_files(directory: str, name: str):
+    """Remove files of the database, including volumes and alias file."""
+    pattern = re.compile(re.escape(name) + r"(\.\d\d){0,2}\.(p[a-z]{2})")
+    for file_name in os.listdir(directory):
+        if pattern.fullmatch(file_name):
+            os.remove(os.path.join(directory, file_name))
+
+
+def load_database_source(directory: str, name: str) -> typing.Optional[typing.Dict]:
+    """Return URL and source version the database was built from."""
+    return _load_json(_source_file(directory, name))
+
+
+def _source_file(directory: str, name: str) -> str:
+    return os.path.join(directory, name + ".source.json")
+
+
+def _load_json(file: str) -> typing.Optional[typing.Dict]:
+    try:
+        with open(file, encoding="utf-8") as stream:
+            return json.load(stream)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _save_json(file: str, content: typing.Dict):
+    # Write and rename, so the file is never partially written.
+    temp_file = file + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as stream:
+        json.dump(content, stream)
+    os.replace(temp_file, file)
+
+
+# endregion
+
+
+def resolve_database(name: str) -> str:
+    """
+    Return path to the database in the current version, or the name for
+    not versioned database. Resolve the database once for a search, so all
+    files used by the search are from the same version even when a new
+    version is activated during the search.
+    """
+    if BLASTDB is None:
+        return name
+    directory = get_database_directory(name)
+    if directory == BLASTDB:
+        return name
+    return os.path.join(os.path.realpath(directory), name)
+
+
+def get_database_version(database: str) -> typing.Optional[str]:
+    """Return version of database returned by resolve_database."""
+    directory = os.path.dirname(database)
+    if directory == "":
+        return None
+    return os.path.basename(directory)
+
+
+def get_database_volumes(database: str) -> typing.List[str]:
+    """
+    Return volumes of database returned by resolve_database, or the
+    database for single volume.
+    """
+    directory, name = os.path.split(database)
+    prefix = ""
+    if directory == "":
+        directory = BLASTDB
+    else:
+        prefix = directory + os.path.sep
+    pattern = re.compile(re.escape(name) + r"\.\d\d\.(pin|pal)")
+    result = sorted(
+        prefix + file_name[:-4]
+        for file_name in os.listdir(directory)
+        if pattern.fullmatch(file_name)
+    )
+    if len(result) == 0:
+        return [database]
+    return result
+
+
+DatabaseSize = collections.namedtuple("DatabaseSize", ["sequences", "residues"])
+
+# Sizes of databases.
+_database_sizes: typing.Dict[str, DatabaseSize] = {}
+
+
+def get_database_size(name: str) -> DatabaseSize:
+    """
+    Return number of sequences and total number of residues in the database,
+    use path returned by resolve_database for versioned database.
+    """
+    if name not in _database_sizes:
+        output = subprocess.run(
+            [BLASTDBCMD_CMD, "-db", name, "-info"],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            env=os.environ.copy(),
+            check=True,
+        ).stdout
+        match = re.search(r"([\d,]+) sequences; ([\d,]+) total residues", output)
+        if match is None:
+            raise Exception(f"Can't read size of database '{name}'.")
+        _database_sizes[name] = DatabaseSize(
+            int(match.group(1).replace(",", "")),
+            int(match.group(2).replace(",", "")),
+        )
+    return _database_sizes[name]
+
+
+# Gapped Karlin-Altschul parameters of BLOSUM62 with gap costs 11/1,
+# the PSI-BLAST defaults: lambda, K, alpha and beta.
+BLOSUM62_GAPPED_PARAMETERS = (0.267, 0.041, 1.9, -30)
+
+
+def compute_search_space(query_length: int, database_size: DatabaseSize) -> int:
+    """
+    Return effective search space as computed by BLAST for the whole
+    database, so a search in a volume can report the same E-values.
+    """
+    length_adjustment = _compute_length_adjustment(
+        query_length, database_size.residues, database_size.sequences
+    )
+    database_length = max(
+        database_size.residues - database_size.sequences * length_adjustment, 1
+    )
+    return max(query_length - length_adjustment, 1) * database_length
+
+
+def _compute_length_adjustment(
+    query_length: int, database_length: int, database_sequences: int
+) -> int:
+    """Port of BLAST_ComputeLengthAdjustment from NCBI BLAST."""
+    lambda_, k, alpha, beta = BLOSUM62_GAPPED_PARAMETERS
+    log_k = math.log(k)
+    alpha_d_lambda = alpha / lambda_
+    m, n, count = query_length, database_length, database_sequences
+    # Largest length for which K * (m - ell) * (n - count * ell) > max(m, n).
+    a = count
+    mb = m * count + n
+    c = n * m - max(m, n) / k
+    if c < 0:
+        return 0
+    ell_max = 2 * c / (mb + math.sqrt(mb * mb - 4 * a * c))
+    ell_min = 0
+    ell_next = 0
+    converged = False
+    for iteration in range(1, 21):
+        ell = ell_next
+        search_space = (m - ell) * (n - count * ell)
+        ell_bar = alpha_d_lambda * (log_k + math.log(search_space)) + beta
+        if ell_bar >= ell:
+            ell_min = ell
+            if ell_bar - ell_min <= 1.0:
+                converged = True
+                break
+            if ell_min == ell_max:
+                break
+        else:
+            ell_max = ell
+        if ell_min <= ell_bar <= ell_max:
+            ell_next = ell_bar
+        elif iteration == 1:
+            ell_next = ell_max
+        else:
+            ell_next = (ell_min + ell_max) / 2
+    result = int(ell_min)
+    if converged:
+        # Try the ceiling, it may also satisfy the condition.
+        ell = math.ceil(ell_min)
+        if ell <= ell_max:
+            search_space = (m - ell) * (n - count * ell)
+            if alpha_d_lambda * (log_k + math.log(search_space)) + beta >= ell:
+                result = ell
+    return result
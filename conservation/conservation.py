@@ -1,11 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
-# Compute conservation from MSA using
+# Compute conservation from MSA using Jensen-Shannon divergence, see
 # https://compbio.cs.princeton.edu/conservation/.
 #
 # Required environment variables:
-#   * JENSE_SHANNON_DIVERGANCE_DIR  = conservation_code/
 #   * PSIBLAST_CMD                  = ncbi-blast-2.9.0+/bin/psiblast
 #   * BLASTDBCMD_CMD                = ncbi-blast-2.9.0+/bin/blastdbcmd
 #   * CDHIT_CMD                     = cd-hit-v4.8.1-2019-0228/cd-hit
@@ -23,11 +22,17 @@ import logging
 import argparse
 import subprocess
 import shutil
+import signal
+import threading
 
 import multiple_sequence_alignment as msa
+import jensen_shannon_divergence
 import blast_database
-
-JENSE_SHANNON_DIVERGANCE_DIR = os.environ.get("JENSE_SHANNON_DIVERGANCE_DIR", None)
+import database_manager
+import fasta
+import sequence_store
+import search_plan
+import kmer_index
 
 PSIBLAST_CMD = os.environ.get("PSIBLAST_CMD", None)
 
@@ -49,6 +54,50 @@ class ConservationConfiguration:
     execute_command: typing.Callable[[str], None]
     # Name of BLAST databases used to compute MSA.
     blast_databases: typing.List[str] = None
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_concurrent_database_search: bool = False
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_maximum_concurrent_searches: int = 0
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_streaming_search: bool = False
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_adaptive_alignment: bool = False
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_alignment_time_budget: float = 0
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_checkpoints: bool = False
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_sharded_search: bool = False
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_maximum_volume_searches: int = 0
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_trim_hits: bool = False
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_trim_flank: int = 20
+    # Directory with sequence stores, see sequence_store. When not set,
+    # sequences are retrieved using blastdbcmd. Versioned databases use
+    # the store in their version directory, see database_manager, for
+    # them the directory is only used to enable the stores.
+    sequence_store_dir: typing.Optional[str] = None
+    # Directory with k-mer indexes, see kmer_index. Required for
+    # msa_prefilter_databases. Versioned databases use the index in
+    # their version directory, for them the directory is only used to
+    # enable the prefilter.
+    kmer_index_dir: typing.Optional[str] = None
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    msa_prefilter_databases: typing.List[str] = []
+    # Directory with search plans, see search_plan. When not set,
+    # all databases are searched.
+    search_plan_dir: typing.Optional[str] = None
+    # See multiple_sequence_alignment.MsaConfiguration for more details.
+    psiblast_results: typing.Dict[str, str] = None
+    # Optional semaphore limiting number of concurrently running tools,
+    # it can be shared with other processes.
+    tools_limit: typing.Optional[threading.Semaphore] = None
+    # Paths to current versions of the databases, see resolve_databases.
+    # They are resolved once, so the search and keys of cached results
+    # use the same versions.
+    database_paths: typing.Optional[typing.Dict[str, str]] = None
 
 
 def _read_arguments() -> typing.Dict[str, str]:
@@ -66,6 +115,83 @@ def _read_arguments() -> typing.Dict[str, str]:
         nargs="+",
         help="BLAST databases used for MSA computation.",
     )
+    parser.add_argument(
+        "--concurrent-search",
+        action="store_true",
+        help="Search all BLAST databases concurrently.",
+    )
+    parser.add_argument(
+        "--max-searches",
+        default=0,
+        type=int,
+        help="Maximum number of concurrent searches, 0 for number of CPUs.",
+    )
+    parser.add_argument(
+        "--streaming-search",
+        action="store_true",
+        help="Filter PSI-BLAST output as it is produced.",
+    )
+    parser.add_argument(
+        "--adaptive-alignment",
+        action="store_true",
+        help="Select MUSCLE options based on query length and sequence count.",
+    )
+    parser.add_argument(
+        "--alignment-budget",
+        default=0,
+        type=float,
+        help="Time budget for adaptive alignment in seconds, 0 for no limit.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Record completed stages and resume from them when restarted.",
+    )
+    parser.add_argument(
+        "--sharded-search",
+        action="store_true",
+        help="Search volumes of a database in parallel.",
+    )
+    parser.add_argument(
+        "--max-volume-searches",
+        default=0,
+        type=int,
+        help="Maximum number of concurrently searched volumes, 0 for number of CPUs.",
+    )
+    parser.add_argument(
+        "--trim-hits",
+        action="store_true",
+        help="Cut found sequences to the region aligned to the query.",
+    )
+    parser.add_argument(
+        "--trim-flank",
+        default=20,
+        type=int,
+        help="Number of residues kept around the aligned region.",
+    )
+    parser.add_argument(
+        "--sequence-store",
+        default=sequence_store.SEQUENCE_STORE_DIR,
+        help="Directory with sequence stores used instead of blastdbcmd.",
+    )
+    parser.add_argument(
+        "--kmer-index",
+        default=kmer_index.KMER_INDEX_DIR,
+        help="Directory with k-mer indexes used to prefilter searches.",
+    )
+    parser.add_argument(
+        "--prefilter-database",
+        metavar="D",
+        default=[],
+        type=str,
+        nargs="+",
+        help="BLAST databases searched only in candidates from k-mer index.",
+    )
+    parser.add_argument(
+        "--search-plan",
+        default=search_plan.CONSERVATION_SEARCH_PLAN_DIR,
+        help="Directory with search plans used to skip insufficient databases.",
+    )
     return vars(parser.parse_args())
 
 
@@ -76,11 +202,26 @@ def main(arguments):
         return
     config = ConservationConfiguration()
     config.blast_databases = arguments["database"]
+    config.msa_concurrent_database_search = arguments["concurrent_search"]
+    config.msa_maximum_concurrent_searches = arguments["max_searches"]
+    config.msa_streaming_search = arguments["streaming_search"]
+    config.msa_adaptive_alignment = arguments["adaptive_alignment"]
+    config.msa_alignment_time_budget = arguments["alignment_budget"]
+    config.msa_checkpoints = arguments["resume"]
+    config.msa_sharded_search = arguments["sharded_search"]
+    config.msa_maximum_volume_searches = arguments["max_volume_searches"]
+    config.msa_trim_hits = arguments["trim_hits"]
+    config.msa_trim_flank = arguments["trim_flank"]
+    config.sequence_store_dir = arguments["sequence_store"]
+    config.search_plan_dir = arguments["search_plan"]
+    config.kmer_index_dir = arguments["kmer_index"]
+    config.msa_prefilter_databases = arguments["prefilter_database"]
     config.execute_command = _default_execute_command
     os.makedirs(arguments["working"], exist_ok=True)
     compute_conservation(
         arguments["input"], arguments["working"], arguments["output"], config
     )
+    # Remove only on success, so failed computation can be resumed.
     shutil.rmtree(arguments["working"])
 
 
@@ -98,6 +239,26 @@ def _default_execute_command(command: str):
     result.check_returncode()
 
 
+def execute_cancellable_command(command: str, cancel: threading.Event):
+    """
+    Execute command, terminate it and raise msa.SearchCancelled when
+    the cancel event is set.
+    """
+    if cancel.is_set():
+        raise msa.SearchCancelled()
+    # Use new session, so we can terminate the shell and all its children.
+    process = subprocess.Popen(
+        command, shell=True, env=os.environ.copy(), start_new_session=True
+    )
+    while process.poll() is None:
+        if cancel.wait(timeout=0.5):
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+            raise msa.SearchCancelled()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
 def compute_conservation(
     input_file: str,
     working_dir: str,
@@ -108,46 +269,277 @@ def compute_conservation(
     msa_file = os.path.join(working_dir, "msa")
     msa_config = create_msa_configuration(working_dir, config)
     msa.compute_msa(input_file, msa_file, msa_config)
-    compute_jensen_shannon_divergence(msa_file, output_file, config)
+    # Write and rename, so existing output file is always complete.
+    temp_file = output_file + ".tmp"
+    compute_jensen_shannon_divergence(msa_file, temp_file)
+    os.replace(temp_file, output_file)
     return msa_file
 
 
+def search_in_batch(
+    fasta_files: typing.Dict[str, str],
+    working_dir: str,
+    config: ConservationConfiguration,
+) -> typing.Dict[str, typing.Dict[str, str]]:
+    """
+    Search all sequences at once, the result for each sequence can be used
+    as ConservationConfiguration.psiblast_results.
+    """
+    msa_config = create_msa_configuration(working_dir, config)
+    return msa.search_in_batch(fasta_files, msa_config)
+
+
+def resolve_databases(config: ConservationConfiguration) -> typing.Dict[str, str]:
+    """Resolve current versions of the databases, only once for the config."""
+    if config.database_paths is None:
+        config.database_paths = {
+            database: blast_database.resolve_database(database)
+            for database in config.blast_databases or []
+        }
+    return config.database_paths
+
+
+def get_database_versions(config: ConservationConfiguration) -> typing.Dict[str, str]:
+    """Return versions of versioned databases."""
+    result = {}
+    for database, path in resolve_databases(config).items():
+        version = blast_database.get_database_version(path)
+        if version is not None:
+            result[database] = version
+    return result
+
+
 def create_msa_configuration(
     working_dir: str, config: ConservationConfiguration
 ) -> msa.MsaConfiguration:
+    database_paths = resolve_databases(config)
     result = msa.MsaConfiguration()
     result.minimum_sequence_count = config.msa_minimum_sequence_count
     result.minimum_coverage = config.msa_minimum_coverage
     result.maximum_sequences_for_msa = config.msa_maximum_sequences
     result.blast_databases = config.blast_databases
+    result.concurrent_database_search = config.msa_concurrent_database_search
+    result.maximum_concurrent_searches = config.msa_maximum_concurrent_searches
+    result.streaming_search = config.msa_streaming_search
+    result.adaptive_alignment = config.msa_adaptive_alignment
+    result.alignment_time_budget = config.msa_alignment_time_budget
+    result.checkpoints = config.msa_checkpoints
+    result.sharded_search = config.msa_sharded_search
+    result.maximum_volume_searches = config.msa_maximum_volume_searches
+    result.trim_hits = config.msa_trim_hits
+    result.trim_flank = config.msa_trim_flank
     result.working_dir = working_dir
-    result.execute_psiblast = _create_execute_psiblast(config.execute_command)
-    result.execute_blastdb = _create_execute_blastdbcmd(config.execute_command)
-    result.execute_cdhit = _create_execute_cdhit(config.execute_command)
-    result.execute_muscle = _create_execute_muscle(config.execute_command)
+    result.database_versions = get_database_versions(config)
+    if config.psiblast_results is not None:
+        result.psiblast_results = config.psiblast_results
+    result.execute_psiblast = _limit_concurrency(
+        _create_execute_psiblast(config.execute_command, database_paths),
+        config.tools_limit,
+    )
+    result.list_database_volumes = _create_list_database_volumes(database_paths)
+    result.execute_psiblast_volume = _limit_concurrency(
+        _create_execute_psiblast_volume(config.execute_command), config.tools_limit
+    )
+    result.execute_psiblast_batch = _limit_concurrency(
+        _create_execute_psiblast_batch(config.execute_command, database_paths),
+        config.tools_limit,
+    )
+    result.start_psiblast = _limit_process_concurrency(
+        _create_start_psiblast(database_paths), config.tools_limit
+    )
+    result.execute_blastdb = _limit_concurrency(
+        _create_execute_blastdbcmd(config.execute_command, database_paths),
+        config.tools_limit,
+    )
+    if config.sequence_store_dir is not None:
+        result.retrieve_sequences = _create_retrieve_sequences(
+            config.sequence_store_dir, database_paths
+        )
+    if config.search_plan_dir is not None:
+        result.plan_search, result.record_search = _create_search_plan(
+            config.search_plan_dir, config
+        )
+    if config.kmer_index_dir is not None:
+        result.prefilter_databases = config.msa_prefilter_databases
+        result.find_candidates = _create_find_candidates(
+            config.kmer_index_dir, database_paths
+        )
+    result.execute_makeblastdb = _create_execute_makeblastdb(config.execute_command)
+    result.start_blastdb = _limit_process_concurrency(
+        _create_start_blastdbcmd(database_paths), config.tools_limit
+    )
+    result.execute_cdhit = _limit_concurrency(
+        _create_execute_cdhit(config.execute_command), config.tools_limit
+    )
+    result.execute_muscle = _limit_concurrency(
+        _create_execute_muscle(config.execute_command), config.tools_limit
+    )
     return result
 
 
-def _create_execute_psiblast(execute_command):
+def _limit_concurrency(callback, semaphore: typing.Optional[threading.Semaphore]):
+    """Execute the callback only when the semaphore is acquired."""
+    if semaphore is None:
+        return callback
+
+    def limited_callback(*args, **kwargs):
+        with semaphore:
+            return callback(*args, **kwargs)
+
+    return limited_callback
+
+
+def _limit_process_concurrency(
+    callback, semaphore: typing.Optional[threading.Semaphore]
+):
+    """Start the process only when the semaphore is acquired, the semaphore
+    is released once the process terminates."""
+    if semaphore is None:
+        return callback
+
+    def limited_callback(*args, **kwargs):
+        semaphore.acquire()
+        try:
+            process = callback(*args, **kwargs)
+        except BaseException:
+            semaphore.release()
+            raise
+
+        def release_on_exit():
+            process.wait()
+            semaphore.release()
+
+        threading.Thread(target=release_on_exit, daemon=True).start()
+        return process
+
+    return limited_callback
+
+
+def _create_execute_psiblast(execute_command, database_paths: typing.Dict[str, str]):
     """Search for similar sequences using PSI-BLAST."""
 
-    def execute_psiblast(input_file: str, output_file: str, database: str):
-        output_format = "6 sallseqid qcovs pident"
+    def execute_psiblast(
+        input_file: str,
+        output_file: str,
+        database: str,
+        cancel: typing.Optional[threading.Event] = None,
+    ):
+        output_format = "6 sallseqid qcovs pident sstart send"
         cmd = "{} < {} -db {} -outfmt '{}' -evalue 1e-5 > {}".format(
-            PSIBLAST_CMD, input_file, database, output_format, output_file
+            PSIBLAST_CMD,
+            input_file,
+            database_paths.get(database, database),
+            output_format,
+            output_file,
         )
         logging.debug("Executing PSI-BLAST ...")
-        execute_command(cmd)
+        if cancel is None:
+            execute_command(cmd)
+        else:
+            execute_cancellable_command(cmd, cancel)
 
     return execute_psiblast
 
 
-def _create_execute_blastdbcmd(execute_command):
+def _create_list_database_volumes(database_paths: typing.Dict[str, str]):
+    def list_database_volumes(
+        database: str,
+    ) -> typing.Tuple[typing.List[str], blast_database.DatabaseSize]:
+        path = database_paths.get(database, database)
+        return (
+            blast_database.get_database_volumes(path),
+            blast_database.get_database_size(path),
+        )
+
+    return list_database_volumes
+
+
+def _create_execute_psiblast_volume(execute_command):
+    """Search in a database volume using PSI-BLAST."""
+
+    def execute_psiblast_volume(
+        input_file: str,
+        output_file: str,
+        volume: str,
+        database_size: blast_database.DatabaseSize,
+        cancel: typing.Optional[threading.Event] = None,
+    ):
+        output_format = "6 sallseqid qcovs pident sstart send evalue bitscore"
+        # Use size and search space of the whole database so the E-values
+        # are the same, the length adjustment depends on the database.
+        query_length = len(fasta.read_fasta_file(input_file)[0][1])
+        search_space = blast_database.compute_search_space(query_length, database_size)
+        cmd = (
+            "{} < {} -db {} -dbsize {} -searchsp {} -outfmt '{}' -evalue 1e-5 > {}"
+        ).format(
+            PSIBLAST_CMD,
+            input_file,
+            volume,
+            database_size.residues,
+            search_space,
+            output_format,
+            output_file,
+        )
+        logging.debug("Executing PSI-BLAST on '%s' ...", volume)
+        if cancel is None:
+            execute_command(cmd)
+        else:
+            execute_cancellable_command(cmd, cancel)
+
+    return execute_psiblast_volume
+
+
+def _create_execute_psiblast_batch(
+    execute_command, database_paths: typing.Dict[str, str]
+):
+    """Search for similar sequences for multiple queries using PSI-BLAST."""
+
+    def execute_psiblast_batch(input_file: str, output_file: str, database: str):
+        output_format = "6 qseqid sallseqid qcovs pident sstart send"
+        cmd = "{} < {} -db {} -outfmt '{}' -evalue 1e-5 > {}".format(
+            PSIBLAST_CMD,
+            input_file,
+            database_paths.get(database, database),
+            output_format,
+            output_file,
+        )
+        logging.debug("Executing PSI-BLAST for multiple queries ...")
+        execute_command(cmd)
+
+    return execute_psiblast_batch
+
+
+def _create_start_psiblast(database_paths: typing.Dict[str, str]):
+    def start_psiblast(input_file: str, database: str) -> subprocess.Popen:
+        output_format = "6 sallseqid qcovs pident sstart send"
+        cmd = "{} < {} -db {} -outfmt '{}' -evalue 1e-5".format(
+            PSIBLAST_CMD,
+            input_file,
+            database_paths.get(database, database),
+            output_format,
+        )
+        logging.debug("Starting PSI-BLAST ...")
+        return subprocess.Popen(
+            cmd,
+            shell=True,
+            env=os.environ.copy(),
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            start_new_session=True,
+        )
+
+    return start_psiblast
+
+
+def _create_execute_blastdbcmd(execute_command, database_paths: typing.Dict[str, str]):
     """Retrieve sequences from database."""
 
     def execute_blastdbcmd(input_file: str, sequence_file: str, database: str):
         cmd = "{} -db {} -entry_batch {} > {}".format(
-            BLASTDBCMD_CMD, database, input_file, sequence_file
+            BLASTDBCMD_CMD,
+            database_paths.get(database, database),
+            input_file,
+            sequence_file,
         )
         logging.debug("Executing BLAST ...")
         execute_command(cmd)
@@ -155,6 +547,107 @@ def _create_execute_blastdbcmd(execute_command):
     return execute_blastdbcmd
 
 
+def _create_retrieve_sequences(store_dir: str, database_paths: typing.Dict[str, str]):
+    """Retrieve sequences from local sequence store."""
+
+    def retrieve_sequences(input_file: str, output_file: str, database: str):
+        directory = _select_database_directory(
+            store_dir,
+            database_paths.get(database, database),
+            database_manager.VERSION_SEQUENCE_STORE_DIR,
+        )
+        return sequence_store.retrieve_sequences(
+            directory, database, input_file, output_file
+        )
+
+    return retrieve_sequences
+
+
+def _create_find_candidates(index_dir: str, database_paths: typing.Dict[str, str]):
+    """Select candidates using local k-mer index."""
+
+    def find_candidates(input_file: str, database: str, output_file: str):
+        directory = _select_database_directory(
+            index_dir,
+            database_paths.get(database, database),
+            database_manager.VERSION_KMER_INDEX_DIR,
+        )
+        return kmer_index.write_candidates(directory, database, input_file, output_file)
+
+    return find_candidates
+
+
+def _select_database_directory(
+    directory: str, database_path: str, version_subdirectory: str
+) -> str:
+    """
+    Return directory with stores or indexes for the database. For versioned
+    database they are in the version directory, see database_manager, and
+    the configured directory is not used. A store outside of the version
+    directory can't be swapped together with the database, so it could
+    return sequences of another version.
+    """
+    version_dir = os.path.dirname(database_path)
+    if version_dir == "":
+        return directory
+    return os.path.join(version_dir, version_subdirectory)
+
+
+def _create_execute_makeblastdb(execute_command):
+    def execute_makeblastdb(sequences_file: str, database: str):
+        cmd = "{} -in {} -out {} -dbtype prot -parse_seqids".format(
+            blast_database.BLASTDMAKEDB_CMD, sequences_file, database
+        )
+        logging.debug("Executing makeblastdb ...")
+        execute_command(cmd)
+
+    return execute_makeblastdb
+
+
+def _create_search_plan(plan_dir: str, config: ConservationConfiguration):
+    """Plan and record searches using search plans in given directory."""
+    # Outcome of a search depends on these, so they are part of the key.
+    parameters = {
+        "blast_databases": config.blast_databases,
+        "msa_minimum_sequence_count": config.msa_minimum_sequence_count,
+        "msa_minimum_coverage": config.msa_minimum_coverage,
+        "msa_maximum_sequences": config.msa_maximum_sequences,
+    }
+    if config.kmer_index_dir is not None and config.msa_prefilter_databases:
+        parameters["msa_prefilter_databases"] = config.msa_prefilter_databases
+    database_versions = get_database_versions(config)
+    if len(database_versions) > 0:
+        parameters["database_versions"] = database_versions
+
+    def plan_search(sequence: str, databases: typing.List[str]) -> typing.List[str]:
+        return search_plan.plan_search(plan_dir, sequence, databases, parameters)
+
+    def record_search(
+        sequence: str, failed: typing.List[str], durations: typing.Dict[str, float]
+    ):
+        search_plan.record_search(plan_dir, sequence, parameters, failed, durations)
+
+    return plan_search, record_search
+
+
+def _create_start_blastdbcmd(database_paths: typing.Dict[str, str]):
+    def start_blastdbcmd(sequence_file: str, database: str) -> subprocess.Popen:
+        cmd = "{} -db {} -entry_batch - > {}".format(
+            BLASTDBCMD_CMD, database_paths.get(database, database), sequence_file
+        )
+        logging.debug("Starting BLAST ...")
+        return subprocess.Popen(
+            cmd,
+            shell=True,
+            env=os.environ.copy(),
+            stdin=subprocess.PIPE,
+            universal_newlines=True,
+            start_new_session=True,
+        )
+
+    return start_blastdbcmd
+
+
 def _create_execute_cdhit(execute_command):
     def execute_cdhit(input_file: str, output_file: str, log_file: str):
         cmd = "{} -i {} -o {} > {}".format(CDHIT_CMD, input_file, output_file, log_file)
@@ -165,48 +658,61 @@ def _create_execute_cdhit(execute_command):
 
 
 def _create_execute_muscle(execute_command):
-    def execute_muscle(input_file: str, output_file: str):
-        cmd = "cat {} | {} -quiet > {}".format(input_file, MUSCLE_CMD, output_file)
+    def execute_muscle(
+        input_file: str,
+        output_file: str,
+        strategy: typing.Optional[msa.AlignmentStrategy] = None,
+    ):
+        options = "" if strategy is None else _muscle_options(strategy)
+        cmd = "cat {} | {} -quiet{} > {}".format(
+            input_file, MUSCLE_CMD, options, output_file
+        )
         logging.info("Executing muscle ...")
-        execute_command(cmd)
+        if strategy is None or strategy.time_budget <= 0:
+            execute_command(cmd)
+            return
+        cancel = threading.Event()
+        timer = threading.Timer(strategy.time_budget, cancel.set)
+        timer.start()
+        try:
+            execute_cancellable_command(cmd, cancel)
+        except msa.SearchCancelled:
+            raise msa.AlignmentTimeout()
+        finally:
+            timer.cancel()
 
     return execute_muscle
 
 
-def compute_jensen_shannon_divergence(
-    input_file: str, output_file: str, config: ConservationConfiguration
-) -> str:
-    """Input sequence must be on the first position."""
-    sanitized_input_file = input_file + ".sanitized"
-    _sanitize_jensen_shannon_divergence_input(input_file, sanitized_input_file)
-    cmd = "cd {} && python2 score_conservation.py {} > {}".format(
-        JENSE_SHANNON_DIVERGANCE_DIR,
-        os.path.abspath(sanitized_input_file),
-        os.path.abspath(output_file),
-    )
-    logging.info("Executing Jense Shannon Divergence script ...")
-    logging.debug("Executing command:\n%s", cmd)
-    config.execute_command(cmd)
-    return output_file
+def _muscle_options(strategy: msa.AlignmentStrategy) -> str:
+    result = f" -maxiters {strategy.iterations}"
+    if strategy.iterations == 1:
+        # Faster distance and diagonal optimization as recommended
+        # for large alignments by MUSCLE documentation.
+        result += " -diags -sv -distance1 kbit20_3"
+    elif strategy.time_budget > 0:
+        # Let MUSCLE stop the refinement on its own and keep the alignment,
+        # the hard limit is applied only when this does not work.
+        result += " -maxhours {:.6f}".format(0.75 * strategy.time_budget / 3600)
+    return result
 
 
-def _sanitize_jensen_shannon_divergence_input(input_file: str, output_file: str):
-    """Chain names such as '>pdb|2SRC|Chain A' lead to
+def align_to_profile(
+    msa_file: str, input_file: str, output_file: str, config: ConservationConfiguration
+) -> None:
+    """Add sequences from the input file to the existing MSA."""
+    cmd = "{} -quiet -profile -in1 {} -in2 {} -out {}".format(
+        MUSCLE_CMD, msa_file, input_file, output_file
+    )
+    logging.info("Executing muscle profile alignment ...")
+    _limit_concurrency(config.execute_command, config.tools_limit)(cmd)
 
-    File "score_conservation.py", line 599, in load_sequence_weights
-    seq_weights.append(float(l[1]))
-    ValueError: could not convert string to float: A
 
-    As output of the jensen_shannon_divergence does not use the names,
-    we replace all spaces with '_' in chain names.
-    """
-    with open(input_file, "r") as in_stream, open(
-        output_file, "w", newline=""
-    ) as out_stream:
-        for line in in_stream:
-            if line.startswith(">"):
-                line = line.replace(" ", "_")
-            out_stream.write(line)
+def compute_jensen_shannon_divergence(input_file: str, output_file: str) -> str:
+    """Input sequence must be on the first position."""
+    logging.info("Computing Jensen Shannon Divergence ...")
+    jensen_shannon_divergence.compute_jensen_shannon_divergence(input_file, output_file)
+    return output_file
 
 
 if __name__ == "__main__":
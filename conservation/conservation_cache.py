@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Persistent content-addressed store of computed conservations.
+#
+# The cache is shared by all tasks, an entry is identified by hash of the
+# sequence, used databases and conservation parameters. Entries are
+# written into a temporary directory and renamed into place, so readers
+# never see partially written entries. The total size of the cache is
+# bounded, least recently used entries are evicted first. Eviction also
+# removes index lines of evicted entries and temporary directories left
+# by crashed writers.
+#
+# Entries can be indexed by MinHash bands of their sequence, so entries
+# for near-identical sequences can be found, see find_similar.
+#
+# Layout:
+#   {cache}/entries/{key[:2]}/{key}/conservation.score
+#   {cache}/entries/{key[:2]}/{key}/msa.fasta
+#   {cache}/entries/{key[:2]}/{key}/info.json
+#   {cache}/entries/{key[:2]}/{key}/sequence.fasta
+#   {cache}/similar/{band[:2]}/{band}
+#   {cache}/tmp/
+#
+
+import os
+import typing
+import logging
+import hashlib
+import json
+import shutil
+import time
+import uuid
+
+import conservation
+import fasta
+import sequence_signature
+
+# Directory with the cache, when not set the cache is not used.
+CONSERVATION_CACHE_DIR = os.environ.get("CONSERVATION_CACHE_DIR", None)
+
+# Maximum size of the cache in bytes.
+CONSERVATION_CACHE_SIZE = int(
+    os.environ.get("CONSERVATION_CACHE_SIZE", str(16 * 1024 * 1024 * 1024))
+)
+
+# Temporary directories older than this many seconds are left by crashed
+# writers and are removed during eviction.
+CONSERVATION_CACHE_TEMPORARY_AGE = int(
+    os.environ.get("CONSERVATION_CACHE_TEMPORARY_AGE", str(24 * 3600))
+)
+
+# Change to invalidate all existing entries.
+CACHE_VERSION = 1
+
+SCORE_FILE = "conservation.score"
+
+MSA_FILE = "msa.fasta"
+
+INFO_FILE = "info.json"
+
+SEQUENCE_FILE = "sequence.fasta"
+
+
+def create_key(
+    sequence: str,
+    config: conservation.ConservationConfiguration,
+    variant: typing.Optional[typing.Dict] = None,
+) -> str:
+    """
+    Return cache key for given sequence and configuration. Entries not
+    computed by the pipeline must use a variant, so they are never used
+    as a computed conservation.
+    """
+    content = create_key_content(config)
+    if variant is not None:
+        content["variant"] = variant
+    content["sequence"] = hashlib.sha256(sequence.upper().encode("ascii")).hexdigest()
+    serialized = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def create_key_content(config: conservation.ConservationConfiguration) -> typing.Dict:
+    """
+    Return all key components but the sequence, they describe options and
+    databases the conservation is computed with.
+    """
+    content = {
+        "version": CACHE_VERSION,
+        "databases": config.blast_databases,
+        "msa_minimum_sequence_count": config.msa_minimum_sequence_count,
+        "msa_minimum_coverage": config.msa_minimum_coverage,
+        "msa_maximum_sequences": config.msa_maximum_sequences,
+    }
+    if config.msa_adaptive_alignment:
+        content["msa_adaptive_alignment"] = True
+        content["msa_alignment_time_budget"] = config.msa_alignment_time_budget
+    if config.msa_trim_hits:
+        content["msa_trim_flank"] = config.msa_trim_flank
+    if config.kmer_index_dir is not None and config.msa_prefilter_databases:
+        content["msa_prefilter_databases"] = config.msa_prefilter_databases
+    database_versions = conservation.get_database_versions(config)
+    if len(database_versions) > 0:
+        content["database_versions"] = database_versions
+    return content
+
+
+def contains(cache_dir: str, key: str) -> bool:
+    return os.path.exists(_entry_directory(cache_dir, key))
+
+
+def load(
+    cache_dir: str, key: str, score_file: str, msa_file: typing.Optional[str]
+) -> bool:
+    """Copy cached files to given locations, return False on cache miss."""
+    entry_dir = _entry_directory(cache_dir, key)
+    if not os.path.exists(entry_dir):
+        return False
+    try:
+        shutil.copy(os.path.join(entry_dir, SCORE_FILE), score_file)
+        if msa_file is not None:
+            shutil.copy(os.path.join(entry_dir, MSA_FILE), msa_file)
+        # Mark as recently used.
+        os.utime(entry_dir)
+    except FileNotFoundError:
+        # The entry was evicted while we were reading it.
+        logging.info("Cache entry '%s' was evicted during load.", key)
+        return False
+    logging.info("Using cached conservation '%s'.", key)
+    return True
+
+
+def store(
+    cache_dir: str, key: str, score_file: str, msa_file: str, size_limit: int
+) -> None:
+    """Add the files to the cache and evict old entries if needed."""
+    entry_dir = _entry_directory(cache_dir, key)
+    if os.path.exists(entry_dir):
+        return
+    temp_dir = _create_temporary_directory(cache_dir)
+    shutil.copy(score_file, os.path.join(temp_dir, SCORE_FILE))
+    shutil.copy(msa_file, os.path.join(temp_dir, MSA_FILE))
+    with open(os.path.join(temp_dir, INFO_FILE), "w", encoding="utf-8") as stream:
+        json.dump({"key": key, "version": CACHE_VERSION}, stream)
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+    try:
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        # Another task stored the same entry in the meantime.
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return
+    logging.info("Conservation stored in cache as '%s'.", key)
+    evict(cache_dir, size_limit)
+
+
+def add_sequence(
+    cache_dir: str,
+    key: str,
+    sequence: str,
+    config: conservation.ConservationConfiguration,
+) -> None:
+    """Store sequence of the entry and index the entry by the sequence."""
+    entry_dir = _entry_directory(cache_dir, key)
+    sequence_file = os.path.join(entry_dir, SEQUENCE_FILE)
+    if not os.path.exists(entry_dir) or os.path.exists(sequence_file):
+        return
+    temp_dir = _create_temporary_directory(cache_dir)
+    temp_file = os.path.join(temp_dir, SEQUENCE_FILE)
+    fasta.save_sequence_to_fasta(key, sequence, temp_file)
+    try:
+        os.replace(temp_file, sequence_file)
+    except FileNotFoundError:
+        # The entry was evicted in the meantime.
+        return
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    for band_key in _similarity_keys(sequence, config):
+        index_file = _similarity_index_file(cache_dir, band_key)
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        # Short appends are atomic, so the file can be shared by processes.
+        with open(index_file, "a") as stream:
+            stream.write(key + "\n")
+
+
+def find_similar(
+    cache_dir: str, sequence: str, config: conservation.ConservationConfiguration
+) -> typing.List[typing.Tuple[str, str]]:
+    """
+    Return key and sequence of entries with sequences similar to given
+    sequence. Entries sharing more signature bands are first.
+    """
+    counts = {}
+    for band_key in _similarity_keys(sequence, config):
+        try:
+            with open(_similarity_index_file(cache_dir, band_key)) as stream:
+                keys = {line.strip() for line in stream if len(line.strip()) > 0}
+        except FileNotFoundError:
+            continue
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+    result = []
+    for key in sorted(counts.keys(), key=lambda item: -counts[item]):
+        sequence_file = os.path.join(_entry_directory(cache_dir, key), SEQUENCE_FILE)
+        try:
+            result.append((key, fasta.read_fasta_file(sequence_file)[0][1]))
+        except FileNotFoundError:
+            # Evicted before the index was pruned.
+            continue
+    return result
+
+
+def _similarity_keys(
+    sequence: str, config: conservation.ConservationConfiguration
+) -> typing.List[str]:
+    # Only entries computed with the same parameters are similar.
+    namespace = json.dumps(create_key_content(config), sort_keys=True)
+    return sequence_signature.compute_band_keys(sequence, namespace)
+
+
+def _similarity_index_file(cache_dir: str, band_key: str) -> str:
+    return os.path.join(cache_dir, "similar", band_key[:2], band_key)
+
+
+def _entry_directory(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, "entries", key[:2], key)
+
+
+def _create_temporary_directory(cache_dir: str) -> str:
+    result = os.path.join(cache_dir, "tmp", str(uuid.uuid4()))
+    os.makedirs(result)
+    return result
+
+
+def evict(cache_dir: str, size_limit: int) -> None:
+    """Remove least recently used entries till the cache fits into the limit."""
+    _remove_stale_temporary_directories(cache_dir)
+    entries = _list_entries(cache_dir)
+    total_size = sum(size for _, _, size in entries)
+    if total_size <= size_limit:
+        return
+    # Oldest first.
+    entries.sort(key=lambda item: item[1])
+    for entry_dir, _, size in entries:
+        if total_size <= size_limit:
+            break
+        _remove_entry(cache_dir, entry_dir)
+        total_size -= size
+    _prune_similarity_index(cache_dir)
+    logging.info("Conservation cache size after eviction: %s", total_size)
+
+
+def _remove_stale_temporary_directories(cache_dir: str) -> None:
+    temp_root = os.path.join(cache_dir, "tmp")
+    if not os.path.exists(temp_root):
+        return
+    threshold = time.time() - CONSERVATION_CACHE_TEMPORARY_AGE
+    for name in os.listdir(temp_root):
+        path = os.path.join(temp_root, name)
+        try:
+            if os.stat(path).st_mtime > threshold:
+                continue
+        except FileNotFoundError:
+            continue
+        logging.info("Removing stale temporary directory '%s'.", name)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _prune_similarity_index(cache_dir: str) -> None:
+    """Remove index lines of keys without an entry."""
+    similar_root = os.path.join(cache_dir, "similar")
+    if not os.path.exists(similar_root):
+        return
+    for prefix in os.listdir(similar_root):
+        prefix_dir = os.path.join(similar_root, prefix)
+        for band_key in os.listdir(prefix_dir):
+            index_file = os.path.join(prefix_dir, band_key)
+            try:
+                with open(index_file) as stream:
+                    keys = [line.strip() for line in stream]
+            except FileNotFoundError:
+                continue
+            keys = [key for key in keys if len(key) > 0]
+            alive = [key for key in keys if contains(cache_dir, key)]
+            if len(alive) == len(keys):
+                continue
+            if len(alive) == 0:
+                _remove_file(index_file)
+                continue
+            # A key appended while we rewrite the file can be lost, so the
+            # entry is not found by find_similar. It is still a valid entry.
+            temp_dir = _create_temporary_directory(cache_dir)
+            temp_file = os.path.join(temp_dir, band_key)
+            with open(temp_file, "w") as stream:
+                stream.write("".join(key + "\n" for key in alive))
+            os.replace(temp_file, index_file)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _list_entries(cache_dir: str) -> typing.List[typing.Tuple[str, float, int]]:
+    """Return path, last access time and size for every entry."""
+    result = []
+    entries_root = os.path.join(cache_dir, "entries")
+    if not os.path.exists(entries_root):
+        return result
+    for prefix in os.listdir(entries_root):
+        prefix_dir = os.path.join(entries_root, prefix)
+        for key in os.listdir(prefix_dir):
+            entry_dir = os.path.join(prefix_dir, key)
+            try:
+                last_access = os.stat(entry_dir).st_mtime
+                size = sum(
+                    os.path.getsize(os.path.join(entry_dir, name))
+                    for name in os.listdir(entry_dir)
+                )
+            except FileNotFoundError:
+                # Removed by another task.
+                continue
+            result.append((entry_dir, last_access, size))
+    return result
+
+
+def _remove_entry(cache_dir: str, entry_dir: str) -> None:
+    # Move the entry out first, so no one can start reading it.
+    trash_dir = _create_temporary_directory(cache_dir)
+    try:
+        os.rename(entry_dir, os.path.join(trash_dir, "entry"))
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(trash_dir, ignore_errors=True)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Reuse conservation computed for near-identical sequences.
+#
+# When there is no cache entry for a sequence, we look for cache entries
+# of near-identical sequences, see conservation_cache.find_similar:
+#   * When the sequence is a substring of a cached sequence, and is long
+#     enough to satisfy the coverage threshold, the cached MSA columns and
+#     scores for the substring are used as they are.
+#   * Otherwise the sequence is added to the cached MSA using MUSCLE
+#     profile alignment. When identity and coverage of the sequence
+#     with the cached sequence in the alignment are above thresholds,
+#     the conservation is computed from the new MSA.
+#
+# The provenance is recorded as a comment in the header of the score
+# file, e.g.:
+#   # reused: {"method": "profile", "source": "{key}", ...}
+#
+# Reused conservation is cached under a key of its own, see
+# create_reused_key, so an exact cache hit is always a computed
+# conservation.
+#
+
+import os
+import typing
+import logging
+import json
+
+import numpy
+
+import conservation
+import conservation_cache
+import jensen_shannon_divergence
+import fasta
+
+# Set to "1" to reuse conservation of near-identical sequences.
+CONSERVATION_REUSE = os.environ.get("CONSERVATION_REUSE", "0") == "1"
+
+# Minimum identity, in percent, with the cached sequence.
+CONSERVATION_REUSE_IDENTITY = float(os.environ.get("CONSERVATION_REUSE_IDENTITY", "95"))
+
+# Minimum coverage, in percent, of the sequence and of the cached sequence,
+# so a fragment does not use conservation computed for a longer sequence.
+CONSERVATION_REUSE_COVERAGE = float(os.environ.get("CONSERVATION_REUSE_COVERAGE", "90"))
+
+# Maximum number of cached sequences we try to align to.
+MAXIMUM_CANDIDATES = 3
+
+QUERY_PREFIX = "reuse_query|"
+
+CACHED_PREFIX = "reuse_cached|"
+
+
+def create_reused_key(
+    sequence: str,
+    config: conservation.ConservationConfiguration,
+    minimum_identity: float = CONSERVATION_REUSE_IDENTITY,
+    minimum_coverage: float = CONSERVATION_REUSE_COVERAGE,
+) -> str:
+    """Return cache key for conservation reused for the sequence."""
+    return conservation_cache.create_key(
+        sequence, config, {"reused": [minimum_identity, minimum_coverage]}
+    )
+
+
+def reuse_conservation(
+    cache_dir: str,
+    input_file: str,
+    working_dir: str,
+    output_file: str,
+    config: conservation.ConservationConfiguration,
+    minimum_identity: float = CONSERVATION_REUSE_IDENTITY,
+    minimum_coverage: float = CONSERVATION_REUSE_COVERAGE,
+) -> typing.Optional[str]:
+    """
+    Compute conservation using cached near-identical sequence, return
+    path to utilized MSA file or None when there is no such sequence.
+    """
+    header, sequence = fasta.read_fasta_file(input_file)[0]
+    candidates = conservation_cache.find_similar(cache_dir, sequence, config)
+    # Projection is exact and cheap, so we prefer it.
+    candidates.sort(key=lambda item: sequence.upper() not in item[1].upper())
+    for key, cached_sequence in candidates[:MAXIMUM_CANDIDATES]:
+        cached_dir = os.path.join(working_dir, "reuse-" + key)
+        os.makedirs(cached_dir, exist_ok=True)
+        cached_score = os.path.join(cached_dir, conservation_cache.SCORE_FILE)
+        cached_msa = os.path.join(cached_dir, conservation_cache.MSA_FILE)
+        if not conservation_cache.load(cache_dir, key, cached_score, cached_msa):
+            continue
+        msa_file = os.path.join(working_dir, "msa")
+        # Write and rename, so existing output file is always complete.
+        temp_file = output_file + ".tmp"
+        if sequence.upper() in cached_sequence.upper():
+            coverage = 100.0 * len(sequence) / len(cached_sequence)
+            if coverage < minimum_coverage:
+                logging.info("Sequence has coverage %.1f with '%s'.", coverage, key)
+                continue
+            _project_conservation(
+                header, sequence, cached_msa, cached_score, msa_file, temp_file
+            )
+            provenance = {
+                "method": "projection",
+                "identity": 100.0,
+                "coverage": round(coverage, 2),
+            }
+        else:
+            identity, coverage = _align_to_cached_msa(
+                header, sequence, cached_msa, cached_dir, msa_file, config
+            )
+            logging.info(
+                "Sequence has identity %.1f and coverage %.1f with '%s'.",
+                identity,
+                coverage,
+                key,
+            )
+            if identity < minimum_identity or coverage < minimum_coverage:
+                continue
+            conservation.compute_jensen_shannon_divergence(msa_file, temp_file)
+            provenance = {
+                "method": "profile",
+                "identity": round(identity, 2),
+                "coverage": round(coverage, 2),
+            }
+        provenance["source"] = key
+        _add_provenance(temp_file, provenance)
+        os.replace(temp_file, output_file)
+        logging.info("Reused conservation: %s", provenance)
+        return msa_file
+    return None
+
+
+def _project_conservation(
+    header: str,
+    sequence: str,
+    cached_msa: str,
+    cached_score: str,
+    msa_file: str,
+    score_file: str,
+):
+    """Select MSA columns and scores for the sequence from cached files."""
+    records = fasta.read_fasta_file(cached_msa)
+    cached_row = records[0][1]
+    # Columns with residues of the cached sequence.
+    residue_columns = [
+        index for index, residue in enumerate(cached_row) if residue != "-"
+    ]
+    start = cached_row.replace("-", "").upper().index(sequence.upper())
+    first_column = residue_columns[start]
+    last_column = residue_columns[start + len(sequence) - 1] + 1
+    with open(msa_file, "w", newline="\n") as out_stream:
+        out_stream.write(
+            fasta.format_fasta_sequence(
+                header, cached_row[first_column:last_column], 60
+            )
+        )
+        for record_header, record_sequence in records[1:]:
+            out_stream.write(
+                fasta.format_fasta_sequence(
+                    record_header, record_sequence[first_column:last_column], 60
+                )
+            )
+    scores = _read_scores(cached_score)[first_column:last_column]
+    columns = jensen_shannon_divergence.read_msa_columns(msa_file)
+    jensen_shannon_divergence.write_scores(
+        msa_file, columns, numpy.array(scores), score_file
+    )
+
+
+def _read_scores(score_file: str) -> typing.List[float]:
+    result = []
+    with open(score_file) as stream:
+        for line in stream:
+            if line.startswith("#") or len(line.strip()) == 0:
+                continue
+            result.append(float(line.split("\t")[1]))
+    return result
+
+
+def _align_to_cached_msa(
+    header: str,
+    sequence: str,
+    cached_msa: str,
+    cached_dir: str,
+    msa_file: str,
+    config: conservation.ConservationConfiguration,
+) -> typing.Tuple[float, float]:
+    """
+    Add the sequence to the cached MSA, the sequence is put first.
+    Return identity and coverage with the cached sequence.
+    """
+    records = fasta.read_fasta_file(cached_msa)
+    profile_file = os.path.join(cached_dir, "profile-input")
+    with open(profile_file, "w", newline="\n") as out_stream:
+        # Mark the cached sequence, so we can find it in the output.
+        out_stream.write(
+            fasta.format_fasta_sequence(CACHED_PREFIX + records[0][0], records[0][1])
+        )
+        for record_header, record_sequence in records[1:]:
+            out_stream.write(
+                fasta.format_fasta_sequence(record_header, record_sequence)
+            )
+    query_file = os.path.join(cached_dir, "profile-query")
+    fasta.save_sequence_to_fasta(QUERY_PREFIX + header, sequence, query_file)
+    output_file = os.path.join(cached_dir, "profile-output")
+    conservation.align_to_profile(profile_file, query_file, output_file, config)
+    query_row = None
+    cached_row = None
+    others = []
+    for record_header, record_sequence in fasta.read_fasta(output_file):
+        if record_header.startswith(QUERY_PREFIX):
+            query_row = record_sequence
+        elif record_header.startswith(CACHED_PREFIX):
+            cached_row = record_sequence
+            others.insert(0, (record_header[len(CACHED_PREFIX) :], record_sequence))
+        else:
+            others.append((record_header, record_sequence))
+    if query_row is None or cached_row is None:
+        raise Exception("Missing sequences in " + output_file)
+    with open(msa_file, "w", newline="\n") as out_stream:
+        out_stream.write(fasta.format_fasta_sequence(header, query_row, 60))
+        for record_header, record_sequence in others:
+            out_stream.write(
+                fasta.format_fasta_sequence(record_header, record_sequence, 60)
+            )
+    return _compute_identity_and_coverage(query_row, cached_row)
+
+
+def _compute_identity_and_coverage(
+    query_row: str, cached_row: str
+) -> typing.Tuple[float, float]:
+    """
+    Identity over aligned residues, coverage of the longer of the query
+    and the cached sequence by aligned residues.
+    """
+    aligned = 0
+    identical = 0
+    for query_residue, cached_residue in zip(query_row.upper(), cached_row.upper()):
+        if query_residue == "-" or cached_residue == "-":
+            continue
+        aligned += 1
+        if query_residue == cached_residue:
+            identical += 1
+    length = max(
+        len(query_row) - query_row.count("-"), len(cached_row) - cached_row.count("-")
+    )
+    if aligned == 0:
+        return 0.0, 0.0
+    return 100.0 * identical / aligned, 100.0 * aligned / length
+
+
+def _add_provenance(score_file: str, provenance: typing.Dict):
+    """Add the provenance after the comments in the score file header."""
+    with open(score_file) as stream:
+        lines = stream.readlines()
+    position = 0
+    while position < len(lines) and lines[position].startswith("#"):
+        position += 1
+    lines.insert(position, "# reused: " + json.dumps(provenance) + "\n")
+    with open(score_file, "w", newline="\n") as stream:
+        stream.writelines(lines)
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Local service coalescing PSI-BLAST searches of concurrent tasks.
+#
+# Tasks running at the same time often search the same databases. The
+# service collects requests that arrive within a short window and search
+# for all their sequences using one multi-query PSI-BLAST execution per
+# database, see multiple_sequence_alignment.search_in_batch. Only the
+# search is shared, the rest of the conservation pipeline runs in the task.
+#
+# The service listens on a Unix socket, requests and responses are JSON
+# documents. A request carries the database paths resolved by the task,
+# so the service searches the same database versions the task uses for
+# retrieval and cache keys, also across a database swap. Only requests
+# with the same parameters and paths are coalesced, groups are searched
+# in parallel by a bounded pool. While a search runs, the service sends
+# heartbeat messages, so a client can tell a long search from a hung
+# service. PSI-BLAST results are kept in the service working directory,
+# the client copies them and closes the connection, then the service
+# removes them. The tasks must be able to read the service working
+# directory.
+#
+# Start the service:
+#   python3 conservation_service.py --socket {socket} --working {directory}
+#
+# Tasks use the service through compute_conservation when
+# CONSERVATION_SERVICE_SOCKET is set, when the service is not available
+# the conservation is computed in the task.
+#
+
+import os
+import typing
+import logging
+import argparse
+import subprocess
+import threading
+import queue
+import time
+import json
+import shutil
+import uuid
+import concurrent.futures
+import multiprocessing.connection
+
+import conservation
+import fasta
+
+# Path to the service socket, when not set the service is not used.
+CONSERVATION_SERVICE_SOCKET = os.environ.get("CONSERVATION_SERVICE_SOCKET", None)
+
+# Time in seconds the service waits for other requests before searching.
+CONSERVATION_SERVICE_WINDOW = float(
+    os.environ.get("CONSERVATION_SERVICE_WINDOW", "2.0")
+)
+
+# Maximum number of groups of requests searched at the same time.
+CONSERVATION_SERVICE_WORKERS = int(os.environ.get("CONSERVATION_SERVICE_WORKERS", "2"))
+
+# Time in seconds the client waits for a message from the service, when
+# there is none the search is executed in the task.
+CONSERVATION_SERVICE_TIMEOUT = float(
+    os.environ.get("CONSERVATION_SERVICE_TIMEOUT", "60")
+)
+
+# Time in seconds between heartbeat messages sent by the service.
+HEARTBEAT_INTERVAL = 10
+
+RESULTS_DIR = "results"
+
+# Keys required in the request configuration.
+CONFIGURATION_KEYS = [
+    "blast_databases",
+    "database_paths",
+    "msa_minimum_sequence_count",
+    "msa_minimum_coverage",
+]
+
+
+class ServiceRequest:
+    # Sequence to search for.
+    sequence: str
+    # Directory in the service working directory for PSI-BLAST results.
+    result_dir: str
+    # Search parameters and database paths, only requests with same
+    # parameters and paths share a search.
+    configuration: typing.Dict
+    # Set once the response is ready.
+    done: threading.Event
+    # Response for the client.
+    response: typing.Dict = None
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(
+        description="Serve PSI-BLAST searches for concurrent tasks."
+    )
+    parser.add_argument(
+        "--socket",
+        default=CONSERVATION_SERVICE_SOCKET,
+        help="Path to the Unix socket to listen on.",
+    )
+    parser.add_argument("--working", required=True, help="Working directory.")
+    parser.add_argument(
+        "--window",
+        default=CONSERVATION_SERVICE_WINDOW,
+        type=float,
+        help="Time in seconds to collect requests before searching.",
+    )
+    parser.add_argument(
+        "--workers",
+        default=CONSERVATION_SERVICE_WORKERS,
+        type=int,
+        help="Maximum number of concurrently searched groups of requests.",
+    )
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    _init_logging()
+    if arguments["socket"] is None:
+        raise Exception("Missing socket path.")
+    os.makedirs(arguments["working"], exist_ok=True)
+    serve(
+        arguments["socket"],
+        arguments["working"],
+        arguments["window"],
+        _execute_command,
+        arguments["workers"],
+    )
+
+
+def _init_logging() -> None:
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+    )
+
+
+def _execute_command(command: str):
+    result = subprocess.run(command, shell=True, env=os.environ.copy())
+    # Throw for non-zero (failure) return code.
+    result.check_returncode()
+
+
+# region Service
+
+
+def serve(
+    socket_path: str,
+    working_dir: str,
+    window: float,
+    execute_command: typing.Callable[[str], None],
+    workers: int = CONSERVATION_SERVICE_WORKERS,
+):
+    """Accept requests till the process is terminated."""
+    if os.path.exists(socket_path):
+        # Left over from previous run.
+        os.remove(socket_path)
+    with multiprocessing.connection.Listener(socket_path, family="AF_UNIX") as listener:
+        logging.info("Listening on '%s' ...", socket_path)
+        serve_listener(listener, working_dir, window, execute_command, workers)
+
+
+def serve_listener(
+    listener: multiprocessing.connection.Listener,
+    working_dir: str,
+    window: float,
+    execute_command: typing.Callable[[str], None],
+    workers: int = CONSERVATION_SERVICE_WORKERS,
+):
+    """Accept requests till the listener is closed."""
+    # Results left over from previous run.
+    shutil.rmtree(os.path.join(working_dir, RESULTS_DIR), ignore_errors=True)
+    requests = queue.Queue()
+    threading.Thread(
+        target=_process_requests,
+        args=(requests, working_dir, window, execute_command, workers),
+        daemon=True,
+    ).start()
+    while True:
+        try:
+            connection = listener.accept()
+        except OSError:
+            logging.info("Listener closed.")
+            return
+        threading.Thread(
+            target=_handle_connection,
+            args=(connection, requests, working_dir),
+            daemon=True,
+        ).start()
+
+
+def _handle_connection(connection, requests: queue.Queue, working_dir: str):
+    with connection:
+        try:
+            content = json.loads(connection.recv_bytes().decode("utf-8"))
+        except (EOFError, OSError, ValueError):
+            logging.exception("Can't read request.")
+            return
+        try:
+            request = _create_request(content, working_dir)
+        except (KeyError, TypeError, ValueError) as ex:
+            logging.warning("Invalid request: %s", repr(ex))
+            _send_message(connection, {"error": f"Invalid request: {repr(ex)}"})
+            return
+        requests.put(request)
+        connected = True
+        while connected and not request.done.wait(HEARTBEAT_INTERVAL):
+            connected = _send_message(connection, {"status": "running"})
+        request.done.wait()
+        if connected and _send_message(connection, request.response):
+            # The client closes the connection once it copied the results.
+            try:
+                connection.poll(CONSERVATION_SERVICE_TIMEOUT)
+            except OSError:
+                pass
+        shutil.rmtree(request.result_dir, ignore_errors=True)
+
+
+def _create_request(content: typing.Dict, working_dir: str) -> ServiceRequest:
+    """Create request from the content, raise an error for invalid content."""
+    sequence = content["sequence"]
+    if not isinstance(sequence, str) or not sequence.isalpha():
+        raise ValueError("Sequence must be a non-empty string of letters.")
+    configuration = content["configuration"]
+    for key in CONFIGURATION_KEYS:
+        if key not in configuration:
+            raise KeyError(key)
+    if not all(isinstance(name, str) for name in configuration["blast_databases"]):
+        raise ValueError("Database names must be strings.")
+    database_paths = configuration["database_paths"]
+    if not isinstance(database_paths, dict):
+        raise TypeError("Database paths must be an object.")
+    if not all(
+        isinstance(database_paths.get(name, None), str)
+        for name in configuration["blast_databases"]
+    ):
+        raise ValueError("Database paths must be strings given for all databases.")
+    result = ServiceRequest()
+    result.sequence = sequence
+    result.result_dir = os.path.join(working_dir, RESULTS_DIR, str(uuid.uuid4()))
+    result.configuration = {key: configuration[key] for key in CONFIGURATION_KEYS}
+    result.done = threading.Event()
+    return result
+
+
+def _send_message(connection, message: typing.Dict) -> bool:
+    """Return False when the client is disconnected."""
+    try:
+        connection.send_bytes(json.dumps(message).encode("utf-8"))
+        return True
+    except OSError:
+        logging.info("Client disconnected before receiving the response.")
+        return False
+
+
+def _process_requests(
+    requests: queue.Queue,
+    working_dir: str,
+    window: float,
+    execute_command: typing.Callable[[str], None],
+    workers: int,
+):
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+        while True:
+            batch = _collect_requests(requests, window)
+            groups = {}
+            for request in batch:
+                key = json.dumps(request.configuration, sort_keys=True)
+                groups.setdefault(key, []).append(request)
+            for group in groups.values():
+                executor.submit(_process_group, group, working_dir, execute_command)
+
+
+def _process_group(
+    group: typing.List[ServiceRequest],
+    working_dir: str,
+    execute_command: typing.Callable[[str], None],
+):
+    batch_dir = os.path.join(working_dir, str(uuid.uuid4()))
+    os.makedirs(batch_dir)
+    try:
+        _search_for_requests(group, batch_dir, execute_command)
+    except Exception as ex:
+        logging.exception("Search failed.")
+        for request in group:
+            request.response = {"error": str(ex)}
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        for request in group:
+            request.done.set()
+
+
+def _collect_requests(requests: queue.Queue, window: float) -> typing.List:
+    """Wait for a request and collect all requests in the window after it."""
+    result = [requests.get()]
+    deadline = time.monotonic() + window
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            result.append(requests.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return result
+
+
+def _search_for_requests(
+    requests: typing.List[ServiceRequest],
+    batch_dir: str,
+    execute_command: typing.Callable[[str], None],
+):
+    # Same sequences are searched only once.
+    sequence_to_query = {}
+    fasta_files = {}
+    for request in requests:
+        sequence = request.sequence.upper()
+        if sequence in sequence_to_query:
+            continue
+        query = f"query_{len(sequence_to_query)}"
+        sequence_to_query[sequence] = query
+        fasta_files[query] = os.path.join(batch_dir, query + ".fasta")
+        fasta.save_sequence_to_fasta(query, sequence, fasta_files[query])
+    logging.info(
+        "Searching for %s sequences from %s requests ...",
+        len(fasta_files),
+        len(requests),
+    )
+    config = _create_conservation_configuration(
+        requests[0].configuration, execute_command
+    )
+    psiblast_results = conservation.search_in_batch(fasta_files, batch_dir, config)
+    for request in requests:
+        query = sequence_to_query[request.sequence.upper()]
+        os.makedirs(request.result_dir)
+        result = {}
+        for database, psiblast_file in psiblast_results[query].items():
+            target_file = os.path.join(request.result_dir, f"psiblast-{database}")
+            shutil.copy(psiblast_file, target_file)
+            result[database] = target_file
+        request.response = {"psiblast_results": result}
+
+
+def _create_conservation_configuration(
+    configuration: typing.Dict, execute_command: typing.Callable[[str], None]
+) -> conservation.ConservationConfiguration:
+    result = conservation.ConservationConfiguration()
+    result.execute_command = execute_command
+    result.blast_databases = configuration["blast_databases"]
+    # Versions resolved by the task, the service never resolves databases.
+    result.database_paths = configuration["database_paths"]
+    result.msa_minimum_sequence_count = configuration["msa_minimum_sequence_count"]
+    result.msa_minimum_coverage = configuration["msa_minimum_coverage"]
+    return result
+
+
+# endregion
+
+# region Client
+
+
+def search(
+    input_file: str,
+    working_dir: str,
+    config: conservation.ConservationConfiguration,
+    socket_path: typing.Optional[str] = CONSERVATION_SERVICE_SOCKET,
+    timeout: float = CONSERVATION_SERVICE_TIMEOUT,
+) -> typing.Optional[typing.Dict[str, str]]:
+    """
+    Search for similar sequences using the service, return map of database
+    to PSI-BLAST output in the working directory or None when the service
+    is not available.
+    """
+    if socket_path is None or not os.path.exists(socket_path):
+        return None
+    sequences = fasta.read_fasta_file(input_file)
+    request = {
+        "sequence": sequences[0][1],
+        "configuration": {
+            "blast_databases": config.blast_databases,
+            "database_paths": conservation.resolve_databases(config),
+            "msa_minimum_sequence_count": config.msa_minimum_sequence_count,
+            "msa_minimum_coverage": config.msa_minimum_coverage,
+        },
+    }
+    logging.info("Searching using conservation service ...")
+    try:
+        with multiprocessing.connection.Client(
+            socket_path, family="AF_UNIX"
+        ) as connection:
+            connection.send_bytes(json.dumps(request).encode("utf-8"))
+            response = _receive_response(connection, timeout)
+            if response is None:
+                logging.warning("Conservation service is not responding.")
+                return None
+            if "error" in response:
+                logging.warning("Conservation service failed: %s", response["error"])
+                return None
+            # Copy before we close the connection, the service then
+            # removes the files.
+            result = {}
+            for database, psiblast_file in response["psiblast_results"].items():
+                target_file = os.path.join(working_dir, f"psiblast-service-{database}")
+                shutil.copy(psiblast_file, target_file)
+                result[database] = target_file
+            return result
+    except (EOFError, OSError):
+        logging.warning("Conservation service is not available.")
+        return None
+
+
+def _receive_response(connection, timeout: float) -> typing.Optional[typing.Dict]:
+    """Return the response, skip heartbeats, return None on timeout."""
+    while connection.poll(timeout):
+        message = json.loads(connection.recv_bytes().decode("utf-8"))
+        if message.get("status", None) == "running":
+            continue
+        return message
+    return None
+
+
+def compute_conservation(
+    input_file: str,
+    working_dir: str,
+    output_file: str,
+    config: conservation.ConservationConfiguration,
+) -> str:
+    """
+    Same as conservation.compute_conservation, but the search is done by
+    the service when available.
+    """
+    if config.psiblast_results is None:
+        config.psiblast_results = search(input_file, working_dir, config)
+    return conservation.compute_conservation(
+        input_file, working_dir, output_file, config
+    )
+
+
+# endregion
+
+if __name__ == "__main__":
+    main(_read_arguments())
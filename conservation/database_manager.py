@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Manage versions of BLAST databases.
+#
+# Each database version is built into its own directory and activated by
+# an atomic swap of a symbolic link, so running searches keep using files
+# of the version they have opened. The layout in BLASTDB is:
+#   {name}.pal                   : alias file pointing to {name}.current/{name}
+#   {name}.current               : symbolic link to versions/{name}/{version}
+#   versions/{name}/{version}/   : database files
+#   versions/{name}/{version}/sequence-store/ : sequence store, see sequence_store.py
+#   versions/{name}/{version}/kmer-index/     : k-mer index, see kmer_index.py
+#   manifest.json                : ready databases with current versions
+# Sequence stores and k-mer indexes are built into the version directory
+# before the version is activated, so they are swapped together with the
+# database files.
+# Tasks use only the ready databases from the manifest, they never build
+# a database. Long running processes reload the manifest when the file
+# is replaced, see load_manifest. Builds are executed by prepare_database.py,
+# possibly started in background using start_background_build.
+#
+# Example:
+#   python3 database_manager.py --status
+#
+
+import os
+import sys
+import typing
+import logging
+import argparse
+import json
+import time
+import uuid
+import shutil
+import fcntl
+import contextlib
+import subprocess
+
+import blast_database
+
+# Number of old versions kept for each database.
+BLASTDB_RETENTION = int(os.environ.get("BLASTDB_RETENTION", "1"))
+
+# Set to "0" to not start a background build for databases that are not ready.
+BLASTDB_BACKGROUND_BUILD = os.environ.get("BLASTDB_BACKGROUND_BUILD", "1") == "1"
+
+MANIFEST_FILE = "manifest.json"
+
+LOCK_FILE = "manager.lock"
+
+BUILD_LOG_FILE = "build.log"
+
+VERSIONS_DIR = "versions"
+
+VERSION_SEQUENCE_STORE_DIR = "sequence-store"
+
+VERSION_KMER_INDEX_DIR = "kmer-index"
+
+# Manifest loaded by this process.
+_manifest: typing.Optional[typing.Dict] = None
+
+# Identification of the file the manifest was loaded from.
+_manifest_stat: typing.Optional[typing.Tuple[int, int, int]] = None
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(description="Manage BLAST database versions.")
+    parser.add_argument(
+        "--status", action="store_true", help="Print the manifest and versions."
+    )
+    parser.add_argument(
+        "--activate",
+        nargs=2,
+        metavar=("DATABASE", "VERSION"),
+        help="Activate existing version of the database, e.g. to roll back.",
+    )
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+    )
+    if arguments["activate"] is not None:
+        name, version = arguments["activate"]
+        with _lock(blocking=True):
+            activate_version(name, version)
+    if arguments["status"]:
+        manifest = _load_manifest_file() or {}
+        manifest["versions"] = {
+            name: list_versions(name) for name in manifest.get("databases", {})
+        }
+        print(json.dumps(manifest, indent=2))
+
+
+# region Readiness
+
+
+def load_manifest() -> typing.Optional[typing.Dict]:
+    """Return manifest, it is read again only when the file was replaced."""
+    global _manifest, _manifest_stat
+    try:
+        stat = os.stat(_manifest_file())
+    except FileNotFoundError:
+        _manifest, _manifest_stat = None, None
+        return None
+    # The manifest is always replaced, so a new version has a new inode.
+    current = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if current != _manifest_stat:
+        _manifest, _manifest_stat = _load_manifest_file(), current
+    return _manifest
+
+
+def get_ready_databases(names: typing.List[str]) -> typing.List[str]:
+    """Return databases that are ready to be searched, keep the order."""
+    manifest = load_manifest()
+    if manifest is None:
+        # There are no versioned databases, check the files.
+        return [name for name in names if blast_database.is_database_available(name)]
+    return [name for name in names if name in manifest["databases"]]
+
+
+def select_databases(names: typing.List[str]) -> typing.List[str]:
+    """
+    Return ready databases, missing databases are skipped so the search
+    falls back to the remaining ones. Raise when no database is ready.
+    """
+    result = get_ready_databases(names)
+    missing = [name for name in names if name not in result]
+    if len(missing) > 0:
+        logging.warning("Databases are not ready, skipping: %s", missing)
+        if BLASTDB_BACKGROUND_BUILD:
+            start_background_build()
+    if len(result) == 0:
+        raise RuntimeError(f"No database is ready from: {names}")
+    return result
+
+
+def start_background_build():
+    """Start detached build of missing or changed databases."""
+    if is_build_running():
+        logging.info("Database build is already running.")
+        return
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "prepare_database.py"),
+    ]
+    logging.info("Starting database build in background.")
+    with open(os.path.join(blast_database.BLASTDB, BUILD_LOG_FILE), "a") as stream:
+        subprocess.Popen(
+            command,
+            stdout=stream,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            env=os.environ.copy(),
+            start_new_session=True,
+        )
+
+
+def is_build_running() -> bool:
+    try:
+        with _lock(blocking=False):
+            return False
+    except BlockingIOError:
+        return True
+
+
+# endregion
+
+# region Versions
+
+
+def build_versions(
+    execute_command: typing.Callable[[str], None],
+    names: typing.List[str],
+    prepare_version: typing.Optional[typing.Callable[[str, str], None]] = None,
+) -> typing.Dict[str, typing.Dict]:
+    """
+    Build new versions of the databases and activate them. Only one build
+    runs at a time, raise BlockingIOError when other build is running.
+    The prepare_version is called with database name and version directory
+    before the version is activated.
+    """
+    if len(names) == 0:
+        return {}
+    with _lock(blocking=False):
+        version = time.strftime("%Y%m%d-%H%M%S")
+        target_dirs = {name: _version_dir(name, version) for name in names}
+        report = blast_database.build_databases(execute_command, names, target_dirs)
+        if prepare_version is not None:
+            for name in names:
+                prepare_version(name, target_dirs[name])
+        for name in names:
+            activate_version(name, version)
+        return report
+
+
+def get_version_directory(name: str) -> typing.Optional[str]:
+    """Return directory of the current version, None for not versioned database."""
+    database = blast_database.resolve_database(name)
+    if blast_database.get_database_version(database) is None:
+        return None
+    return os.path.dirname(database)
+
+
+def activate_version(name: str, version: str):
+    """
+    Make the version current, update manifest and remove old versions.
+    Must be called with the lock held.
+    """
+    version_dir = _version_dir(name, version)
+    if not os.path.isdir(version_dir):
+        raise RuntimeError(f"Missing version '{version}' of '{name}'.")
+    # Create new link and rename it over the old one, so there is always
+    # a valid link.
+    link = os.path.join(blast_database.BLASTDB, name + blast_database.CURRENT_SUFFIX)
+    temp_link = f"{link}.{uuid.uuid4().hex}"
+    os.symlink(os.path.relpath(version_dir, blast_database.BLASTDB), temp_link)
+    os.replace(temp_link, link)
+    _prepare_alias_file(name)
+    manifest = _load_manifest_file() or _create_manifest()
+    manifest["databases"][name] = {
+        "version": version,
+        "source": blast_database.load_database_source(version_dir, name),
+        "activated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    blast_database._save_json(_manifest_file(), manifest)
+    logging.info("Activated version %s of %s.", version, name)
+    remove_old_versions(name, version)
+
+
+def _prepare_alias_file(name: str):
+    """Replace files of not versioned database with alias to current version."""
+    alias_file = os.path.join(blast_database.BLASTDB, name + ".pal")
+    if os.path.exists(alias_file):
+        with open(alias_file) as stream:
+            if name + blast_database.CURRENT_SUFFIX in stream.read():
+                return
+    # First activation, so we remove not versioned files.
+    blast_database._remove_database_files(blast_database.BLASTDB, name)
+    temp_file = alias_file + ".tmp"
+    with open(temp_file, "w") as stream:
+        stream.write(f"TITLE {name}\n")
+        stream.write(f"DBLIST {name}{blast_database.CURRENT_SUFFIX}/{name}\n")
+    os.replace(temp_file, alias_file)
+
+
+def list_versions(name: str) -> typing.List[str]:
+    """Return versions of the database, from the oldest one."""
+    directory = os.path.join(blast_database.BLASTDB, VERSIONS_DIR, name)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.listdir(directory))
+
+
+def remove_old_versions(name: str, current: str, retention: int = BLASTDB_RETENTION):
+    """
+    Keep given number of versions before the current one, newer versions
+    are kept as well. Searches using removed files are not interrupted,
+    as the files are deleted once closed.
+    """
+    versions = list_versions(name)
+    older = [version for version in versions if version < current]
+    for version in older[: max(0, len(older) - retention)]:
+        logging.info("Removing version %s of %s.", version, name)
+        shutil.rmtree(_version_dir(name, version))
+
+
+def _version_dir(name: str, version: str) -> str:
+    return os.path.join(blast_database.BLASTDB, VERSIONS_DIR, name, version)
+
+
+# endregion
+
+
+def _manifest_file() -> str:
+    return os.path.join(blast_database.BLASTDB, MANIFEST_FILE)
+
+
+def _load_manifest_file() -> typing.Optional[typing.Dict]:
+    return blast_database._load_json(_manifest_file())
+
+
+def _create_manifest() -> typing.Dict:
+    """Create manifest with databases that are not versioned yet."""
+    return {
+        "databases": {
+            name: {"version": None} for name in blast_database.get_available_databases()
+        }
+    }
+
+
+@contextlib.contextmanager
+def _lock(blocking: bool):
+    """Exclusive lock shared by all processes managing the databases."""
+    with open(os.path.join(blast_database.BLASTDB, LOCK_FILE), "w") as stream:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        fcntl.flock(stream, flags)
+        try:
+            yield
+        finally:
+            fcntl.flock(stream, fcntl.LOCK_UN)
+
+
+if __name__ == "__main__":
+    main(_read_arguments())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Streaming and indexed access to FASTA files.
+#
+
+import typing
+import collections
+
+# Position of a sequence in a FASTA file, offset and size are in bytes
+# and cover the sequence lines without the header.
+FastaIndexEntry = collections.namedtuple(
+    "FastaIndexEntry", ["header", "offset", "size"]
+)
+
+
+def read_fasta(input_file: str) -> typing.Iterator[typing.Tuple[str, str]]:
+    """Yield (header, sequence) for every record in the file."""
+    header = None
+    lines = []
+    with open(input_file) as in_stream:
+        for line in in_stream:
+            line = line.rstrip()
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(lines)
+                header = line[1:]
+                lines = []
+            else:
+                lines.append(line)
+    if header is not None:
+        yield header, "".join(lines)
+
+
+def read_fasta_stream(
+    in_stream: typing.BinaryIO,
+) -> typing.Iterator[typing.Tuple[str, str]]:
+    """Yield (header, sequence) for every record in a binary stream."""
+    header = None
+    lines = []
+    for line in in_stream:
+        line = line.rstrip()
+        if line.startswith(b">"):
+            if header is not None:
+                yield header, b"".join(lines).decode("ascii")
+            header = line[1:].decode("utf-8")
+            lines = []
+        else:
+            lines.append(line)
+    if header is not None:
+        yield header, b"".join(lines).decode("ascii")
+
+
+def read_fasta_file(input_file: str) -> typing.List[typing.Tuple[str, str]]:
+    """Return all (header, sequence) records in the file."""
+    return list(read_fasta(input_file))
+
+
+def count_sequences(input_file: str) -> int:
+    """Count records without parsing the sequences."""
+    result = 0
+    with open(input_file, "rb") as in_stream:
+        for line in in_stream:
+            if line.startswith(b">"):
+                result += 1
+    return result
+
+
+def build_index(input_file: str) -> typing.List[FastaIndexEntry]:
+    """Return position of every record in the file."""
+    result = []
+    header = None
+    offset = 0
+    position = 0
+    with open(input_file, "rb") as in_stream:
+        for line in in_stream:
+            if line.startswith(b">"):
+                if header is not None:
+                    result.append(FastaIndexEntry(header, offset, position - offset))
+                header = line[1:].rstrip().decode("utf-8")
+                offset = position + len(line)
+            position += len(line)
+    if header is not None:
+        result.append(FastaIndexEntry(header, offset, position - offset))
+    return result
+
+
+def read_indexed_sequence(in_stream: typing.BinaryIO, entry: FastaIndexEntry) -> str:
+    """Read sequence from a file opened in binary mode."""
+    in_stream.seek(entry.offset)
+    content = in_stream.read(entry.size).decode("utf-8")
+    return "".join(line.rstrip() for line in content.splitlines())
+
+
+def read_indexed_sequences(
+    input_file: str, entries: typing.Iterable[FastaIndexEntry]
+) -> typing.Iterator[typing.Tuple[str, str]]:
+    """Yield (header, sequence) for given entries."""
+    with open(input_file, "rb") as in_stream:
+        for entry in entries:
+            yield entry.header, read_indexed_sequence(in_stream, entry)
+
+
+def normalize_identifier(identifier: str) -> str:
+    """Return identifier as used in the FASTA header of the sequence."""
+    # PSI-BLAST may report local identifiers with a prefix.
+    if identifier.startswith("lcl|"):
+        return identifier[4:]
+    return identifier
+
+
+def save_sequence_to_fasta(header: str, sequence: str, output_file: str):
+    with open(output_file, "w") as out_stream:
+        out_stream.write(format_fasta_sequence(header, sequence))
+
+
+def format_fasta_sequence(header: str, sequence: str, line_width: int = 80):
+    lines = "\n".join(
+        [
+            sequence[index : index + line_width]
+            for index in range(0, len(sequence), line_width)
+        ]
+    )
+    return f">{header}\n{lines}\n"
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Packed store of HSSP conservation scores.
+#
+# The HSSP directory contains a gzipped score file for every chain,
+# {code}{chain}.hssp.fasta.scores.gz . The store packs the gzipped files
+# as they are into a single file, so each record stays compressed on its
+# own and can be read without the others. The index maps the record name,
+# {code}{chain}, to position of the record. All files are memory-mapped.
+#
+# Layout:
+#   {store}/records.bin
+#   {store}/names.npy     - sorted record names
+#   {store}/offsets.npy   - record offsets, in order of names
+#   {store}/sizes.npy     - record sizes, in order of names
+#
+# Pack the HSSP directory:
+#   python3 hssp_store.py --input /data/conservation/hssp/
+#
+
+import os
+import typing
+import logging
+import argparse
+import collections
+import mmap
+import shutil
+import uuid
+import zlib
+
+import numpy
+
+# Directory with the store, when not set the store is not used.
+HSSP_STORE_DIR = os.environ.get("HSSP_STORE_DIR", None)
+
+HSSP_FILE_SUFFIX = ".hssp.fasta.scores.gz"
+
+RECORDS_FILE = "records.bin"
+
+NAMES_FILE = "names.npy"
+
+OFFSETS_FILE = "offsets.npy"
+
+SIZES_FILE = "sizes.npy"
+
+DECOMPRESS_BLOCK_SIZE = 1024 * 1024
+
+HsspStore = collections.namedtuple(
+    "HsspStore", ["records", "names", "offsets", "sizes"]
+)
+
+# Opened stores, the memory maps are shared in a process.
+_stores: typing.Dict[str, HsspStore] = {}
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(description="Pack HSSP score files into a store.")
+    parser.add_argument(
+        "--input", required=True, help="Directory with HSSP score files."
+    )
+    parser.add_argument("--store", default=HSSP_STORE_DIR, help="Store directory.")
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+    )
+    if arguments["store"] is None:
+        raise Exception("Missing HSSP store directory.")
+    build_store(arguments["store"], arguments["input"])
+
+
+# region Build
+
+
+def build_store(store_dir: str, hssp_dir: str):
+    """Pack all score files from the directory, existing store is replaced."""
+    logging.info("Packing HSSP files from '%s' ...", hssp_dir)
+    names = sorted(
+        entry.name[: -len(HSSP_FILE_SUFFIX)]
+        for entry in os.scandir(hssp_dir)
+        if entry.name.endswith(HSSP_FILE_SUFFIX)
+    )
+    parent_dir = os.path.dirname(os.path.abspath(store_dir))
+    temp_dir = os.path.join(parent_dir, "tmp-" + str(uuid.uuid4()))
+    os.makedirs(temp_dir)
+    offsets = []
+    sizes = []
+    position = 0
+    with open(os.path.join(temp_dir, RECORDS_FILE), "wb") as out_stream:
+        for name in names:
+            with open(os.path.join(hssp_dir, name + HSSP_FILE_SUFFIX), "rb") as stream:
+                content = stream.read()
+            out_stream.write(content)
+            offsets.append(position)
+            sizes.append(len(content))
+            position += len(content)
+    numpy.save(os.path.join(temp_dir, NAMES_FILE), _encode_names(names))
+    numpy.save(
+        os.path.join(temp_dir, OFFSETS_FILE), numpy.array(offsets, dtype=numpy.uint64)
+    )
+    numpy.save(
+        os.path.join(temp_dir, SIZES_FILE), numpy.array(sizes, dtype=numpy.uint32)
+    )
+    # Replace the old store.
+    if os.path.exists(store_dir):
+        trash_dir = os.path.join(parent_dir, "tmp-" + str(uuid.uuid4()))
+        os.rename(store_dir, trash_dir)
+        shutil.rmtree(trash_dir)
+    os.rename(temp_dir, store_dir)
+    logging.info("HSSP store contains %s records.", len(names))
+
+
+def _encode_names(names: typing.List[str]) -> numpy.ndarray:
+    # Fixed width byte strings keep the order of ASCII names.
+    width = max([len(name) for name in names], default=1)
+    return numpy.array([name.encode("ascii") for name in names], dtype=f"S{width}")
+
+
+# endregion
+
+# region Retrieve
+
+
+def write_record(store_dir: str, code: str, chain: str, output_file: str) -> bool:
+    """
+    Decompress scores for the chain into the output file. Return False,
+    and write nothing, when the store or the record is not available.
+    """
+    store = open_store(store_dir)
+    if store is None:
+        return False
+    position = _find_record(store, code + chain)
+    if position is None:
+        return False
+    offset, size = position
+    records = memoryview(store.records)
+    # Decompress in blocks, so we never hold the whole record in memory.
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    with open(output_file, "wb") as out_stream:
+        for start in range(offset, offset + size, DECOMPRESS_BLOCK_SIZE):
+            end = min(start + DECOMPRESS_BLOCK_SIZE, offset + size)
+            out_stream.write(decompressor.decompress(records[start:end]))
+        out_stream.write(decompressor.flush())
+    records.release()
+    return True
+
+
+def open_store(store_dir: str) -> typing.Optional[HsspStore]:
+    if store_dir in _stores:
+        return _stores[store_dir]
+    if not os.path.exists(os.path.join(store_dir, SIZES_FILE)):
+        return None
+    with open(os.path.join(store_dir, RECORDS_FILE), "rb") as stream:
+        records = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    result = HsspStore(
+        records,
+        numpy.load(os.path.join(store_dir, NAMES_FILE), mmap_mode="r"),
+        numpy.load(os.path.join(store_dir, OFFSETS_FILE), mmap_mode="r"),
+        numpy.load(os.path.join(store_dir, SIZES_FILE), mmap_mode="r"),
+    )
+    _stores[store_dir] = result
+    return result
+
+
+def _find_record(
+    store: HsspStore, name: str
+) -> typing.Optional[typing.Tuple[int, int]]:
+    key = name.encode("ascii")
+    index = int(numpy.searchsorted(store.names, key))
+    if index == len(store.names) or store.names[index] != key:
+        logging.info("Missing '%s' in the HSSP store.", name)
+        return None
+    return int(store.offsets[index]), int(store.sizes[index])
+
+
+# endregion
+
+if __name__ == "__main__":
+    main(_read_arguments())
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# K-mer index of database sequences used to prefilter PSI-BLAST searches.
+#
+# For every k-mer the index holds sorted numbers of sequences containing
+# it (postings). Candidates for a query are sequences sharing the most
+# k-mers with the query, PSI-BLAST then searches only a small database
+# created from the candidates, see multiple_sequence_alignment
+# _execute_prefiltered_psiblast. All files are memory-mapped.
+#
+# Layout:
+#   {index}/{database}/info.json
+#   {index}/{database}/offsets.npy            - postings start for k-mers
+#   {index}/{database}/postings.npy           - sequence numbers
+#   {index}/{database}/identifiers.txt        - sequence identifiers
+#   {index}/{database}/identifier_offsets.npy - identifier positions
+#
+# Build the index from existing BLAST database:
+#   python3 kmer_index.py --database swissprot
+#
+
+import os
+import typing
+import logging
+import argparse
+import subprocess
+import collections
+import array
+import shutil
+import json
+import gzip
+import mmap
+import uuid
+
+import numpy
+
+import fasta
+
+BLASTDBCMD_CMD = os.environ.get("BLASTDBCMD_CMD", None)
+
+# Directory with the indexes, when not set the prefilter is not used.
+# Versioned databases use indexes in their version directory, see
+# database_manager, for them the directory only enables the prefilter.
+KMER_INDEX_DIR = os.environ.get("KMER_INDEX_DIR", None)
+
+# Comma separated list of databases to build the index for.
+KMER_INDEX_DATABASES = os.environ.get("KMER_INDEX_DATABASES", "swissprot,uniref50")
+
+# Maximum number of candidates for a query.
+KMER_INDEX_MAXIMUM_CANDIDATES = int(
+    os.environ.get("KMER_INDEX_MAXIMUM_CANDIDATES", "5000")
+)
+
+KMER_SIZE = 4
+
+ALPHABET = "ACDEFGHIKLMNPQRSTVWY"
+
+# Candidates must share at least this number of k-mers with the query.
+MINIMUM_SHARED_KMERS = 2
+
+# K-mers in larger fraction of sequences carry no information,
+# they are ignored for queries.
+MAXIMUM_KMER_FREQUENCY = 0.05
+
+# Number of residues processed at once during build.
+BUILD_CHUNK_RESIDUES = 16 * 1024 * 1024
+
+INFO_FILE = "info.json"
+
+OFFSETS_FILE = "offsets.npy"
+
+POSTINGS_FILE = "postings.npy"
+
+IDENTIFIERS_FILE = "identifiers.txt"
+
+IDENTIFIER_OFFSETS_FILE = "identifier_offsets.npy"
+
+KmerIndex = collections.namedtuple(
+    "KmerIndex",
+    ["kmer_size", "offsets", "postings", "identifiers", "identifier_offsets"],
+)
+
+# Opened indexes, the memory maps are shared by all searches in a process.
+_indexes: typing.Dict[str, KmerIndex] = {}
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(
+        description="Build k-mer index for a BLAST database."
+    )
+    parser.add_argument("--database", required=True, help="Database name.")
+    parser.add_argument(
+        "--input",
+        help="FASTA file, can be gzipped. When not set the content "
+        "is read from the BLAST database using blastdbcmd.",
+    )
+    parser.add_argument("--index", default=KMER_INDEX_DIR, help="Index directory.")
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+    )
+    if arguments["index"] is None:
+        raise Exception("Missing index directory.")
+    if arguments["input"] is not None:
+        build_index_from_file(
+            arguments["index"], arguments["database"], arguments["input"]
+        )
+    else:
+        build_index_from_database(arguments["index"], arguments["database"])
+
+
+# region Build
+
+
+def build_index_from_database(
+    index_dir: str, database: str, source: typing.Optional[str] = None
+):
+    """
+    Build the index using all sequences in the BLAST database, the source
+    is path to the BLAST database when it is not the database name.
+    """
+    command = [BLASTDBCMD_CMD, "-db", source or database, "-entry", "all"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, env=os.environ.copy())
+    try:
+        build_index(index_dir, database, process.stdout)
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        shutil.rmtree(_index_directory(index_dir, database), ignore_errors=True)
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def build_index_from_file(index_dir: str, database: str, input_file: str):
+    if input_file.endswith(".gz"):
+        with gzip.open(input_file, "rb") as in_stream:
+            build_index(index_dir, database, in_stream)
+    else:
+        with open(input_file, "rb") as in_stream:
+            build_index(index_dir, database, in_stream)
+
+
+def build_index(index_dir: str, database: str, in_stream: typing.BinaryIO):
+    """Build the index from FASTA content, existing index is replaced."""
+    logging.info("Building k-mer index for '%s' ...", database)
+    temp_dir = os.path.join(index_dir, "tmp-" + str(uuid.uuid4()))
+    os.makedirs(temp_dir)
+    # Sorted (k-mer, sequence) pairs for each chunk of sequences.
+    chunk_files = []
+    # Offsets are written to disk with each chunk, as there can be
+    # hundreds of millions of sequences.
+    identifier_offsets = array.array("Q", [0])
+    identifier_position = 0
+    offsets_file = os.path.join(temp_dir, IDENTIFIER_OFFSETS_FILE + ".raw")
+    sequence_count = 0
+    chunk = []
+    chunk_size = 0
+    with open(os.path.join(temp_dir, IDENTIFIERS_FILE), "wb") as out_stream, open(
+        offsets_file, "wb"
+    ) as offsets_stream:
+        for header, sequence in fasta.read_fasta_stream(in_stream):
+            identifier = header.split(maxsplit=1)[0].encode("utf-8") + b"\n"
+            out_stream.write(identifier)
+            identifier_position += len(identifier)
+            identifier_offsets.append(identifier_position)
+            chunk.append(sequence)
+            chunk_size += len(sequence)
+            if chunk_size >= BUILD_CHUNK_RESIDUES:
+                chunk_files.append(
+                    _save_chunk(temp_dir, chunk, sequence_count, len(chunk_files))
+                )
+                sequence_count += len(chunk)
+                chunk = []
+                chunk_size = 0
+                identifier_offsets.tofile(offsets_stream)
+                del identifier_offsets[:]
+        identifier_offsets.tofile(offsets_stream)
+    if len(chunk) > 0:
+        chunk_files.append(
+            _save_chunk(temp_dir, chunk, sequence_count, len(chunk_files))
+        )
+        sequence_count += len(chunk)
+    numpy.save(
+        os.path.join(temp_dir, IDENTIFIER_OFFSETS_FILE),
+        numpy.fromfile(offsets_file, dtype=numpy.uint64),
+    )
+    os.remove(offsets_file)
+    _merge_chunks(temp_dir, chunk_files)
+    with open(os.path.join(temp_dir, INFO_FILE), "w", encoding="utf-8") as stream:
+        json.dump({"kmer_size": KMER_SIZE, "sequences": sequence_count}, stream)
+    # Replace the old index.
+    target_dir = _index_directory(index_dir, database)
+    if os.path.exists(target_dir):
+        trash_dir = os.path.join(index_dir, "tmp-" + str(uuid.uuid4()))
+        os.rename(target_dir, trash_dir)
+        shutil.rmtree(trash_dir)
+    os.rename(temp_dir, target_dir)
+    logging.info("K-mer index contains %s sequences.", sequence_count)
+
+
+def _save_chunk(
+    temp_dir: str, sequences: typing.List[str], first_sequence: int, index: int
+) -> str:
+    """Save sorted unique pairs of k-mer and sequence number."""
+    # Sequences are separated by an invalid residue, so no k-mer spans two.
+    content = numpy.frombuffer(
+        ("*".join(sequences) + "*").upper().encode("ascii"), dtype=numpy.uint8
+    )
+    codes = _encode_kmers(content)
+    lengths = numpy.array([len(sequence) + 1 for sequence in sequences])
+    sequence_numbers = numpy.repeat(
+        numpy.arange(
+            first_sequence, first_sequence + len(sequences), dtype=numpy.uint64
+        ),
+        lengths,
+    )[: len(codes)]
+    valid = codes >= 0
+    pairs = (codes[valid].astype(numpy.uint64) << numpy.uint64(32)) | sequence_numbers[
+        valid
+    ]
+    output_file = os.path.join(temp_dir, f"chunk-{index}.npy")
+    numpy.save(output_file, numpy.unique(pairs))
+    return output_file
+
+
+def _merge_chunks(temp_dir: str, chunk_files: typing.List[str]):
+    """Create offsets and postings from the chunks."""
+    kmer_count = len(ALPHABET) ** KMER_SIZE
+    counts = numpy.zeros(kmer_count, dtype=numpy.uint64)
+    for chunk_file in chunk_files:
+        kmers = (numpy.load(chunk_file, mmap_mode="r") >> numpy.uint64(32)).astype(
+            numpy.int64
+        )
+        counts += numpy.bincount(kmers, minlength=kmer_count).astype(numpy.uint64)
+    offsets = numpy.zeros(kmer_count + 1, dtype=numpy.uint64)
+    numpy.cumsum(counts, out=offsets[1:])
+    numpy.save(os.path.join(temp_dir, OFFSETS_FILE), offsets)
+    postings = numpy.lib.format.open_memmap(
+        os.path.join(temp_dir, POSTINGS_FILE),
+        mode="w+",
+        dtype=numpy.uint32,
+        shape=(int(offsets[-1]),),
+    )
+    # Chunks are in order of sequences, so postings are sorted.
+    cursor = offsets[:-1].copy()
+    for chunk_file in chunk_files:
+        pairs = numpy.load(chunk_file)
+        kmers = (pairs >> numpy.uint64(32)).astype(numpy.int64)
+        first = numpy.searchsorted(kmers, kmers, side="left")
+        rank = numpy.arange(len(kmers), dtype=numpy.uint64) - first.astype(numpy.uint64)
+        postings[cursor[kmers] + rank] = (pairs & numpy.uint64(0xFFFFFFFF)).astype(
+            numpy.uint32
+        )
+        cursor += numpy.bincount(kmers, minlength=kmer_count).astype(numpy.uint64)
+        os.remove(chunk_file)
+    postings.flush()
+    del postings
+
+
+# endregion
+
+# region Query
+
+
+def find_candidates(
+    index_dir: str,
+    database: str,
+    sequence: str,
+    maximum_candidates: int = KMER_INDEX_MAXIMUM_CANDIDATES,
+) -> typing.Optional[typing.List[str]]:
+    """
+    Return identifiers of sequences sharing most k-mers with the sequence,
+    None when there is no index for the database.
+    """
+    index = open_index(index_dir, database)
+    if index is None:
+        return None
+    content = numpy.frombuffer(sequence.upper().encode("ascii"), dtype=numpy.uint8)
+    codes = numpy.unique(_encode_kmers(content))
+    codes = codes[codes >= 0]
+    sequence_count = len(index.identifier_offsets) - 1
+    maximum_postings = max(1, int(MAXIMUM_KMER_FREQUENCY * sequence_count))
+    postings = []
+    for code in codes:
+        start, end = int(index.offsets[code]), int(index.offsets[code + 1])
+        if 0 < end - start <= maximum_postings:
+            postings.append(index.postings[start:end])
+    if len(postings) == 0:
+        return []
+    numbers, shared = numpy.unique(numpy.concatenate(postings), return_counts=True)
+    selected = shared >= MINIMUM_SHARED_KMERS
+    numbers, shared = numbers[selected], shared[selected]
+    if len(numbers) > maximum_candidates:
+        best = numpy.argpartition(-shared, maximum_candidates - 1)
+        numbers = numbers[best[:maximum_candidates]]
+    logging.info("Prefilter selected %s candidates.", len(numbers))
+    return [_read_identifier(index, int(number)) for number in numbers]
+
+
+def write_candidates(
+    index_dir: str, database: str, input_file: str, output_file: str
+) -> bool:
+    """
+    Write identifiers of candidates for sequence in the input file to
+    the output file. Return False when there is no index for the database.
+    """
+    sequence = fasta.read_fasta_file(input_file)[0][1]
+    candidates = find_candidates(index_dir, database, sequence)
+    if candidates is None:
+        return False
+    with open(output_file, "w") as out_stream:
+        for identifier in candidates:
+            out_stream.write(identifier)
+            out_stream.write("\n")
+    return True
+
+
+def open_index(index_dir: str, database: str) -> typing.Optional[KmerIndex]:
+    directory = _index_directory(index_dir, database)
+    if directory in _indexes:
+        return _indexes[directory]
+    if not os.path.exists(os.path.join(directory, INFO_FILE)):
+        return None
+    with open(os.path.join(directory, INFO_FILE), encoding="utf-8") as stream:
+        info = json.load(stream)
+    if info["kmer_size"] != KMER_SIZE:
+        logging.warning("Ignoring k-mer index with different k-mer size.")
+        return None
+    with open(os.path.join(directory, IDENTIFIERS_FILE), "rb") as stream:
+        identifiers = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    result = KmerIndex(
+        info["kmer_size"],
+        numpy.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r"),
+        numpy.load(os.path.join(directory, POSTINGS_FILE), mmap_mode="r"),
+        identifiers,
+        numpy.load(os.path.join(directory, IDENTIFIER_OFFSETS_FILE), mmap_mode="r"),
+    )
+    _indexes[directory] = result
+    return result
+
+
+def _read_identifier(index: KmerIndex, number: int) -> str:
+    start = int(index.identifier_offsets[number])
+    end = int(index.identifier_offsets[number + 1]) - 1
+    return index.identifiers[start:end].decode("utf-8")
+
+
+# endregion
+
+
+def _create_translation_table() -> numpy.ndarray:
+    """Map residues to positions in ALPHABET, other symbols to -1."""
+    result = numpy.full(256, -1, dtype=numpy.int64)
+    for index, residue in enumerate(ALPHABET):
+        result[ord(residue)] = index
+    return result
+
+
+TRANSLATION_TABLE = _create_translation_table()
+
+
+def _encode_kmers(content: numpy.ndarray) -> numpy.ndarray:
+    """Return code of k-mer starting at each position, -1 for invalid k-mers."""
+    residues = TRANSLATION_TABLE[content]
+    count = len(residues) - KMER_SIZE + 1
+    if count <= 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    result = numpy.zeros(count, dtype=numpy.int64)
+    valid = numpy.ones(count, dtype=bool)
+    for offset in range(KMER_SIZE):
+        window = residues[offset : offset + count]
+        result = result * len(ALPHABET) + window
+        valid &= window >= 0
+    result[~valid] = -1
+    return result
+
+
+def _index_directory(index_dir: str, database: str) -> str:
+    return os.path.join(index_dir, database)
+
+
+if __name__ == "__main__":
+    main(_read_arguments())
@@ -7,10 +7,23 @@
 #   input-sequence.fasta
 #   psiblast                    -> _execute_psiblast
 #                                   Query for similar proteins.
+#                                   With sharded_search each volume of
+#                                   the database is searched in parallel,
+#                                   see _execute_sharded_psiblast.
+#                                   With prefilter_databases only
+#                                   candidate sequences are searched,
+#                                   see _execute_prefiltered_psiblast.
 #   psiblast-filtered           -> _filter_psiblast_file
 #                                   Filter proteins by similarity.
-#   blastdb-output              -> _execute_blastdbcmd
-#                                   Get sequences for the proteins.
+#   blastdb-output              -> _retrieve_sequences
+#                                   Get sequences for the proteins from
+#                                   the sequence store or using blastdbcmd.
+#                                   With streaming_search the three steps
+#                                   above are executed as one pipeline,
+#                                   see _search_database_streaming.
+#   blastdb-trimmed             -> _trim_sequences
+#                                   With trim_hits cut the sequences to
+#                                   the aligned region and a flank.
 #   blast-output                -> _execute_cdhit
 #                                   Cluster sequences and select
 #                                   representatives.
@@ -18,15 +31,82 @@
 #                                   Add the input sequence to the
 #                                   found sequences.
 #   muscle-output               -> _compute_msa_for_sequences
-#                                   Apply muscle to get MSA.
+#                                   Apply muscle to get MSA. With
+#                                   adaptive_alignment the strategy is
+#                                   selected by _select_alignment_strategy.
 #   msa                         -> _order_muscle_result
 #                                   Reorder sequences and put the
 #                                   input sequence first.
 #
+# With checkpoints enabled, completed stages are recorded in
+# checkpoints/{stage}.json together with fingerprint of their inputs
+# and sizes of their outputs. When the computation is executed again
+# in the same working directory, stages with a valid checkpoint are
+# not executed, see _execute_stage.
+#
 
 import os
 import typing
 import logging
+import threading
+import signal
+import subprocess
+import collections
+import re
+import concurrent.futures
+import json
+import hashlib
+import time
+import queue
+
+import fasta
+
+
+class SearchCancelled(Exception):
+    """Raised by callbacks when the execution was cancelled."""
+
+
+class AlignmentTimeout(Exception):
+    """Raised by execute_muscle when the time budget was exceeded."""
+
+
+# Result of a search in a database, the sequences_file is None when
+# the sequences were not retrieved yet. The ranges_file is set only
+# with trim_hits, see _save_hit_ranges.
+SearchResult = collections.namedtuple(
+    "SearchResult",
+    ["filtered_file", "sequences_file", "count", "ranges_file"],
+    defaults=(None,),
+)
+
+# How to compute the alignment. Number of refinement iterations, use 1 for
+# progressive alignment only. Time budget in seconds, 0 for no limit.
+AlignmentStrategy = collections.namedtuple(
+    "AlignmentStrategy", ["name", "iterations", "maximum_sequences", "time_budget"]
+)
+
+# Default number of MUSCLE iterations.
+DEFAULT_ALIGNMENT_ITERATIONS = 16
+
+# Default number of sequences reported by PSI-BLAST (-max_target_seqs).
+PSIBLAST_MAXIMUM_TARGETS = 500
+
+# Up to this number of residues (query length x sequences) the alignment
+# is computed using default number of iterations.
+DEFAULT_ALIGNMENT_RESIDUES = 70000
+
+# Up to this number of residues only two iterations are used, above it
+# only progressive alignment is computed.
+REFINED_ALIGNMENT_RESIDUES = 105000
+
+# For progressive alignment the number of sequences is limited, so
+# there are at most given number of residues.
+PROGRESSIVE_ALIGNMENT_RESIDUES = 105000
+
+# Part of the alignment time budget reserved for the fallback alignment.
+FALLBACK_BUDGET_FRACTION = 0.2
+
+FALLBACK_STRATEGY = "fallback"
 
 
 class MsaConfiguration:
@@ -41,14 +121,106 @@ class MsaConfiguration:
     maximum_sequences_for_msa: int
     # List of databases used to search for multisequence alignment.
     blast_databases: typing.List[str] = []
+    # If True all databases are searched concurrently, still the first
+    # database, in order given by blast_databases, with enough sequences
+    # is used and searches in the remaining databases are cancelled.
+    concurrent_database_search: bool = False
+    # Maximum number of concurrently running searches, use 0 for number of CPUs.
+    maximum_concurrent_searches: int = 0
+    # If True, output of PSI-BLAST is filtered as it is produced and
+    # the identifiers are passed to blastdbcmd once there are enough of
+    # them, no intermediate files are written. Requires start_psiblast
+    # and start_blastdb. With retrieve_sequences the identifiers are
+    # written to a file and retrieved using retrieve_sequences instead.
+    # PSI-BLAST writes hits only at the end of the scan, so a database
+    # without enough sequences is still recognized only after the scan.
+    streaming_search: bool = False
+    # If True, found sequences are cut to the region aligned by PSI-BLAST
+    # (sstart, send) extended by trim_flank residues on each side before
+    # clustering and alignment. Requires sstart and send in PSI-BLAST output.
+    trim_hits: bool = False
+    # Number of residues kept on each side of the aligned region.
+    trim_flank: int = 20
+    # If True, databases with multiple volumes are searched per volume
+    # in parallel. The results are merged so they are same as for a search
+    # in the whole database. Requires list_database_volumes and
+    # execute_psiblast_volume.
+    sharded_search: bool = False
+    # Maximum number of concurrently searched volumes, use 0 for number of CPUs.
+    maximum_volume_searches: int = 0
+    # Databases searched only in candidates selected by find_candidates,
+    # the candidates are searched with E-values of the whole database.
+    # Requires find_candidates, execute_makeblastdb, list_database_volumes
+    # and execute_psiblast_volume.
+    prefilter_databases: typing.List[str] = []
+    # Return databases that are known to not provide enough sequences
+    # for given sequence, such databases are not searched. Can be None.
+    # Arguments: sequence, databases
+    plan_search: typing.Optional[
+        typing.Callable[[str, typing.List[str]], typing.List[str]]
+    ] = None
+    # Record databases that did not provide enough sequences and time
+    # spent searching them. Can be None.
+    # Arguments: sequence, failed databases, durations in seconds
+    record_search: typing.Optional[
+        typing.Callable[[str, typing.List[str], typing.Dict[str, float]], None]
+    ] = None
     # Path to a working directory.
     working_dir: str
+    # Versions of the databases, checkpoints of other versions are
+    # not used.
+    database_versions: typing.Dict[str, str] = {}
+    # Precomputed PSI-BLAST output for the input sequence, maps database
+    # name to a file, see search_in_batch. For databases with a file
+    # PSI-BLAST is not executed.
+    psiblast_results: typing.Dict[str, str] = {}
     # Execute psiblast for given files.
+    # Arguments: input file, output file, database, cancel event
+    # When the cancel event is set, the execution should be terminated
+    # and SearchCancelled raised. The event can be None.
+    execute_psiblast: typing.Callable[
+        [str, str, str, typing.Optional[threading.Event]], None
+    ]
+    # Return volumes of the database and size of the whole database,
+    # the size is passed to execute_psiblast_volume.
+    # Arguments: database
+    list_database_volumes: typing.Callable[
+        [str], typing.Tuple[typing.List[str], typing.Any]
+    ]
+    # Execute psiblast for a database volume with E-values computed for the
+    # whole database. Output must have two more columns: evalue and bitscore.
+    # Arguments: input file, output file, volume, database size, cancel event
+    execute_psiblast_volume: typing.Callable[
+        [str, str, str, typing.Any, typing.Optional[threading.Event]], None
+    ]
+    # Execute psiblast for multiple queries, the output must have the
+    # query identifier (qseqid) in the first column.
     # Arguments: input file, output file, database
-    execute_psiblast: typing.Callable[[str, str, str], None]
+    execute_psiblast_batch: typing.Callable[[str, str, str], None]
+    # Start psiblast writing tabular output to stdout of the process.
+    # The process must be started in a new session.
+    # Arguments: input file, database
+    start_psiblast: typing.Callable[[str, str], subprocess.Popen]
     # Execute psiblast for given files.
     # Arguments: input file, output file, database
     execute_blastdb: typing.Callable[[str, str, str], None]
+    # Retrieve sequences for identifiers without running blastdbcmd.
+    # Return False when the sequences are not available, in such case
+    # execute_blastdb is used. Can be None.
+    # Arguments: input file, output file, database
+    retrieve_sequences: typing.Optional[typing.Callable[[str, str, str], bool]] = None
+    # Write identifiers of candidate sequences for the input sequence.
+    # Return False when candidates can not be selected for the database,
+    # in such case the whole database is searched. Can be None.
+    # Arguments: input file, database, output file
+    find_candidates: typing.Optional[typing.Callable[[str, str, str], bool]] = None
+    # Create BLAST database from FASTA file.
+    # Arguments: sequences file, database path
+    execute_makeblastdb: typing.Callable[[str, str], None]
+    # Start blastdbcmd reading identifiers from stdin of the process.
+    # The process must be started in a new session.
+    # Arguments: output file, database
+    start_blastdb: typing.Callable[[str, str], subprocess.Popen]
     # Execute psiblast for given files.
     # Arguments: sequences files, output file, log file
     execute_cdhit: typing.Callable[
@@ -59,21 +231,168 @@ class MsaConfiguration:
         ],
         None,
     ]
-    # Execute psiblast for given files.
-    # Arguments: input file, output file
-    execute_muscle: typing.Callable[[str, str], None]
+    # If True the alignment strategy and number of sequences are selected
+    # based on the query length and number of found sequences.
+    adaptive_alignment: bool = False
+    # Time budget for adaptive alignment in seconds. The selected strategy
+    # can use all but FALLBACK_BUDGET_FRACTION of it, when exceeded the
+    # alignment is computed again using progressive alignment only in the
+    # rest of the budget. Use 0 for no limit.
+    alignment_time_budget: float = 0
+    # If True, completed stages are recorded in the working directory
+    # and not executed again when the computation is restarted.
+    checkpoints: bool = False
+    # Execute muscle for given files.
+    # Arguments: input file, output file, alignment strategy
+    # The strategy can be None, in such case default options are used.
+    # Raise AlignmentTimeout when the strategy time budget is exceeded.
+    execute_muscle: typing.Callable[
+        [str, str, typing.Optional[AlignmentStrategy]], None
+    ]
 
 
 def compute_msa(fasta_file: str, output_file: str, config: MsaConfiguration):
     blast_input = _prepare_blast_input(fasta_file, config)
     blast_output = os.path.join(config.working_dir, "blast-output")
-    _find_similar_sequences(blast_input, blast_output, config)
+    _execute_stage(
+        config,
+        "similar-sequences",
+        [blast_input],
+        {
+            "databases": config.blast_databases,
+            "minimum_sequence_count": config.minimum_sequence_count,
+            "minimum_coverage": config.minimum_coverage,
+            "maximum_sequences_for_msa": config.maximum_sequences_for_msa,
+            "trim_hits": config.trim_hits,
+            "trim_flank": config.trim_flank,
+        },
+        lambda: (
+            _find_similar_sequences(blast_input, blast_output, config),
+            [blast_output],
+        ),
+    )
     muscle_file = os.path.join(config.working_dir, "muscle-output")
-    _compute_msa_for_sequences(blast_input, blast_output, muscle_file, config)
+    alignment_files = [muscle_file]
+    if config.adaptive_alignment:
+        alignment_files.append(_alignment_strategy_file(output_file))
+    _execute_stage(
+        config,
+        "alignment",
+        [blast_input, blast_output],
+        {
+            "adaptive_alignment": config.adaptive_alignment,
+            "alignment_time_budget": config.alignment_time_budget,
+            "minimum_sequence_count": config.minimum_sequence_count,
+            "maximum_sequences_for_msa": config.maximum_sequences_for_msa,
+        },
+        lambda: (
+            _compute_alignment(
+                blast_input, blast_output, muscle_file, output_file, config
+            ),
+            alignment_files,
+        ),
+    )
     _prepare_for_conservation(muscle_file, output_file, config)
     config.maximum_sequences_for_msa = 1
 
 
+def _compute_alignment(
+    fasta_file: str,
+    sequence_file: str,
+    output_file: str,
+    msa_file: str,
+    config: MsaConfiguration,
+):
+    if config.adaptive_alignment:
+        _compute_adaptive_msa_for_sequences(
+            fasta_file, sequence_file, output_file, msa_file, config
+        )
+    else:
+        _compute_msa_for_sequences(fasta_file, sequence_file, output_file, config)
+
+
+# region Checkpoints
+
+
+def _execute_stage(
+    config: MsaConfiguration,
+    name: str,
+    input_files: typing.List[str],
+    parameters: typing.Dict,
+    action: typing.Callable[[], typing.Tuple[typing.Any, typing.List[str]]],
+) -> typing.Any:
+    """
+    Execute the action unless there is a valid checkpoint for the stage.
+    The action returns result and list of output files, the result must
+    be JSON serializable. Return the result.
+    """
+    if not config.checkpoints:
+        return action()[0]
+    checkpoint_file = os.path.join(config.working_dir, "checkpoints", name + ".json")
+    if len(config.database_versions) > 0:
+        parameters = {**parameters, "database_versions": config.database_versions}
+    fingerprint = _compute_fingerprint(input_files, parameters)
+    checkpoint = _load_checkpoint(checkpoint_file, fingerprint)
+    if checkpoint is not None:
+        logging.info("Using checkpoint for stage '%s'.", name)
+        return checkpoint["result"]
+    result, output_files = action()
+    _save_checkpoint(checkpoint_file, fingerprint, result, output_files)
+    return result
+
+
+def _compute_fingerprint(input_files: typing.List[str], parameters: typing.Dict) -> str:
+    result = hashlib.sha256()
+    result.update(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+    for input_file in input_files:
+        result.update(input_file.encode("utf-8"))
+        with open(input_file, "rb") as in_stream:
+            for chunk in iter(lambda: in_stream.read(1024 * 1024), b""):
+                result.update(chunk)
+    return result.hexdigest()
+
+
+def _load_checkpoint(
+    checkpoint_file: str, fingerprint: str
+) -> typing.Optional[typing.Dict]:
+    """Return the checkpoint if it exists and match the inputs and outputs."""
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, encoding="utf-8") as stream:
+        checkpoint = json.load(stream)
+    if checkpoint["fingerprint"] != fingerprint:
+        logging.info("Ignoring checkpoint '%s' for different input.", checkpoint_file)
+        return None
+    for output_file, size in checkpoint["outputs"].items():
+        if not os.path.exists(output_file) or os.path.getsize(output_file) != size:
+            logging.info(
+                "Ignoring checkpoint '%s' for invalid output.", checkpoint_file
+            )
+            return None
+    return checkpoint
+
+
+def _save_checkpoint(
+    checkpoint_file: str,
+    fingerprint: str,
+    result: typing.Any,
+    output_files: typing.List[str],
+):
+    os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    checkpoint = {
+        "fingerprint": fingerprint,
+        "outputs": {file: os.path.getsize(file) for file in output_files},
+        "result": result,
+    }
+    # Write and rename, so the checkpoint is never partially written.
+    temp_file = checkpoint_file + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as stream:
+        json.dump(checkpoint, stream, indent=2)
+    os.replace(temp_file, checkpoint_file)
+
+
+# endregion
+
 # region Prepare Blast input
 
 
@@ -83,7 +402,7 @@ def _prepare_blast_input(fasta_file: str, config: MsaConfiguration) -> str:
     Mare sure there is only one sequence in the file. Add recognizable header
     to the sequence name and save it to a file.
     """
-    sequences = _read_fasta_file(fasta_file)
+    sequences = fasta.read_fasta_file(fasta_file)
     if len(sequences) != 1:
         raise Exception(
             "The input file must contains only one sequence not {}".format(
@@ -91,48 +410,12 @@ def _prepare_blast_input(fasta_file: str, config: MsaConfiguration) -> str:
             )
         )
     blast_input = os.path.join(config.working_dir, "input-sequence.fasta")
-    _save_sequence_to_fasta(
+    fasta.save_sequence_to_fasta(
         config.sequence_prefix + sequences[0][0], sequences[0][1], blast_input
     )
     return blast_input
 
 
-def _read_fasta_file(input_file: str) -> typing.List[typing.Tuple[str, str]]:
-    header = None
-    result = []
-    sequence = ""
-    with open(input_file) as in_stream:
-        for line in in_stream:
-            line = line.rstrip()
-            if line.startswith(">"):
-                if header is None:
-                    header = line[1:]
-                else:
-                    result.append((header, sequence))
-                    header = line[1:]
-                    sequence = ""
-            else:
-                sequence += line
-    if header is not None:
-        result.append((header, sequence))
-    return result
-
-
-def _save_sequence_to_fasta(header: str, sequence: str, output_file: str):
-    with open(output_file, "w") as out_stream:
-        out_stream.write(_format_fasta_sequence(header, sequence))
-
-
-def _format_fasta_sequence(header: str, sequence: str, line_width: int = 80):
-    lines = "\n".join(
-        [
-            sequence[index : index + line_width]
-            for index in range(0, len(sequence), line_width)
-        ]
-    )
-    return f">{header}\n{lines}\n"
-
-
 # endregion
 
 # region Find similar sequences
@@ -144,36 +427,261 @@ def _find_similar_sequences(
     """
     Try to find sufficient amount of similar sequences in databases.
     """
-    for database in config.blast_databases:
-        found = _find_similar_sequences_in_database(
-            input_file, output_file, config, database
-        )
-        if found:
+    sequence = fasta.read_fasta_file(input_file)[0][1]
+    databases = config.blast_databases
+    if config.plan_search is not None:
+        skip = config.plan_search(sequence, databases)
+        databases = [database for database in databases if database not in skip]
+    # Databases without enough sequences and time spent searching them.
+    failed = {}
+    try:
+        if config.concurrent_database_search:
+            _find_similar_sequences_concurrently(
+                input_file, output_file, config, databases, failed
+            )
             return
-    raise Exception("Not enough similar sequences found!")
+        for database in databases:
+            start = time.perf_counter()
+            found = _find_similar_sequences_in_database(
+                input_file, output_file, config, database
+            )
+            if found:
+                return
+            failed[database] = time.perf_counter() - start
+        raise Exception("Not enough similar sequences found!")
+    finally:
+        if config.record_search is not None and len(failed) > 0:
+            config.record_search(sequence, list(failed.keys()), failed)
 
 
 def _find_similar_sequences_in_database(
     input_file: str, output_file: str, config: MsaConfiguration, database: str
 ) -> bool:
+    # With checkpoints, each database needs own files to be resumable.
+    suffix = "-" + database if config.checkpoints else ""
+    search_result = _search_database(input_file, config, database, suffix, None)
+    return _select_from_database(search_result, output_file, config, database, suffix)
+
+
+def _search_database(
+    input_file: str,
+    config: MsaConfiguration,
+    database: str,
+    suffix: str,
+    cancel: typing.Optional[threading.Event],
+) -> SearchResult:
+    """Execute PSI-BLAST and filter the results, use checkpoint if available."""
+    input_files = [input_file]
+    if database in config.psiblast_results:
+        input_files.append(config.psiblast_results[database])
+
+    def search():
+        result = _execute_search(input_file, config, database, suffix, cancel)
+        output_files = [
+            file
+            for file in (
+                result.filtered_file,
+                result.sequences_file,
+                result.ranges_file,
+            )
+            if file is not None
+        ]
+        return result, output_files
+
+    result = _execute_stage(
+        config,
+        "search-" + database,
+        input_files,
+        {
+            "database": database,
+            "minimum_coverage": config.minimum_coverage,
+            "streaming_search": config.streaming_search,
+            "trim_hits": config.trim_hits,
+            "prefilter": database in config.prefilter_databases,
+        },
+        search,
+    )
+    return SearchResult(*result)
+
+
+def _execute_search(
+    input_file: str,
+    config: MsaConfiguration,
+    database: str,
+    suffix: str,
+    cancel: typing.Optional[threading.Event],
+) -> SearchResult:
+    """Execute PSI-BLAST and filter the results."""
     logging.info(
         "Searching for similar sequences using psiblast on '%s' database ...", database
     )
-    psiblast = os.path.join(config.working_dir, "psiblast")
-    config.execute_psiblast(input_file, psiblast, database)
+    psiblast = config.psiblast_results.get(database, None)
+    if psiblast is not None:
+        logging.info("Using precomputed psiblast result.")
+    elif database in config.prefilter_databases:
+        psiblast = _execute_prefiltered_psiblast(
+            input_file, config, database, suffix, cancel
+        )
+    if psiblast is None:
+        if config.streaming_search and not config.sharded_search:
+            return _search_database_streaming(
+                input_file, config, database, suffix, cancel
+            )
+        psiblast = os.path.join(config.working_dir, "psiblast" + suffix)
+        if config.sharded_search:
+            _execute_sharded_psiblast(input_file, psiblast, config, database, cancel)
+        else:
+            config.execute_psiblast(input_file, psiblast, database, cancel)
     logging.info("Filtering result to match required criteria...")
-    psiblast_filtered = os.path.join(config.working_dir, "psiblast-filtered")
-    filtered_count = _filter_psiblast_file(psiblast, psiblast_filtered, config)
-    if filtered_count < config.minimum_sequence_count:
+    psiblast_filtered = os.path.join(config.working_dir, "psiblast-filtered" + suffix)
+    ranges = {} if config.trim_hits else None
+    filtered_count = _filter_psiblast_file(psiblast, psiblast_filtered, config, ranges)
+    ranges_file = _save_hit_ranges(ranges, config, suffix)
+    return SearchResult(psiblast_filtered, None, filtered_count, ranges_file)
+
+
+def _execute_prefiltered_psiblast(
+    input_file: str,
+    config: MsaConfiguration,
+    database: str,
+    suffix: str,
+    cancel: typing.Optional[threading.Event],
+) -> typing.Optional[str]:
+    """
+    Search only in candidate sequences, return path to PSI-BLAST output
+    or None when there are no candidates for the database.
+    """
+    candidates = os.path.join(config.working_dir, "prefilter-candidates" + suffix)
+    if config.find_candidates is None or not config.find_candidates(
+        input_file, database, candidates
+    ):
+        logging.info("Prefilter is not available for '%s'.", database)
+        return None
+    output_file = os.path.join(config.working_dir, "psiblast" + suffix)
+    if os.path.getsize(candidates) == 0:
+        open(output_file, "w").close()
+        return output_file
+    sequences = os.path.join(config.working_dir, "prefilter-sequences" + suffix)
+    _retrieve_sequences(candidates, sequences, config, database)
+    candidates_database = os.path.join(
+        config.working_dir, "prefilter-database" + suffix
+    )
+    config.execute_makeblastdb(sequences, candidates_database)
+    _, database_size = config.list_database_volumes(database)
+    candidates_output = output_file + "-prefilter"
+    config.execute_psiblast_volume(
+        input_file, candidates_output, candidates_database, database_size, cancel
+    )
+    _merge_volume_results([candidates_output], output_file)
+    return output_file
+
+
+def _execute_sharded_psiblast(
+    input_file: str,
+    output_file: str,
+    config: MsaConfiguration,
+    database: str,
+    cancel: typing.Optional[threading.Event],
+):
+    """Search all volumes of the database in parallel and merge the results."""
+    volumes, database_size = config.list_database_volumes(database)
+    if len(volumes) < 2:
+        config.execute_psiblast(input_file, output_file, database, cancel)
+        return
+    max_workers = config.maximum_volume_searches or os.cpu_count() or 1
+    max_workers = min(max_workers, len(volumes))
+    logging.info("Searching %s volumes using %s workers ...", len(volumes), max_workers)
+    # Used to stop remaining searches when one fails.
+    volumes_cancel = threading.Event()
+    if cancel is not None:
+        threading.Thread(
+            target=_propagate_cancel,
+            args=(cancel, volumes_cancel),
+            daemon=True,
+        ).start()
+    output_files = [f"{output_file}-{index}" for index in range(len(volumes))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = [
+            executor.submit(
+                config.execute_psiblast_volume,
+                input_file,
+                volume_output,
+                volume,
+                database_size,
+                volumes_cancel,
+            )
+            for volume, volume_output in zip(volumes, output_files)
+        ]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            volumes_cancel.set()
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                _wait_for_cancelled_search(future)
+    _merge_volume_results(output_files, output_file)
+
+
+def _propagate_cancel(cancel: threading.Event, target: threading.Event):
+    """Set target when cancel is set, stop once the target is set."""
+    while not target.is_set():
+        if cancel.wait(timeout=0.5):
+            target.set()
+            return
+
+
+def _merge_volume_results(input_files: typing.List[str], output_file: str):
+    """
+    Order hits by E-value and bit score and keep the same number of target
+    sequences as PSI-BLAST would for the whole database.
+    """
+    hits = []
+    for input_file in input_files:
+        with open(input_file) as in_stream:
+            for line in in_stream:
+                columns = line.rstrip("\n").split("\t")
+                if len(columns) < 3:
+                    continue
+                evalue, bitscore = float(columns[-2]), float(columns[-1])
+                hits.append((evalue, -bitscore, columns[:-2]))
+    hits.sort(key=lambda item: (item[0], item[1]))
+    targets = set()
+    with open(output_file, "w") as out_stream:
+        for _, _, columns in hits:
+            if columns[0] not in targets:
+                if len(targets) == PSIBLAST_MAXIMUM_TARGETS:
+                    continue
+                targets.add(columns[0])
+            out_stream.write("\t".join(columns))
+            out_stream.write("\n")
+
+
+def _select_from_database(
+    search_result: SearchResult,
+    output_file: str,
+    config: MsaConfiguration,
+    database: str,
+    suffix: str,
+) -> bool:
+    """Retrieve, cluster and select sequences found in the database."""
+    if search_result.count < config.minimum_sequence_count:
         logging.info("Not enough sequences.")
         return False
-    logging.info("Retrieving content of sequences ...")
-    sequences = os.path.join(config.working_dir, "blastdb-output")
-    config.execute_blastdb(psiblast_filtered, sequences, database)
+    sequences = search_result.sequences_file
+    if sequences is None:
+        logging.info("Retrieving content of sequences ...")
+        sequences = os.path.join(config.working_dir, "blastdb-output" + suffix)
+        _retrieve_sequences(search_result.filtered_file, sequences, config, database)
+    if search_result.ranges_file is not None:
+        trimmed = os.path.join(config.working_dir, "blastdb-trimmed" + suffix)
+        _trim_sequences(sequences, search_result.ranges_file, trimmed, config)
+        sequences = trimmed
     # Cluster and select representatives.
     logging.info("Selecting representative sequences ...")
-    cdhit_log_file = os.path.join(config.working_dir, "cd-hit.log")
-    cdhit_output_file = os.path.join(config.working_dir, "cd-hit")
+    cdhit_log_file = os.path.join(config.working_dir, "cd-hit.log" + suffix)
+    cdhit_output_file = os.path.join(config.working_dir, "cd-hit" + suffix)
     config.execute_cdhit(sequences, cdhit_output_file, cdhit_log_file)
     if not _found_enough_sequences(cdhit_output_file, config):
         return False
@@ -181,19 +689,242 @@ def _find_similar_sequences_in_database(
     return True
 
 
+def _retrieve_sequences(
+    input_file: str, output_file: str, config: MsaConfiguration, database: str
+):
+    if config.retrieve_sequences is not None and config.retrieve_sequences(
+        input_file, output_file, database
+    ):
+        return
+    config.execute_blastdb(input_file, output_file, database)
+
+
+def _search_database_streaming(
+    input_file: str,
+    config: MsaConfiguration,
+    database: str,
+    suffix: str,
+    cancel: typing.Optional[threading.Event],
+) -> SearchResult:
+    """
+    Filter PSI-BLAST output as it is produced. Once there are enough
+    sequences, blastdbcmd is started and identifiers are passed to it as
+    they pass the filter, so no intermediate files are written. When
+    there is a sequence store, the identifiers are written to a file and
+    the sequences are retrieved by _retrieve_sequences instead.
+    """
+    if config.retrieve_sequences is not None:
+        filtered_file = os.path.join(config.working_dir, "psiblast-filtered" + suffix)
+    else:
+        filtered_file = None
+    sequences = os.path.join(config.working_dir, "blastdb-output" + suffix)
+    psiblast = config.start_psiblast(input_file, database)
+    processes = [psiblast]
+    finished = threading.Event()
+    if cancel is not None:
+        threading.Thread(
+            target=_terminate_on_cancel,
+            args=(processes, cancel, finished),
+            daemon=True,
+        ).start()
+    # Identifiers for blastdbcmd, None marks the end.
+    identifiers = queue.Queue()
+    feeder = None
+    feeder_errors = []
+    inputs_count = 0
+    results_count = 0
+    ranges = {} if config.trim_hits else None
+    out_stream = None if filtered_file is None else open(filtered_file, "w")
+    try:
+        for line in psiblast.stdout:
+            inputs_count += 1
+            identifier = _filter_psiblast_line(line, config)
+            if identifier is None:
+                continue
+            if ranges is not None:
+                _update_hit_range(ranges, identifier, line)
+            results_count += 1
+            if out_stream is not None:
+                out_stream.write(identifier)
+                out_stream.write("\n")
+                continue
+            identifiers.put(identifier)
+            if feeder is None and results_count >= config.minimum_sequence_count:
+                # Started in a thread, so we keep reading PSI-BLAST output
+                # while blastdbcmd waits for the tools limit.
+                feeder = threading.Thread(
+                    target=_feed_blastdb,
+                    args=(
+                        identifiers,
+                        sequences,
+                        config,
+                        database,
+                        processes,
+                        finished,
+                        feeder_errors,
+                    ),
+                    daemon=True,
+                )
+                feeder.start()
+        identifiers.put(None)
+        psiblast.stdout.close()
+        psiblast.wait()
+        if cancel is not None and cancel.is_set():
+            raise SearchCancelled()
+        if psiblast.returncode != 0:
+            raise subprocess.CalledProcessError(psiblast.returncode, psiblast.args)
+        logging.info("Filtering results from %s to %s", inputs_count, results_count)
+        ranges_file = _save_hit_ranges(ranges, config, suffix)
+        if out_stream is not None:
+            out_stream.close()
+            return SearchResult(filtered_file, None, results_count, ranges_file)
+        if feeder is None:
+            # The database failed, there is nothing to retrieve.
+            return SearchResult(None, None, results_count)
+        feeder.join()
+        if cancel is not None and cancel.is_set():
+            raise SearchCancelled()
+        if len(feeder_errors) > 0:
+            raise feeder_errors[0]
+        return SearchResult(None, sequences, results_count, ranges_file)
+    finally:
+        identifiers.put(None)
+        if out_stream is not None:
+            out_stream.close()
+        finished.set()
+        for process in processes:
+            _terminate_process(process)
+
+
+def _feed_blastdb(
+    identifiers: queue.Queue,
+    output_file: str,
+    config: MsaConfiguration,
+    database: str,
+    processes: typing.List[subprocess.Popen],
+    finished: threading.Event,
+    errors: typing.List[BaseException],
+):
+    """Start blastdbcmd and write identifiers to it till None is read."""
+    try:
+        blastdb = config.start_blastdb(output_file, database)
+        processes.append(blastdb)
+        if finished.is_set():
+            # The search ended while we waited for the tools limit.
+            _terminate_process(blastdb)
+            return
+        while True:
+            identifier = identifiers.get()
+            if identifier is None:
+                break
+            blastdb.stdin.write(identifier)
+            blastdb.stdin.write("\n")
+        blastdb.stdin.close()
+        blastdb.wait()
+        if blastdb.returncode != 0:
+            raise subprocess.CalledProcessError(blastdb.returncode, blastdb.args)
+    except BaseException as error:
+        errors.append(error)
+
+
+def _terminate_on_cancel(
+    processes: typing.List[subprocess.Popen],
+    cancel: threading.Event,
+    finished: threading.Event,
+):
+    while not finished.is_set():
+        if cancel.wait(timeout=0.5):
+            for process in processes:
+                _terminate_process(process)
+            return
+
+
+def _terminate_process(process: subprocess.Popen):
+    """Terminate process started in a new session and all its children."""
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def _find_similar_sequences_concurrently(
+    input_file: str,
+    output_file: str,
+    config: MsaConfiguration,
+    databases: typing.List[str],
+    failed: typing.Dict[str, float],
+):
+    """
+    Search all databases at once, use the first database in the order of
+    databases with enough sequences. Databases without enough sequences
+    are added to failed, with time since start of the search.
+    """
+    max_workers = config.maximum_concurrent_searches or os.cpu_count() or 1
+    max_workers = min(max_workers, len(databases))
+    cancel_events = [threading.Event() for _ in databases]
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = [
+            executor.submit(
+                _search_database, input_file, config, database, "-" + database, cancel
+            )
+            for database, cancel in zip(databases, cancel_events)
+        ]
+        try:
+            for index, database in enumerate(databases):
+                found = _select_from_database(
+                    futures[index].result(),
+                    output_file,
+                    config,
+                    database,
+                    "-" + database,
+                )
+                if found:
+                    logging.info("Using sequences from '%s' database.", database)
+                    return
+                failed[database] = time.perf_counter() - start
+        finally:
+            # Cancel all searches that are not needed anymore.
+            for future, cancel in zip(futures, cancel_events):
+                future.cancel()
+                cancel.set()
+            for future in futures:
+                _wait_for_cancelled_search(future)
+    raise Exception("Not enough similar sequences found!")
+
+
+def _wait_for_cancelled_search(future: concurrent.futures.Future):
+    if future.cancelled():
+        return
+    try:
+        future.result()
+    except SearchCancelled:
+        pass
+    except Exception as error:
+        # We are not interested in results of cancelled searches.
+        logging.debug("Cancelled search failed: %s", error)
+
+
 def _filter_psiblast_file(
-    input_file: str, output_file: str, config: MsaConfiguration
+    input_file: str,
+    output_file: str,
+    config: MsaConfiguration,
+    ranges: typing.Optional[typing.Dict[str, typing.List[int]]] = None,
 ) -> int:
+    """When ranges are given, collect aligned regions of the sequences."""
     inputs_count = 0
     results_count = 0
     with open(input_file) as in_stream, open(output_file, "w") as out_stream:
         for line in in_stream:
             inputs_count += 1
-            identifier, coverage, identity = line.rstrip().split("\t")
-            if float(coverage) < config.minimum_coverage:
-                continue
-            if not (30 <= float(identity) <= 95):
+            identifier = _filter_psiblast_line(line, config)
+            if identifier is None:
                 continue
+            if ranges is not None:
+                _update_hit_range(ranges, identifier, line)
             out_stream.write(identifier)
             out_stream.write("\n")
             results_count += 1
@@ -201,10 +932,164 @@ def _filter_psiblast_file(
     return results_count
 
 
+def search_in_batch(
+    fasta_files: typing.Dict[str, str], config: MsaConfiguration
+) -> typing.Dict[str, typing.Dict[str, str]]:
+    """
+    Search for similar sequences for multiple queries using one PSI-BLAST
+    execution per database. Databases are searched in order, a query is
+    searched in the next database only when there are not enough
+    sequences after filtering.
+
+    The input maps query name to FASTA file with a single sequence. Return
+    for each query map of database to the PSI-BLAST output, the map can be
+    used as MsaConfiguration.psiblast_results.
+    """
+    queries = list(fasta_files.keys())
+    result = {query: {} for query in queries}
+    pending = list(queries)
+    for database in config.blast_databases:
+        if len(pending) == 0:
+            break
+        logging.info(
+            "Searching for %s sequences using psiblast on '%s' database ...",
+            len(pending),
+            database,
+        )
+        batch_input = os.path.join(config.working_dir, f"batch-input-{database}")
+        with open(batch_input, "w") as out_stream:
+            for index, query in enumerate(pending):
+                for _, sequence in fasta.read_fasta(fasta_files[query]):
+                    out_stream.write(
+                        fasta.format_fasta_sequence(f"batch_query_{index}", sequence)
+                    )
+        batch_output = os.path.join(config.working_dir, f"psiblast-{database}")
+        config.execute_psiblast_batch(batch_input, batch_output, database)
+        output_files = {
+            query: os.path.join(config.working_dir, f"psiblast-{database}-{index}")
+            for index, query in enumerate(pending)
+        }
+        _split_psiblast_batch_output(batch_output, pending, output_files)
+        next_pending = []
+        for query in pending:
+            output_file = output_files[query]
+            result[query][database] = output_file
+            count = _count_filtered_psiblast_file(output_file, config)
+            logging.info("Query '%s' has %s sequences", query, count)
+            if count < config.minimum_sequence_count:
+                next_pending.append(query)
+        pending = next_pending
+    return result
+
+
+def _split_psiblast_batch_output(
+    input_file: str, queries: typing.List[str], output_files: typing.Dict[str, str]
+):
+    """Split output with query identifier into per query files."""
+    streams = {query: open(output_files[query], "w") for query in queries}
+    try:
+        with open(input_file) as in_stream:
+            for line in in_stream:
+                if len(line.strip()) == 0:
+                    continue
+                query_id, content = line.split("\t", 1)
+                index = _batch_query_index(query_id)
+                streams[queries[index]].write(content)
+    finally:
+        for stream in streams.values():
+            stream.close()
+
+
+def _batch_query_index(query_id: str) -> int:
+    # Query may be reported with local prefix or with generated identifier.
+    query_id = query_id.strip()
+    if query_id.startswith("lcl|"):
+        query_id = query_id[4:]
+    if query_id.startswith("batch_query_"):
+        return int(query_id[len("batch_query_") :])
+    match = re.fullmatch(r"Query_(\d+)", query_id)
+    if match is not None:
+        return int(match.group(1)) - 1
+    raise Exception(f"Unexpected query identifier '{query_id}'.")
+
+
+def _count_filtered_psiblast_file(input_file: str, config: MsaConfiguration) -> int:
+    result = 0
+    with open(input_file) as in_stream:
+        for line in in_stream:
+            if _filter_psiblast_line(line, config) is not None:
+                result += 1
+    return result
+
+
+def _filter_psiblast_line(line: str, config: MsaConfiguration) -> typing.Optional[str]:
+    """Return identifier if the line match required criteria."""
+    identifier, coverage, identity = line.rstrip().split("\t")[:3]
+    if float(coverage) < config.minimum_coverage:
+        return None
+    if not (30 <= float(identity) <= 95):
+        return None
+    return identifier
+
+
+def _update_hit_range(
+    ranges: typing.Dict[str, typing.List[int]], identifier: str, line: str
+):
+    """Extend range of the sequence by subject range (sstart, send) in line."""
+    columns = line.rstrip().split("\t")
+    if len(columns) < 5:
+        # Output without subject range, the sequence is not trimmed.
+        return
+    start, end = sorted((int(columns[3]), int(columns[4])))
+    if identifier in ranges:
+        start = min(start, ranges[identifier][0])
+        end = max(end, ranges[identifier][1])
+    ranges[identifier] = [start, end]
+
+
+def _save_hit_ranges(
+    ranges: typing.Optional[typing.Dict[str, typing.List[int]]],
+    config: MsaConfiguration,
+    suffix: str,
+) -> typing.Optional[str]:
+    """Save ranges as 'identifier start end', return None for no ranges."""
+    if ranges is None:
+        return None
+    output_file = os.path.join(config.working_dir, "psiblast-ranges" + suffix)
+    with open(output_file, "w") as out_stream:
+        for identifier, (start, end) in ranges.items():
+            out_stream.write(f"{identifier}\t{start}\t{end}\n")
+    return output_file
+
+
+def _trim_sequences(
+    input_file: str, ranges_file: str, output_file: str, config: MsaConfiguration
+):
+    """Cut sequences to the aligned region extended by the flank."""
+    ranges = {}
+    with open(ranges_file) as in_stream:
+        for line in in_stream:
+            identifier, start, end = line.rstrip().split("\t")
+            ranges[fasta.normalize_identifier(identifier)] = (int(start), int(end))
+    original_length = 0
+    trimmed_length = 0
+    with open(output_file, "w") as out_stream:
+        for header, sequence in fasta.read_fasta(input_file):
+            original_length += len(sequence)
+            identifier = fasta.normalize_identifier(header.split(maxsplit=1)[0])
+            if identifier in ranges:
+                start, end = ranges[identifier]
+                start = max(0, start - 1 - config.trim_flank)
+                sequence = sequence[start : end + config.trim_flank]
+            trimmed_length += len(sequence)
+            out_stream.write(fasta.format_fasta_sequence(header, sequence))
+    logging.info(
+        "Trimmed sequences from %s to %s residues", original_length, trimmed_length
+    )
+
+
 def _found_enough_sequences(fasta_file: str, config: MsaConfiguration) -> bool:
-    counter = 0
-    for _, _ in _read_fasta_file(fasta_file):
-        counter += 1
+    counter = fasta.count_sequences(fasta_file)
     logging.info("Number of sequences in %s is %s", fasta_file, counter)
     return counter > config.minimum_sequence_count
 
@@ -213,19 +1098,17 @@ def _select_sequences(input_file: str, output_file: str, count: int):
     """
     Keep only first N of sequences.
     """
-    sequences = _read_fasta_file(input_file)
-    if 0 < count < len(sequences):
-        filtered_sequence = [
-            sequences[index] for index in uniform_sample(0, len(sequences), count)
+    entries = fasta.build_index(input_file)
+    if 0 < count < len(entries):
+        filtered_entries = [
+            entries[index] for index in uniform_sample(0, len(entries), count)
         ]
-        logging.info(
-            "Using %s from %s sequences", len(filtered_sequence), len(sequences)
-        )
-        sequences = filtered_sequence
+        logging.info("Using %s from %s sequences", len(filtered_entries), len(entries))
+        entries = filtered_entries
     # Write only selected.
     with open(output_file, "w") as out_stream:
-        for (header, sequence) in sequences:
-            out_stream.write(_format_fasta_sequence(header, sequence))
+        for header, sequence in fasta.read_indexed_sequences(input_file, entries):
+            out_stream.write(fasta.format_fasta_sequence(header, sequence))
 
 
 def uniform_sample(start, end, total_count):
@@ -241,12 +1124,134 @@ def uniform_sample(start, end, total_count):
 # endregion
 
 
+# region Compute MSA
+
+
 def _compute_msa_for_sequences(
     fasta_file: str, sequence_file: str, output_file: str, config: MsaConfiguration
 ):
     muscle_input = os.path.join(config.working_dir, "muscle-input")
     _merge_files([sequence_file, fasta_file], muscle_input)
-    config.execute_muscle(muscle_input, output_file)
+    config.execute_muscle(muscle_input, output_file, None)
+
+
+def _compute_adaptive_msa_for_sequences(
+    fasta_file: str,
+    sequence_file: str,
+    output_file: str,
+    msa_file: str,
+    config: MsaConfiguration,
+):
+    """
+    Select alignment strategy and compute the alignment, the strategy
+    is saved next to the MSA file.
+    """
+    query_length = len(fasta.read_fasta_file(fasta_file)[0][1])
+    sequence_count = fasta.count_sequences(sequence_file)
+    strategy = _select_alignment_strategy(query_length, sequence_count, config)
+    logging.info("Using alignment strategy: %s", strategy)
+    timed_out = []
+    start = time.monotonic()
+    while True:
+        muscle_input = os.path.join(config.working_dir, "muscle-input")
+        if strategy.maximum_sequences < sequence_count:
+            selected_file = os.path.join(
+                config.working_dir, "muscle-sequences-" + strategy.name
+            )
+            _select_sequences(sequence_file, selected_file, strategy.maximum_sequences)
+            _merge_files([selected_file, fasta_file], muscle_input)
+        else:
+            _merge_files([sequence_file, fasta_file], muscle_input)
+        try:
+            config.execute_muscle(muscle_input, output_file, strategy)
+            break
+        except AlignmentTimeout:
+            if strategy.time_budget == 0 or strategy.name == FALLBACK_STRATEGY:
+                raise
+            logging.info("Alignment time budget exceeded for: %s", strategy)
+            timed_out.append(strategy.name)
+            remaining = config.alignment_time_budget - (time.monotonic() - start)
+            strategy = _fallback_alignment_strategy(config, remaining)
+    _save_alignment_strategy(
+        _alignment_strategy_file(msa_file),
+        strategy,
+        query_length,
+        sequence_count,
+        timed_out,
+    )
+
+
+def _select_alignment_strategy(
+    query_length: int, sequence_count: int, config: MsaConfiguration
+) -> AlignmentStrategy:
+    maximum_sequences = sequence_count
+    if 0 < config.maximum_sequences_for_msa < sequence_count:
+        maximum_sequences = config.maximum_sequences_for_msa
+    # Keep part of the budget for the fallback alignment.
+    time_budget = config.alignment_time_budget * (1 - FALLBACK_BUDGET_FRACTION)
+    residues = query_length * maximum_sequences
+    if residues <= DEFAULT_ALIGNMENT_RESIDUES:
+        return AlignmentStrategy(
+            "default",
+            DEFAULT_ALIGNMENT_ITERATIONS,
+            maximum_sequences,
+            time_budget,
+        )
+    if residues <= REFINED_ALIGNMENT_RESIDUES:
+        return AlignmentStrategy("refined", 2, maximum_sequences, time_budget)
+    return AlignmentStrategy(
+        "progressive",
+        1,
+        min(
+            maximum_sequences,
+            _progressive_maximum_sequences(query_length, config),
+        ),
+        time_budget,
+    )
+
+
+def _progressive_maximum_sequences(query_length: int, config: MsaConfiguration):
+    return max(
+        config.minimum_sequence_count, PROGRESSIVE_ALIGNMENT_RESIDUES // query_length
+    )
+
+
+def _fallback_alignment_strategy(
+    config: MsaConfiguration, time_budget: float
+) -> AlignmentStrategy:
+    """
+    Cheapest strategy we have, it gets the rest of the budget. When even
+    this alignment is not computed in time, AlignmentTimeout is raised.
+    """
+    # The budget must stay positive, as 0 means no limit.
+    time_budget = max(time_budget, 1.0)
+    return AlignmentStrategy(
+        FALLBACK_STRATEGY, 1, config.minimum_sequence_count, time_budget
+    )
+
+
+def _alignment_strategy_file(msa_file: str) -> str:
+    return msa_file + ".strategy.json"
+
+
+def _save_alignment_strategy(
+    output_file: str,
+    strategy: AlignmentStrategy,
+    query_length: int,
+    sequence_count: int,
+    timed_out: typing.List[str],
+):
+    with open(output_file, "w", encoding="utf-8") as stream:
+        json.dump(
+            {
+                "strategy": strategy._asdict(),
+                "query_length": query_length,
+                "sequence_count": sequence_count,
+                "timed_out": timed_out,
+            },
+            stream,
+            indent=2,
+        )
 
 
 def _merge_files(input_files: typing.List[str], output_file: str):
@@ -265,23 +1270,28 @@ def _prepare_for_conservation(
     and fix some issues.
     """
     logging.info("Ordering muscle results ...")
-    first_header = None
-    first_sequence = None
-    for header, sequence in _read_fasta_file(input_file):
-        if header.startswith(config.sequence_prefix):
-            # We can remove the prefix here
-            first_header = header[len(config.sequence_prefix) :]
-            first_sequence = sequence
+    first_entry = None
+    for entry in fasta.build_index(input_file):
+        if entry.header.startswith(config.sequence_prefix):
+            first_entry = entry
             break
 
-    if first_header is None:
+    if first_entry is None:
         raise Exception(
             "Missing header '" + config.sequence_prefix + "' in " + input_file
         )
 
+    # We can remove the prefix here
+    first_header = first_entry.header[len(config.sequence_prefix) :]
+    with open(input_file, "rb") as in_stream:
+        first_sequence = fasta.read_indexed_sequence(in_stream, first_entry)
+
     with open(output_file, "w", newline="\n") as out_stream:
-        out_stream.write(_format_fasta_sequence(first_header, first_sequence, 60))
-        for header, sequence in _read_fasta_file(input_file):
+        out_stream.write(fasta.format_fasta_sequence(first_header, first_sequence, 60))
+        for header, sequence in fasta.read_fasta(input_file):
             if header.startswith(config.sequence_prefix):
                 continue
-            out_stream.write(_format_fasta_sequence(header, sequence, 60))
+            out_stream.write(fasta.format_fasta_sequence(header, sequence, 60))
+
+
+# endregion
@@ -3,15 +3,107 @@
 #
 # Prepare BLAST database with default files.
 #
+# Only databases that are missing or whose source has changed are built,
+# sequence stores and k-mer indexes are rebuilt for such databases.
+# Each build creates a new database version, see database_manager.py .
+# Sequence stores and k-mer indexes are built into the version directory
+# before the version is activated.
+#
 
 import os
+import typing
+import logging
+import argparse
 import subprocess
+import json
 import blast_database
+import database_manager
+import sequence_store
+import kmer_index
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(
+        description="Build missing or changed BLAST databases."
+    )
+    parser.add_argument(
+        "--rebuild",
+        metavar="D",
+        default=[],
+        type=str,
+        nargs="+",
+        help="Databases to build even when they have not changed.",
+    )
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+    )
+    databases = list(blast_database.DATABASE_NAME_TO_URL.keys())
+    changed = blast_database.get_changed_databases(databases)
+    changed += [name for name in arguments["rebuild"] if name not in changed]
+    logging.info("Databases to build: %s", changed)
+    try:
+        report = database_manager.build_versions(
+            execute_command, changed, prepare_version
+        )
+    except BlockingIOError:
+        logging.info("Other database build is running.")
+        return
+    # Add missing stores and indexes to databases that were not built.
+    for database in databases:
+        if database in changed:
+            continue
+        version_dir = database_manager.get_version_directory(database)
+        if version_dir is None:
+            prepare_stores(
+                database,
+                database,
+                sequence_store.SEQUENCE_STORE_DIR,
+                kmer_index.KMER_INDEX_DIR,
+            )
+        else:
+            prepare_version(database, version_dir, rebuild=False)
+    print(json.dumps(report, indent=2))
+
+
+def prepare_version(database: str, version_dir: str, rebuild: bool = True):
+    """Build sequence store and k-mer index in the database version."""
+    prepare_stores(
+        database,
+        os.path.join(version_dir, database),
+        os.path.join(version_dir, database_manager.VERSION_SEQUENCE_STORE_DIR),
+        os.path.join(version_dir, database_manager.VERSION_KMER_INDEX_DIR),
+        rebuild,
+    )
 
 
-def main():
-    databases = blast_database.DATABASE_NAME_TO_URL.keys()
-    blast_database.prepare_databases(execute_command, databases)
+def prepare_stores(
+    database: str,
+    source: str,
+    store_dir: typing.Optional[str],
+    index_dir: typing.Optional[str],
+    rebuild: bool = False,
+):
+    """
+    Build sequence store and k-mer index for the database, when they are
+    enabled and missing. Stores are enabled by SEQUENCE_STORE_DIR and
+    indexes by KMER_INDEX_DIR.
+    """
+    if sequence_store.SEQUENCE_STORE_DIR is not None and (
+        rebuild or sequence_store.open_store(store_dir, database) is None
+    ):
+        sequence_store.build_store_from_database(store_dir, database, source)
+    if (
+        kmer_index.KMER_INDEX_DIR is not None
+        and database in kmer_index.KMER_INDEX_DATABASES.split(",")
+        and (rebuild or kmer_index.open_index(index_dir, database) is None)
+    ):
+        kmer_index.build_index_from_database(index_dir, database, source)
 
 
 def execute_command(command: str):
@@ -21,4 +113,4 @@ def execute_command(command: str):
 
 
 if __name__ == "__main__":
-    main()
+    main(_read_arguments())
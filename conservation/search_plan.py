@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Persistent store of database search outcomes.
+#
+# For each searched sequence we record databases that did not provide
+# enough sequences, so next search for the same sequence can start with
+# the first database likely to succeed. Plans are also stored under
+# k-mer signature bands (MinHash), so near-identical sequences can use
+# them as well. Plan found under a band key is used only when the sequence
+# is near-identical to the sequence of the plan, see PLAN_MINIMUM_IDENTITY
+# and PLAN_MINIMUM_COVERAGE, so fragments and chimeras do not inherit the
+# plan. The last database is never skipped.
+#
+# Every lookup is recorded in the statistics file, use
+#   python3 search_plan.py --directory {directory}
+# to print the statistics.
+#
+# Layout:
+#   {directory}/plans/{key[:2]}/{key}.json
+#   {directory}/statistics.jsonl
+#
+
+import os
+import typing
+import logging
+import argparse
+import hashlib
+import json
+import uuid
+import difflib
+
+import sequence_signature
+
+# Directory with the search plans, when not set the plans are not used.
+CONSERVATION_SEARCH_PLAN_DIR = os.environ.get("CONSERVATION_SEARCH_PLAN_DIR", None)
+
+# Change to invalidate all existing plans.
+PLAN_VERSION = 1
+
+# Minimum identity, in percent, of a sequence with the sequence of a plan
+# found under a band key.
+PLAN_MINIMUM_IDENTITY = 95
+
+# Minimum coverage, in percent, of both sequences by the aligned region.
+PLAN_MINIMUM_COVERAGE = 90
+
+STATISTICS_FILE = "statistics.jsonl"
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(description="Print search plan statistics.")
+    parser.add_argument(
+        "--directory",
+        default=CONSERVATION_SEARCH_PLAN_DIR,
+        help="Search plan directory.",
+    )
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    print(json.dumps(load_statistics(arguments["directory"]), indent=2))
+
+
+def plan_search(
+    directory: str, sequence: str, databases: typing.List[str], parameters: typing.Dict
+) -> typing.List[str]:
+    """Return databases that should be skipped for given sequence."""
+    plan, exact = _find_plan(directory, sequence, parameters)
+    if plan is None:
+        _add_statistics(directory, {"hit": False})
+        return []
+    # The last database is always searched, as we have no other option.
+    skip = [database for database in plan["failed"] if database in databases[:-1]]
+    saved_seconds = sum(plan["durations"].get(database, 0) for database in skip)
+    logging.info("Using search plan, skipping databases: %s", skip)
+    _add_statistics(
+        directory,
+        {
+            "hit": True,
+            "exact": exact,
+            "skipped": skip,
+            "saved_seconds": saved_seconds,
+        },
+    )
+    return skip
+
+
+def record_search(
+    directory: str,
+    sequence: str,
+    parameters: typing.Dict,
+    failed: typing.List[str],
+    durations: typing.Dict[str, float],
+):
+    """Record databases that did not provide enough sequences."""
+    previous, exact = _find_plan(directory, sequence, parameters)
+    if previous is not None and exact:
+        # Keep information about databases skipped in this search.
+        failed = list(dict.fromkeys(previous["failed"] + failed))
+        durations = {**previous["durations"], **durations}
+    plan = {
+        "version": PLAN_VERSION,
+        "sequence": sequence.upper(),
+        "failed": failed,
+        "durations": durations,
+    }
+    for key in _plan_keys(sequence, parameters):
+        _save_plan(directory, key, plan)
+
+
+def _find_plan(
+    directory: str, sequence: str, parameters: typing.Dict
+) -> typing.Tuple[typing.Optional[typing.Dict], bool]:
+    """Return plan and True if it was stored for the same sequence."""
+    for index, key in enumerate(_plan_keys(sequence, parameters)):
+        plan = _load_plan(directory, key)
+        if plan is None:
+            continue
+        if index == 0:
+            return plan, True
+        if _is_near_identical(sequence, plan.get("sequence", "")):
+            return plan, False
+    return None, False
+
+
+def _is_near_identical(sequence: str, other: str) -> bool:
+    """
+    Compare the sequences using matching blocks, return True when the
+    identity and coverage of both sequences are above the thresholds.
+    """
+    sequence, other = sequence.upper(), other.upper()
+    if len(sequence) == 0 or len(other) == 0:
+        return False
+    matcher = difflib.SequenceMatcher(None, sequence, other, autojunk=False)
+    blocks = [block for block in matcher.get_matching_blocks() if block.size > 0]
+    if len(blocks) == 0:
+        return False
+    identical = sum(block.size for block in blocks)
+    sequence_span = blocks[-1].a + blocks[-1].size - blocks[0].a
+    other_span = blocks[-1].b + blocks[-1].size - blocks[0].b
+    identity = 100.0 * identical / max(sequence_span, other_span)
+    coverage = 100.0 * min(sequence_span / len(sequence), other_span / len(other))
+    return identity >= PLAN_MINIMUM_IDENTITY and coverage >= PLAN_MINIMUM_COVERAGE
+
+
+def _plan_keys(sequence: str, parameters: typing.Dict) -> typing.List[str]:
+    """Return key for the sequence followed by keys for signature bands."""
+    sequence = sequence.upper()
+    serialized_parameters = json.dumps(parameters, sort_keys=True)
+    namespace = f"{PLAN_VERSION}:{serialized_parameters}"
+    return [
+        _hash(f"{namespace}:{sequence}"),
+        *sequence_signature.compute_band_keys(sequence, namespace),
+    ]
+
+
+def _hash(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def _plan_file(directory: str, key: str) -> str:
+    return os.path.join(directory, "plans", key[:2], key + ".json")
+
+
+def _load_plan(directory: str, key: str) -> typing.Optional[typing.Dict]:
+    try:
+        with open(_plan_file(directory, key), encoding="utf-8") as stream:
+            return json.load(stream)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _save_plan(directory: str, key: str, plan: typing.Dict):
+    plan_file = _plan_file(directory, key)
+    os.makedirs(os.path.dirname(plan_file), exist_ok=True)
+    # Write and rename, so readers never see partial file.
+    temp_file = plan_file + "." + str(uuid.uuid4())
+    with open(temp_file, "w", encoding="utf-8") as stream:
+        json.dump(plan, stream)
+    os.replace(temp_file, plan_file)
+
+
+def _add_statistics(directory: str, record: typing.Dict):
+    os.makedirs(directory, exist_ok=True)
+    # Short appends are atomic, so the file can be shared by processes.
+    with open(os.path.join(directory, STATISTICS_FILE), "a") as stream:
+        stream.write(json.dumps(record) + "\n")
+
+
+def load_statistics(directory: str) -> typing.Dict:
+    """Return number of lookups, hits, skipped searches and saved time."""
+    result = {
+        "lookups": 0,
+        "hits": 0,
+        "exact_hits": 0,
+        "misses": 0,
+        "skipped_searches": 0,
+        "saved_seconds": 0.0,
+    }
+    statistics_file = os.path.join(directory, STATISTICS_FILE)
+    if not os.path.exists(statistics_file):
+        return result
+    with open(statistics_file) as stream:
+        for line in stream:
+            record = json.loads(line)
+            result["lookups"] += 1
+            if not record["hit"]:
+                result["misses"] += 1
+                continue
+            result["hits"] += 1
+            if record["exact"]:
+                result["exact_hits"] += 1
+            result["skipped_searches"] += len(record["skipped"])
+            result["saved_seconds"] += record["saved_seconds"]
+    return result
+
+
+if __name__ == "__main__":
+    main(_read_arguments())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# MinHash signatures of protein sequences.
+#
+# The signature is computed from sequence k-mers and split into bands,
+# sequences sharing a band are likely to be near-identical. Band keys
+# are used to find near-identical sequences without comparing them
+# to all stored sequences.
+#
+
+import typing
+import hashlib
+
+# Length of k-mers used for the signature.
+SIGNATURE_KMER_SIZE = 5
+
+# Number of MinHash values in the signature.
+SIGNATURE_SIZE = 12
+
+# Number of MinHash values in one band, sequences with same values
+# in any band are considered near-identical.
+SIGNATURE_BAND_SIZE = 3
+
+
+def compute_band_keys(sequence: str, namespace: str) -> typing.List[str]:
+    """Return key for every band of the sequence signature."""
+    signature = compute_signature(sequence.upper())
+    result = []
+    for start in range(0, len(signature), SIGNATURE_BAND_SIZE):
+        band = signature[start : start + SIGNATURE_BAND_SIZE]
+        value = f"{namespace}:{start}:{band}"
+        result.append(hashlib.sha256(value.encode("utf-8")).hexdigest())
+    return result
+
+
+def compute_signature(sequence: str) -> typing.List[int]:
+    """MinHash of sequence k-mers."""
+    kmers = {
+        sequence[index : index + SIGNATURE_KMER_SIZE]
+        for index in range(len(sequence) - SIGNATURE_KMER_SIZE + 1)
+    }
+    if len(kmers) == 0:
+        kmers = {sequence}
+    return [
+        min(
+            int.from_bytes(
+                hashlib.blake2b(
+                    kmer.encode("ascii"), digest_size=8, salt=bytes([seed])
+                ).digest(),
+                "little",
+            )
+            for kmer in kmers
+        )
+        for seed in range(SIGNATURE_SIZE)
+    ]
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Local store of database sequences used instead of blastdbcmd.
+#
+# The store is built once from FASTA content of a database. Records are
+# packed into a single file in the same format as produced by blastdbcmd,
+# the index maps hash of identifier to position of the record. All files
+# are memory-mapped, so retrieval is a binary search and a memory read.
+#
+# Layout:
+#   {store}/{database}/sequences.fasta
+#   {store}/{database}/keys.npy      - sorted identifier hashes
+#   {store}/{database}/offsets.npy   - record offsets, in order of keys
+#   {store}/{database}/sizes.npy     - record sizes, in order of keys
+#
+# Build the store from existing BLAST database:
+#   python3 sequence_store.py --database uniref90
+#
+
+import os
+import typing
+import logging
+import argparse
+import subprocess
+import collections
+import array
+import hashlib
+import gzip
+import mmap
+import shutil
+import uuid
+
+import numpy
+
+import fasta
+
+BLASTDBCMD_CMD = os.environ.get("BLASTDBCMD_CMD", None)
+
+# Directory with the stores, when not set the stores are not used.
+# Versioned databases use stores in their version directory, see
+# database_manager, for them the directory only enables the stores.
+SEQUENCE_STORE_DIR = os.environ.get("SEQUENCE_STORE_DIR", None)
+
+SEQUENCES_FILE = "sequences.fasta"
+
+KEYS_FILE = "keys.npy"
+
+OFFSETS_FILE = "offsets.npy"
+
+SIZES_FILE = "sizes.npy"
+
+# Number of index entries kept in memory before they are written to disk.
+INDEX_BUFFER_SIZE = 1024 * 1024
+
+SequenceStore = collections.namedtuple(
+    "SequenceStore", ["sequences", "keys", "offsets", "sizes"]
+)
+
+# Opened stores, the memory maps are shared by all searches in a process.
+_stores: typing.Dict[str, SequenceStore] = {}
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(
+        description="Build sequence store for a BLAST database."
+    )
+    parser.add_argument("--database", required=True, help="Database name.")
+    parser.add_argument(
+        "--input",
+        help="FASTA file, can be gzipped. When not set the content "
+        "is read from the BLAST database using blastdbcmd.",
+    )
+    parser.add_argument(
+        "--store", default=SEQUENCE_STORE_DIR, help="Sequence store directory."
+    )
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+    )
+    if arguments["store"] is None:
+        raise Exception("Missing sequence store directory.")
+    if arguments["input"] is not None:
+        build_store_from_file(
+            arguments["store"], arguments["database"], arguments["input"]
+        )
+    else:
+        build_store_from_database(arguments["store"], arguments["database"])
+
+
+# region Build
+
+
+def build_store_from_database(
+    store_dir: str, database: str, source: typing.Optional[str] = None
+):
+    """
+    Build the store using all sequences in the BLAST database, the source
+    is path to the BLAST database when it is not the database name.
+    """
+    command = [BLASTDBCMD_CMD, "-db", source or database, "-entry", "all"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, env=os.environ.copy())
+    try:
+        build_store(store_dir, database, process.stdout)
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        shutil.rmtree(_store_directory(store_dir, database), ignore_errors=True)
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def build_store_from_file(store_dir: str, database: str, input_file: str):
+    if input_file.endswith(".gz"):
+        with gzip.open(input_file, "rb") as in_stream:
+            build_store(store_dir, database, in_stream)
+    else:
+        with open(input_file, "rb") as in_stream:
+            build_store(store_dir, database, in_stream)
+
+
+def build_store(store_dir: str, database: str, in_stream: typing.BinaryIO):
+    """Build the store from FASTA content, existing store is replaced."""
+    logging.info("Building sequence store for '%s' ...", database)
+    temp_dir = os.path.join(store_dir, "tmp-" + str(uuid.uuid4()))
+    os.makedirs(temp_dir)
+    # Index columns are collected in small buffers and written to disk,
+    # as there can be hundreds of millions of records.
+    columns = [
+        (array.array("Q"), KEYS_FILE, numpy.uint64),
+        (array.array("Q"), OFFSETS_FILE, numpy.uint64),
+        (array.array("I"), SIZES_FILE, numpy.uint32),
+    ]
+    column_streams = [
+        open(_column_file(temp_dir, file_name), "wb") for _, file_name, _ in columns
+    ]
+    keys, offsets, sizes = [buffer for buffer, _, _ in columns]
+    count = 0
+    position = 0
+    try:
+        with open(os.path.join(temp_dir, SEQUENCES_FILE), "wb") as out_stream:
+            for header, sequence in fasta.read_fasta_stream(in_stream):
+                record = fasta.format_fasta_sequence(header, sequence).encode("utf-8")
+                out_stream.write(record)
+                keys.append(_hash_identifier(header.split(maxsplit=1)[0]))
+                offsets.append(position)
+                sizes.append(len(record))
+                position += len(record)
+                count += 1
+                if len(keys) >= INDEX_BUFFER_SIZE:
+                    _flush_columns(columns, column_streams)
+        _flush_columns(columns, column_streams)
+    finally:
+        for stream in column_streams:
+            stream.close()
+    _sort_columns(temp_dir, columns)
+    # Replace the old store.
+    target_dir = _store_directory(store_dir, database)
+    if os.path.exists(target_dir):
+        trash_dir = os.path.join(store_dir, "tmp-" + str(uuid.uuid4()))
+        os.rename(target_dir, trash_dir)
+        shutil.rmtree(trash_dir)
+    os.rename(temp_dir, target_dir)
+    logging.info("Sequence store contains %s sequences.", count)
+
+
+def _column_file(directory: str, file_name: str) -> str:
+    return os.path.join(directory, file_name + ".raw")
+
+
+def _flush_columns(columns, streams: typing.List[typing.BinaryIO]):
+    for (buffer, _, _), stream in zip(columns, streams):
+        buffer.tofile(stream)
+        del buffer[:]
+
+
+def _sort_columns(directory: str, columns):
+    """Sort the raw index columns by keys, and save them as numpy arrays."""
+    keys_file = _column_file(directory, KEYS_FILE)
+    keys = numpy.fromfile(keys_file, dtype=numpy.uint64)
+    order = numpy.argsort(keys, kind="stable")
+    del keys
+    # Load one column at a time to keep the memory usage low.
+    for _, file_name, dtype in columns:
+        raw_file = _column_file(directory, file_name)
+        column = numpy.fromfile(raw_file, dtype=dtype)
+        numpy.save(os.path.join(directory, file_name), column[order])
+        del column
+        os.remove(raw_file)
+
+
+# endregion
+
+# region Retrieve
+
+
+def retrieve_sequences(
+    store_dir: str, database: str, input_file: str, output_file: str
+) -> bool:
+    """
+    Write sequences for identifiers in the input file to the output file.
+    Return False, and write nothing, when the store is not available or
+    some of the sequences are not in the store.
+    """
+    store = open_store(store_dir, database)
+    if store is None:
+        return False
+    with open(input_file) as in_stream:
+        identifiers = [line.strip() for line in in_stream if len(line.strip()) > 0]
+    positions = _find_records(store, identifiers)
+    if positions is None:
+        return False
+    sequences = memoryview(store.sequences)
+    with open(output_file, "wb") as out_stream:
+        for offset, size in positions:
+            out_stream.write(sequences[offset : offset + size])
+    sequences.release()
+    logging.info("Retrieved %s sequences from the store.", len(positions))
+    return True
+
+
+def open_store(store_dir: str, database: str) -> typing.Optional[SequenceStore]:
+    directory = _store_directory(store_dir, database)
+    if directory in _stores:
+        return _stores[directory]
+    if not os.path.exists(os.path.join(directory, SIZES_FILE)):
+        return None
+    with open(os.path.join(directory, SEQUENCES_FILE), "rb") as stream:
+        sequences = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    result = SequenceStore(
+        sequences,
+        numpy.load(os.path.join(directory, KEYS_FILE), mmap_mode="r"),
+        numpy.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r"),
+        numpy.load(os.path.join(directory, SIZES_FILE), mmap_mode="r"),
+    )
+    _stores[directory] = result
+    return result
+
+
+def _find_records(
+    store: SequenceStore, identifiers: typing.List[str]
+) -> typing.Optional[typing.List[typing.Tuple[int, int]]]:
+    """Return offset and size for each identifier, None if any is missing."""
+    identifiers = [fasta.normalize_identifier(identifier) for identifier in identifiers]
+    keys = numpy.array(
+        [_hash_identifier(identifier) for identifier in identifiers],
+        dtype=numpy.uint64,
+    )
+    indices = numpy.searchsorted(store.keys, keys)
+    result = []
+    for identifier, key, index in zip(identifiers, keys, indices):
+        # There can be more records with the same hash.
+        while index < len(store.keys) and store.keys[index] == key:
+            offset = int(store.offsets[index])
+            size = int(store.sizes[index])
+            if _record_identifier(store, offset, size) == identifier:
+                result.append((offset, size))
+                break
+            index += 1
+        else:
+            logging.info("Missing '%s' in the sequence store.", identifier)
+            return None
+    return result
+
+
+def _record_identifier(store: SequenceStore, offset: int, size: int) -> str:
+    end = store.sequences.find(b"\n", offset, offset + size)
+    return store.sequences[offset + 1 : end].split(maxsplit=1)[0].decode("utf-8")
+
+
+def _hash_identifier(identifier: str) -> int:
+    digest = hashlib.blake2b(identifier.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _store_directory(store_dir: str, database: str) -> str:
+    return os.path.join(store_dir, database)
+
+
+# endregion
+
+if __name__ == "__main__":
+    main(_read_arguments())
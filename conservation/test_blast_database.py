@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for detection of available databases, the search space used to
+# search database volumes and building databases from a local file://
+# mirror. makeblastdb is replaced by a function creating the database
+# files with the input sequences.
+#
+
+import os
+import gzip
+import hashlib
+import math
+import shlex
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import blast_database
+import conservation
+import conservation_cache
+import database_manager
+
+
+class TestBlastDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = unittest.mock.patch.object(blast_database, "BLASTDB", self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_volume(self, base_name: str):
+        for extension in blast_database.DATABASE_FILE_EXTENSIONS:
+            open(os.path.join(self.directory, base_name + extension), "w").close()
+
+    def test_database_with_split_shards_is_available(self):
+        # Shard 00 split by makeblastdb into volumes with an alias file.
+        self._create_volume("uniref50.00.00")
+        self._create_volume("uniref50.00.01")
+        open(os.path.join(self.directory, "uniref50.00.pal"), "w").close()
+        self._create_volume("uniref50.01")
+        self.assertTrue(blast_database.is_database_available("uniref50"))
+        self.assertIn("uniref50", blast_database.get_available_databases())
+        self.assertEqual(
+            ["uniref50.00", "uniref50.01"],
+            blast_database.get_database_volumes("uniref50"),
+        )
+        self.assertFalse(blast_database.is_database_available("uniref90"))
+
+    def test_length_adjustment_is_largest_fixed_point(self):
+        lambda_, k, alpha, beta = blast_database.BLOSUM62_GAPPED_PARAMETERS
+
+        def expected_adjustment(query_length, residues, sequences, ell):
+            search_space = (query_length - ell) * (residues - sequences * ell)
+            return alpha / lambda_ * (math.log(k) + math.log(search_space)) + beta
+
+        for query_length, residues, sequences in [
+            (300, 100_000_000, 300_000),
+            (850, 20_000_000_000, 50_000_000),
+            (1500, 200_000_000, 560_000),
+        ]:
+            with self.subTest(query_length=query_length, residues=residues):
+                ell = blast_database._compute_length_adjustment(
+                    query_length, residues, sequences
+                )
+                arguments = (query_length, residues, sequences)
+                self.assertLessEqual(ell, expected_adjustment(*arguments, ell))
+                self.assertGreater(ell + 1, expected_adjustment(*arguments, ell + 1))
+                size = blast_database.DatabaseSize(sequences, residues)
+                self.assertEqual(
+                    (query_length - ell) * (residues - sequences * ell),
+                    blast_database.compute_search_space(query_length, size),
+                )
+
+    def test_length_adjustment_is_limited_for_short_query(self):
+        # Search space must stay large enough for the E-value to make sense.
+        ell = blast_database._compute_length_adjustment(120, 200_000_000, 560_000)
+        self.assertEqual(87, ell)
+
+    def test_length_adjustment_for_small_database(self):
+        size = blast_database.DatabaseSize(1, 10)
+        self.assertEqual(100, blast_database.compute_search_space(10, size))
+
+
+FASTA_CONTENT = b"".join(
+    f">sp|P{index:05d}|TEST\n{'MKVLA' * (index + 1)}\n".encode("ascii")
+    for index in range(10)
+)
+
+
+class TestBuildDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.blastdb = os.path.join(self.directory, "blastdb")
+        os.makedirs(self.blastdb)
+        self.mirror = os.path.join(self.directory, "mirror")
+        os.makedirs(self.mirror)
+        self.archive = os.path.join(self.mirror, "uniprot_sprot.fasta.gz")
+        with gzip.open(self.archive, "wb") as stream:
+            stream.write(FASTA_CONTENT)
+        self._write_checksum(self.archive)
+        self.commands = []
+        for name, value in [
+            ("BLASTDB", self.blastdb),
+            ("BLASTDB_MIRROR", "file://" + self.mirror),
+            ("BLASTDMAKEDB_CMD", "makeblastdb"),
+            ("BLASTDB_SHARDS", 1),
+        ]:
+            patcher = unittest.mock.patch.object(blast_database, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _write_checksum(self, file: str, checksum: str = None):
+        if checksum is None:
+            with open(file, "rb") as stream:
+                checksum = hashlib.md5(stream.read()).hexdigest()
+        with open(file + ".md5", "w") as stream:
+            stream.write(f"{checksum}  {os.path.basename(file)}\n")
+
+    def _execute_command(self, command: str):
+        """Replacement of makeblastdb, database files contain the input."""
+        self.commands.append(command)
+        arguments = shlex.split(command.split("|")[-1])
+        output = arguments[arguments.index("-out") + 1]
+        if "-in" in arguments:
+            with open(arguments[arguments.index("-in") + 1], "rb") as stream:
+                content = stream.read()
+        else:
+            with gzip.open(command.split()[2], "rb") as stream:
+                content = stream.read()
+        for extension in blast_database.DATABASE_FILE_EXTENSIONS:
+            with open(output + extension, "wb") as stream:
+                stream.write(content)
+
+    def _build(self):
+        return blast_database.build_databases(self._execute_command, ["swissprot"])
+
+    def test_resume_download(self):
+        url = blast_database.get_database_url("swissprot")
+        target = os.path.join(self.directory, "download.gz")
+        with open(self.archive, "rb") as stream:
+            content = stream.read()
+        with open(target + ".part", "wb") as stream:
+            stream.write(content[:20])
+        downloaded = blast_database._download(url, target)
+        self.assertEqual(len(content) - 20, downloaded)
+        with open(target, "rb") as stream:
+            self.assertEqual(content, stream.read())
+        self.assertFalse(os.path.exists(target + ".part"))
+
+    def test_checksum_mismatch(self):
+        self._write_checksum(self.archive, "0" * 32)
+        with self.assertRaisesRegex(Exception, "Checksum mismatch"):
+            self._build()
+        self.assertFalse(blast_database.is_database_available("swissprot"))
+        # The archive is removed, so it is downloaded again.
+        build_dir = os.path.join(self.blastdb, "build", "swissprot")
+        self.assertNotIn("uniprot_sprot.fasta.gz", os.listdir(build_dir))
+        self._write_checksum(self.archive)
+        report = self._build()
+        self.assertIn("download", report["swissprot"])
+        self.assertTrue(blast_database.is_database_available("swissprot"))
+
+    def test_continue_interrupted_build(self):
+        def fail(command: str):
+            raise Exception("Interrupted.")
+
+        with self.assertRaisesRegex(Exception, "Interrupted"):
+            blast_database.build_databases(fail, ["swissprot"])
+        # Download and verification are not repeated.
+        report = self._build()
+        self.assertEqual(["format"], list(report["swissprot"].keys()))
+        self.assertTrue(blast_database.is_database_available("swissprot"))
+
+    def test_versioned_database(self):
+        prepared = []
+
+        def prepare_version(name: str, version_dir: str):
+            prepared.append((name, version_dir, blast_database.resolve_database(name)))
+
+        config = conservation.ConservationConfiguration()
+        config.blast_databases = ["swissprot"]
+        key = conservation_cache.create_key("MKVLA", config)
+        database_manager.build_versions(
+            self._execute_command, ["swissprot"], prepare_version
+        )
+        # Version is prepared before it is activated.
+        [(name, version_dir, resolved)] = prepared
+        self.assertEqual("swissprot", name)
+        self.assertEqual("swissprot", resolved)
+        database = blast_database.resolve_database("swissprot")
+        self.assertEqual(os.path.join(os.path.realpath(version_dir), name), database)
+        self.assertEqual([database], blast_database.get_database_volumes(database))
+        version = os.path.basename(version_dir)
+        self.assertEqual(version, blast_database.get_database_version(database))
+        self.assertEqual(
+            os.path.realpath(version_dir),
+            database_manager.get_version_directory("swissprot"),
+        )
+        # Results computed for other versions are not used.
+        config = conservation.ConservationConfiguration()
+        config.blast_databases = ["swissprot"]
+        self.assertEqual(
+            {"swissprot": version}, conservation.get_database_versions(config)
+        )
+        self.assertNotEqual(key, conservation_cache.create_key("MKVLA", config))
+
+    def test_manifest_is_reloaded_when_replaced(self):
+        self.assertIsNone(database_manager.load_manifest())
+        database_manager.build_versions(self._execute_command, ["swissprot"])
+        [first] = database_manager.list_versions("swissprot")
+        manifest = database_manager.load_manifest()
+        self.assertEqual(first, manifest["databases"]["swissprot"]["version"])
+        # Another process activates a new version.
+        second = first + "-next"
+        shutil.copytree(
+            os.path.join(
+                self.blastdb, database_manager.VERSIONS_DIR, "swissprot", first
+            ),
+            os.path.join(
+                self.blastdb, database_manager.VERSIONS_DIR, "swissprot", second
+            ),
+        )
+        database_manager.activate_version("swissprot", second)
+        manifest = database_manager.load_manifest()
+        self.assertEqual(second, manifest["databases"]["swissprot"]["version"])
+
+    def test_skip_unchanged_database(self):
+        self.assertEqual(
+            ["swissprot"], blast_database.get_changed_databases(["swissprot"])
+        )
+        self._build()
+        self.assertEqual(1, len(self.commands))
+        self.assertEqual([], blast_database.get_changed_databases(["swissprot"]))
+        with gzip.open(self.archive, "wb") as stream:
+            stream.write(FASTA_CONTENT + b">sp|P99999|TEST\nMKV\n")
+        self._write_checksum(self.archive)
+        self.assertEqual(
+            ["swissprot"], blast_database.get_changed_databases(["swissprot"])
+        )
+
+    def test_sharded_database(self):
+        with unittest.mock.patch.object(blast_database, "BLASTDB_SHARDS", 3):
+            self._build()
+        self.assertEqual(3, len(self.commands))
+        with open(os.path.join(self.blastdb, "swissprot.pal")) as stream:
+            self.assertEqual(
+                "TITLE swissprot\nDBLIST swissprot.00 swissprot.01 swissprot.02\n",
+                stream.read(),
+            )
+        records = []
+        for index in range(3):
+            with open(
+                os.path.join(self.blastdb, f"swissprot.{index:02d}.psq"), "rb"
+            ) as stream:
+                content = stream.read()
+            self.assertGreater(len(content), 0)
+            records.extend(">" + record for record in content.decode().split(">")[1:])
+        # Every sequence is in exactly one shard.
+        expected = [">" + record for record in FASTA_CONTENT.decode().split(">")[1:]]
+        self.assertEqual(sorted(expected), sorted(records))
+        self.assertTrue(blast_database.is_database_available("swissprot"))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.blastdb, "build", "swissprot"))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for conservation_cache, entries must be restored as stored and
+# eviction must leave no references to evicted entries.
+#
+
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import conservation
+import conservation_cache
+
+SYMBOLS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def _create_configuration(databases=None) -> conservation.ConservationConfiguration:
+    result = conservation.ConservationConfiguration()
+    result.blast_databases = databases or ["swissprot"]
+    return result
+
+
+def _read(path: str) -> str:
+    with open(path) as stream:
+        return stream.read()
+
+
+class TestConservationCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache_dir = os.path.join(self.directory, "cache")
+        self.config = _create_configuration()
+        self.generator = random.Random(3)
+
+    def _random_sequence(self, length: int = 100) -> str:
+        return "".join(self.generator.choice(SYMBOLS) for _ in range(length))
+
+    def _write_files(self, name: str, size: int = 100):
+        score_file = os.path.join(self.directory, name + ".score")
+        msa_file = os.path.join(self.directory, name + ".fasta")
+        with open(score_file, "w") as stream:
+            stream.write(f"score {name}\n".ljust(size, "-"))
+        with open(msa_file, "w") as stream:
+            stream.write(f">{name}\nMKV\n".ljust(size, "-"))
+        return score_file, msa_file
+
+    def _store(self, sequence: str, size_limit: int = 1024 * 1024) -> str:
+        key = conservation_cache.create_key(sequence, self.config)
+        score_file, msa_file = self._write_files(key[:8])
+        conservation_cache.store(self.cache_dir, key, score_file, msa_file, size_limit)
+        conservation_cache.add_sequence(self.cache_dir, key, sequence, self.config)
+        return key
+
+    def _list_temporary(self):
+        return os.listdir(os.path.join(self.cache_dir, "tmp"))
+
+    def _list_index_keys(self):
+        result = set()
+        for root, _, file_names in os.walk(os.path.join(self.cache_dir, "similar")):
+            for file_name in file_names:
+                result.update(_read(os.path.join(root, file_name)).split())
+        return result
+
+    def test_key(self):
+        key = conservation_cache.create_key("MKVLA", self.config)
+        self.assertEqual(key, conservation_cache.create_key("mkvla", self.config))
+        self.assertNotEqual(key, conservation_cache.create_key("MKVLG", self.config))
+        other = _create_configuration(["uniref50"])
+        self.assertNotEqual(key, conservation_cache.create_key("MKVLA", other))
+        other = _create_configuration()
+        other.msa_maximum_sequences = self.config.msa_maximum_sequences + 1
+        self.assertNotEqual(key, conservation_cache.create_key("MKVLA", other))
+        with unittest.mock.patch.object(
+            conservation, "get_database_versions", return_value={"swissprot": "2"}
+        ):
+            versioned = conservation_cache.create_key("MKVLA", self.config)
+        self.assertNotEqual(key, versioned)
+
+    def test_store_and_load(self):
+        sequence = self._random_sequence()
+        key = self._store(sequence)
+        score_file = os.path.join(self.directory, "loaded.score")
+        msa_file = os.path.join(self.directory, "loaded.fasta")
+        self.assertTrue(conservation_cache.contains(self.cache_dir, key))
+        self.assertTrue(
+            conservation_cache.load(self.cache_dir, key, score_file, msa_file)
+        )
+        self.assertEqual(
+            _read(os.path.join(self.directory, key[:8] + ".score")), _read(score_file)
+        )
+        self.assertEqual(
+            _read(os.path.join(self.directory, key[:8] + ".fasta")), _read(msa_file)
+        )
+        self.assertEqual(
+            [(key, sequence)],
+            conservation_cache.find_similar(self.cache_dir, sequence, self.config),
+        )
+        self.assertEqual([], self._list_temporary())
+
+    def test_miss(self):
+        self._store(self._random_sequence())
+        key = conservation_cache.create_key(self._random_sequence(), self.config)
+        score_file = os.path.join(self.directory, "loaded.score")
+        self.assertFalse(conservation_cache.contains(self.cache_dir, key))
+        self.assertFalse(conservation_cache.load(self.cache_dir, key, score_file, None))
+        self.assertFalse(os.path.exists(score_file))
+
+    def test_evict_least_recently_used(self):
+        sequences = [self._random_sequence() for _ in range(3)]
+        keys = []
+        for index, sequence in enumerate(sequences):
+            keys.append(self._store(sequence))
+            entry_dir = conservation_cache._entry_directory(self.cache_dir, keys[-1])
+            used = time.time() - 100 + index
+            os.utime(entry_dir, (used, used))
+        # Use the oldest entry, so the second one is evicted.
+        conservation_cache.load(
+            self.cache_dir, keys[0], os.path.join(self.directory, "used"), None
+        )
+        # Each entry has score, MSA, info and sequence files.
+        conservation_cache.evict(self.cache_dir, size_limit=2 * 400 + 200)
+        self.assertTrue(conservation_cache.contains(self.cache_dir, keys[0]))
+        self.assertFalse(conservation_cache.contains(self.cache_dir, keys[1]))
+        self.assertTrue(conservation_cache.contains(self.cache_dir, keys[2]))
+        # Index has no lines for the evicted entry.
+        self.assertEqual({keys[0], keys[2]}, self._list_index_keys())
+        self.assertEqual(
+            [],
+            conservation_cache.find_similar(self.cache_dir, sequences[1], self.config),
+        )
+        self.assertEqual([], self._list_temporary())
+
+    def test_evict_stale_temporary_directories(self):
+        self._store(self._random_sequence())
+        temp_root = os.path.join(self.cache_dir, "tmp")
+        stale_dir = os.path.join(temp_root, "stale")
+        recent_dir = os.path.join(temp_root, "recent")
+        for directory in [stale_dir, recent_dir]:
+            os.makedirs(directory)
+            with open(os.path.join(directory, "conservation.score"), "w") as stream:
+                stream.write("partial")
+        two_days_ago = time.time() - 2 * 24 * 3600
+        os.utime(stale_dir, (two_days_ago, two_days_ago))
+        conservation_cache.evict(self.cache_dir, size_limit=1024 * 1024)
+        self.assertEqual(["recent"], self._list_temporary())
+
+    def test_concurrent_store(self):
+        sequence = self._random_sequence()
+        key = conservation_cache.create_key(sequence, self.config)
+        files = [self._write_files(f"writer-{index}") for index in range(8)]
+        barrier = threading.Barrier(len(files))
+
+        def store(score_file, msa_file):
+            barrier.wait()
+            conservation_cache.store(
+                self.cache_dir, key, score_file, msa_file, 1024 * 1024
+            )
+            conservation_cache.add_sequence(self.cache_dir, key, sequence, self.config)
+
+        threads = [threading.Thread(target=store, args=item) for item in files]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        entry_dir = conservation_cache._entry_directory(self.cache_dir, key)
+        stored = _read(os.path.join(entry_dir, conservation_cache.SCORE_FILE))
+        # The entry is one complete write.
+        self.assertIn(stored, [_read(score_file) for score_file, _ in files])
+        self.assertEqual([], self._list_temporary())
+        self.assertEqual({key}, self._list_index_keys())
+
+
+if __name__ == "__main__":
+    unittest.main()
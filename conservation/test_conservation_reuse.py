@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for conservation_reuse, conservation of a cached sequence is used
+# for near-identical sequences only.
+#
+
+import os
+import json
+import random
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import conservation
+import conservation_cache
+import conservation_reuse
+import fasta
+
+SYMBOLS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def _create_configuration() -> conservation.ConservationConfiguration:
+    result = conservation.ConservationConfiguration()
+    result.blast_databases = ["swissprot"]
+    return result
+
+
+def _read_score_lines(score_file: str):
+    with open(score_file) as stream:
+        return [
+            line.rstrip("\n").split("\t")
+            for line in stream
+            if not line.startswith("#") and len(line.strip()) > 0
+        ]
+
+
+def _read_provenance(score_file: str):
+    with open(score_file) as stream:
+        for line in stream:
+            if line.startswith("# reused: "):
+                return json.loads(line[len("# reused: ") :])
+    return None
+
+
+class TestConservationReuse(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache_dir = os.path.join(self.directory, "cache")
+        self.config = _create_configuration()
+        generator = random.Random(7)
+        self.sequence = "".join(generator.choice(SYMBOLS) for _ in range(100))
+        # The cached sequence has a gap in column 10, so the columns are
+        # not the residue positions.
+        self.cached_row = self.sequence[:10] + "-" + self.sequence[10:]
+        self.rows = [self.cached_row] + [
+            "".join(
+                generator.choice(SYMBOLS) if generator.random() < 0.3 else residue
+                for residue in self.sequence[:10] + "W" + self.sequence[10:]
+            )
+            for _ in range(5)
+        ]
+        self._store_entry()
+
+    def _store_entry(self):
+        entry_dir = os.path.join(self.directory, "entry")
+        os.makedirs(entry_dir)
+        msa_file = os.path.join(entry_dir, "msa")
+        with open(msa_file, "w", newline="\n") as stream:
+            for index, row in enumerate(self.rows):
+                stream.write(fasta.format_fasta_sequence(f"sequence-{index}", row, 60))
+        score_file = os.path.join(entry_dir, "score")
+        conservation.compute_jensen_shannon_divergence(msa_file, score_file)
+        self.cached_scores = _read_score_lines(score_file)
+        key = conservation_cache.create_key(self.sequence, self.config)
+        conservation_cache.store(self.cache_dir, key, score_file, msa_file, 1024 * 1024)
+        conservation_cache.add_sequence(self.cache_dir, key, self.sequence, self.config)
+        self.key = key
+
+    def _reuse(self, sequence: str, name: str):
+        # The cached sequence must be a candidate, else nothing is tested.
+        similar = conservation_cache.find_similar(self.cache_dir, sequence, self.config)
+        self.assertEqual([self.key], [key for key, _ in similar])
+        working_dir = os.path.join(self.directory, name)
+        os.makedirs(working_dir)
+        input_file = os.path.join(working_dir, "input.fasta")
+        fasta.save_sequence_to_fasta("query", sequence, input_file)
+        output_file = os.path.join(working_dir, "output.score")
+        msa_file = conservation_reuse.reuse_conservation(
+            self.cache_dir, input_file, working_dir, output_file, self.config
+        )
+        return msa_file, output_file
+
+    def test_projection_selects_columns_and_scores(self):
+        start, end = 5, 97
+        msa_file, output_file = self._reuse(self.sequence[start:end], "projection")
+        self.assertIsNotNone(msa_file)
+        # Residue 5 is in column 5, residue 96 is in column 97.
+        first_column, last_column = start, end + 1
+        rows = [row for _, row in fasta.read_fasta_file(msa_file)]
+        self.assertEqual([row[first_column:last_column] for row in self.rows], rows)
+        scores = _read_score_lines(output_file)
+        self.assertEqual(last_column - first_column, len(scores))
+        for index, (score, cached) in enumerate(
+            zip(scores, self.cached_scores[first_column:last_column])
+        ):
+            self.assertEqual([str(index), cached[1], cached[2]], score)
+        self.assertEqual(
+            {
+                "method": "projection",
+                "identity": 100.0,
+                "coverage": 92.0,
+                "source": self.key,
+            },
+            _read_provenance(output_file),
+        )
+
+    def test_projection_below_coverage_is_rejected(self):
+        msa_file, output_file = self._reuse(self.sequence[10:80], "fragment")
+        self.assertIsNone(msa_file)
+        self.assertFalse(os.path.exists(output_file))
+
+    def test_profile_below_identity_is_rejected(self):
+        mutant = self.sequence[:50] + "W" + self.sequence[51:]
+        with unittest.mock.patch.object(
+            conservation_reuse, "_align_to_cached_msa", return_value=(90.0, 100.0)
+        ):
+            msa_file, output_file = self._reuse(mutant, "profile")
+        self.assertIsNone(msa_file)
+        self.assertFalse(os.path.exists(output_file))
+
+    def test_coverage_is_relative_to_longer_sequence(self):
+        identity, coverage = conservation_reuse._compute_identity_and_coverage(
+            "--MKVLA--", "AAMKVLAGG"
+        )
+        self.assertEqual(100.0, identity)
+        self.assertAlmostEqual(100.0 * 5 / 9, coverage)
+
+
+if __name__ == "__main__":
+    unittest.main()
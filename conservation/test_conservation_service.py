@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for conservation_service, PSI-BLAST is replaced by a function
+# writing the query sequence as the search result.
+#
+
+import os
+import typing
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import multiprocessing.connection
+
+import conservation
+import conservation_service
+import fasta
+
+
+class FakeSearch:
+    """Replacement of conservation.search_in_batch recording the calls."""
+
+    def __init__(self, duration: float = 0):
+        self.duration = duration
+        self.calls = []
+        self.database_paths = []
+        self.running = 0
+        self.maximum_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, fasta_files, working_dir, config):
+        with self.lock:
+            self.calls.append(sorted(fasta_files.keys()))
+            self.database_paths.append(config.database_paths)
+            self.running += 1
+            self.maximum_running = max(self.maximum_running, self.running)
+        time.sleep(self.duration)
+        result = {}
+        for query, fasta_file in fasta_files.items():
+            sequence = fasta.read_fasta_file(fasta_file)[0][1]
+            result[query] = {}
+            for database in config.blast_databases:
+                output_file = os.path.join(working_dir, f"{query}-{database}")
+                with open(output_file, "w") as stream:
+                    stream.write(f"{database}\t{sequence}\n")
+                result[query][database] = output_file
+        with self.lock:
+            self.running -= 1
+        return result
+
+
+def _create_configuration(
+    databases, version: typing.Optional[str] = None
+) -> conservation.ConservationConfiguration:
+    result = conservation.ConservationConfiguration()
+    result.blast_databases = databases
+    if version is not None:
+        # As resolved by the task for a versioned database.
+        result.database_paths = {
+            database: f"/blast/versions/{version}/{database}" for database in databases
+        }
+    return result
+
+
+class TestConservationService(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.socket = os.path.join(self.directory, "service.socket")
+
+    def _start_service(self, search: FakeSearch, window: float, workers: int = 2):
+        patcher = unittest.mock.patch.object(conservation, "search_in_batch", search)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        service_dir = os.path.join(self.directory, "service")
+        os.makedirs(service_dir)
+        listener = multiprocessing.connection.Listener(self.socket, family="AF_UNIX")
+        self.addCleanup(listener.close)
+        threading.Thread(
+            target=conservation_service.serve_listener,
+            args=(listener, service_dir, window, None, workers),
+            daemon=True,
+        ).start()
+        return service_dir
+
+    def _search_concurrently(self, requests):
+        """
+        Search for all (sequence, databases[, version]) at once,
+        return results.
+        """
+        results = [None] * len(requests)
+
+        def search(index, sequence, databases, version=None):
+            working_dir = os.path.join(self.directory, f"task-{index}")
+            os.makedirs(working_dir)
+            input_file = os.path.join(working_dir, "input.fasta")
+            fasta.save_sequence_to_fasta("query", sequence, input_file)
+            results[index] = conservation_service.search(
+                input_file,
+                working_dir,
+                _create_configuration(databases, version),
+                self.socket,
+                timeout=5,
+            )
+
+        threads = [
+            threading.Thread(target=search, args=(index, *request))
+            for index, request in enumerate(requests)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce_and_route_results(self):
+        search = FakeSearch()
+        service_dir = self._start_service(search, window=0.5)
+        sequences = ["MKVLA", "GGHHK", "MKVLA"]
+        results = self._search_concurrently(
+            [(sequence, ["swissprot", "uniref50"]) for sequence in sequences]
+        )
+        # One search with distinct sequences only.
+        self.assertEqual([["query_0", "query_1"]], search.calls)
+        for index, (sequence, result) in enumerate(zip(sequences, results)):
+            self.assertEqual(["swissprot", "uniref50"], sorted(result.keys()))
+            for database, file in result.items():
+                task_dir = os.path.join(self.directory, f"task-{index}")
+                self.assertEqual(task_dir, os.path.dirname(file))
+                with open(file) as stream:
+                    self.assertEqual(f"{database}\t{sequence}\n", stream.read())
+        # Results are removed from the service once copied.
+        time.sleep(0.2)
+        results_dir = os.path.join(service_dir, conservation_service.RESULTS_DIR)
+        self.assertEqual([], os.listdir(results_dir))
+
+    def test_search_groups_in_parallel(self):
+        search = FakeSearch(duration=0.5)
+        self._start_service(search, window=0.2)
+        results = self._search_concurrently(
+            [("MKVLA", ["uniref90"]), ("GGHHK", ["swissprot"])]
+        )
+        self.assertEqual(2, len(search.calls))
+        self.assertEqual(2, search.maximum_running)
+        self.assertTrue(all(result is not None for result in results))
+
+    def test_group_by_database_versions(self):
+        search = FakeSearch()
+        self._start_service(search, window=0.5)
+        results = self._search_concurrently(
+            [
+                ("MKVLA", ["swissprot"], "2024-01"),
+                ("GGHHK", ["swissprot"], "2024-01"),
+                ("MKVLA", ["swissprot"], "2024-02"),
+            ]
+        )
+        self.assertTrue(all(result is not None for result in results))
+        self.assertEqual(2, len(search.calls))
+        self.assertEqual(
+            [
+                {"swissprot": "/blast/versions/2024-01/swissprot"},
+                {"swissprot": "/blast/versions/2024-02/swissprot"},
+            ],
+            sorted(search.database_paths, key=lambda item: item["swissprot"]),
+        )
+
+    def test_invalid_request(self):
+        self._start_service(FakeSearch(), window=0)
+        configuration = {
+            "blast_databases": ["swissprot"],
+            "msa_minimum_sequence_count": 1,
+            "msa_minimum_coverage": 1,
+        }
+        for content in [
+            {"sequence": "MKV"},
+            ["MKV"],
+            {"sequence": "M\nK"},
+            {"sequence": "MKV", "configuration": configuration},
+            {
+                "sequence": "MKV",
+                "configuration": {**configuration, "database_paths": {}},
+            },
+            {
+                "sequence": "MKV",
+                "configuration": {**configuration, "database_paths": ["swissprot"]},
+            },
+        ]:
+            with self.subTest(content=content):
+                with multiprocessing.connection.Client(
+                    self.socket, family="AF_UNIX"
+                ) as connection:
+                    connection.send_bytes(json.dumps(content).encode("utf-8"))
+                    self.assertTrue(connection.poll(5))
+                    response = json.loads(connection.recv_bytes().decode("utf-8"))
+                self.assertIn("error", response)
+
+    def test_fallback_when_service_is_not_responding(self):
+        listener = multiprocessing.connection.Listener(self.socket, family="AF_UNIX")
+        self.addCleanup(listener.close)
+        connections = []
+        threading.Thread(
+            target=lambda: connections.append(listener.accept()), daemon=True
+        ).start()
+        input_file = os.path.join(self.directory, "input.fasta")
+        fasta.save_sequence_to_fasta("query", "MKVLA", input_file)
+        start = time.monotonic()
+        result = conservation_service.search(
+            input_file,
+            self.directory,
+            _create_configuration(["swissprot"]),
+            self.socket,
+            timeout=0.5,
+        )
+        self.assertIsNone(result)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_fallback_without_service(self):
+        input_file = os.path.join(self.directory, "input.fasta")
+        fasta.save_sequence_to_fasta("query", "MKVLA", input_file)
+        result = conservation_service.search(
+            input_file,
+            self.directory,
+            _create_configuration(["swissprot"]),
+            os.path.join(self.directory, "missing.socket"),
+        )
+        self.assertIsNone(result)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Parity tests for jensen_shannon_divergence against score_conservation.py.
+#
+# The reference is score_conservation.py from conservation_code.tar.gz,
+# REFERENCE_SCRIPT_URL, executed with default options as the pipeline
+# did before it was replaced:
+#   python2 $JENSE_SHANNON_DIVERGANCE_DIR/score_conservation.py {msa}
+# The script loads matrices from ./matrix, so it is executed in its
+# directory or next to a link to the directory.
+# The script requires python2 and is not part of the runtime image, it is
+# installed in the image described in reference.Dockerfile. There the
+# script is executed by test_parity_with_reference_script and fixtures
+# are regenerated by:
+#   python3 test_jensen_shannon_divergence.py --update-fixtures
+#
+# Output files, header included, are compared with score files stored in
+# test-data/jensen-shannon-divergence . The checksum of the script the
+# fixtures were generated with is in REFERENCE_SOURCE_FILE.
+#
+# Outside of the image the numpy implementation is compared with
+# a transcription of the default code path of the script.
+#
+
+import os
+import sys
+import math
+import hashlib
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import jensen_shannon_divergence as jsd
+
+JENSE_SHANNON_DIVERGANCE_DIR = os.environ.get("JENSE_SHANNON_DIVERGANCE_DIR", None)
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "test-data",
+    "jensen-shannon-divergence",
+)
+
+REFERENCE_SCRIPT_URL = (
+    "http://compbio.cs.princeton.edu/conservation/conservation_code.tar.gz"
+)
+
+# Records the script used to generate the fixtures.
+REFERENCE_SOURCE_FILE = os.path.join(FIXTURES_DIR, "SOURCE")
+
+# Alignments too large to be stored as fixtures.
+FIXTURES_SKIPPED = ["random-large"]
+
+# region Reference implementation
+
+REFERENCE_AMINO_ACIDS = list("ARNDCQEGHILKMFPSTWYV-")
+
+REFERENCE_IUPAC_ALPHABET = list("ABCDEFGHIKLMNPQRSTUVWYZX*-")
+
+
+def reference_read_fasta_alignment(file_name):
+    alignment = []
+    current = ""
+    with open(file_name) as stream:
+        for line in stream:
+            line = line[:-1]
+            if len(line) == 0 or line[0] == ";":
+                continue
+            if line[0] == ">":
+                if current != "":
+                    alignment.append(_reference_sanitize(current))
+                    current = ""
+            elif line[0] in REFERENCE_IUPAC_ALPHABET:
+                current += line.replace("\r", "")
+    alignment.append(_reference_sanitize(current))
+    return alignment
+
+
+def _reference_sanitize(sequence):
+    sequence = sequence.upper()
+    for letter in sequence:
+        if letter not in REFERENCE_IUPAC_ALPHABET:
+            sequence = sequence.replace(letter, "-")
+    return sequence.replace("B", "D").replace("Z", "Q").replace("X", "-")
+
+
+def reference_sequence_weights(alignment):
+    weights = [0.0] * len(alignment)
+    for i in range(len(alignment[0])):
+        counts = [0] * len(REFERENCE_AMINO_ACIDS)
+        for sequence in alignment:
+            if sequence[i] != "-":
+                counts[REFERENCE_AMINO_ACIDS.index(sequence[i])] += 1
+        observed_types = len([count for count in counts if count > 0])
+        for j, sequence in enumerate(alignment):
+            d = counts[REFERENCE_AMINO_ACIDS.index(sequence[i])] * observed_types
+            if d > 0:
+                weights[j] += 1.0 / d
+    return [weight / len(alignment[0]) for weight in weights]
+
+
+def reference_js_divergence(column, weights):
+    frequencies = [jsd.PSEUDOCOUNT] * len(REFERENCE_AMINO_ACIDS)
+    for index, amino_acid in enumerate(REFERENCE_AMINO_ACIDS):
+        for j in range(len(column)):
+            if column[j] == amino_acid:
+                frequencies[index] += weights[j]
+    divisor = sum(weights) + len(REFERENCE_AMINO_ACIDS) * jsd.PSEUDOCOUNT
+    frequencies = [value / divisor for value in frequencies][:-1]
+    total = sum(frequencies)
+    frequencies = [value / total for value in frequencies]
+    background = list(jsd.BLOSUM_BACKGROUND_DISTRIBUTION)
+    result = 0.0
+    for p, q in zip(frequencies, background):
+        r = 0.5 * p + 0.5 * q
+        result += p * math.log(p / r, 2) + q * math.log(q / r, 2)
+    result /= 2
+    gaps = sum(weights[j] for j in range(len(column)) if column[j] == "-")
+    return result * (1 - gaps / sum(weights))
+
+
+def reference_window_score(scores, window_size, window_lambda):
+    result = scores[:]
+    for i in range(window_size, len(scores) - window_size):
+        if scores[i] < 0:
+            continue
+        total = 0.0
+        terms = 0.0
+        for j in range(i - window_size, i + window_size + 1):
+            if i != j and scores[j] >= 0:
+                terms += 1
+                total += scores[j]
+        if terms > 0:
+            result[i] = (1 - window_lambda) * scores[i] + window_lambda * total / terms
+    return result
+
+
+def reference_scores(file_name):
+    alignment = reference_read_fasta_alignment(file_name)
+    weights = reference_sequence_weights(alignment)
+    scores = []
+    for i in range(len(alignment[0])):
+        column = [sequence[i] for sequence in alignment]
+        if column.count("-") / len(column) <= jsd.GAP_CUTOFF:
+            scores.append(reference_js_divergence(column, weights))
+        else:
+            scores.append(jsd.GAP_COLUMN_SCORE)
+    scores = reference_window_score(scores, jsd.WINDOW_SIZE, jsd.WINDOW_LAMBDA)
+    columns = [
+        "".join(sequence[i] for sequence in alignment) for i in range(len(alignment[0]))
+    ]
+    return scores, columns
+
+
+def _is_reference_script_available():
+    return JENSE_SHANNON_DIVERGANCE_DIR is not None and shutil.which("python2")
+
+
+# endregion
+
+
+def _random_alignment(seed, sequence_count, length, gap_rate):
+    generator = random.Random(seed)
+    query = [generator.choice(jsd.AMINO_ACIDS[:-1]) for _ in range(length)]
+    result = []
+    for _ in range(sequence_count):
+        sequence = []
+        for letter in query:
+            value = generator.random()
+            if value < gap_rate:
+                sequence.append("-")
+            elif value < 0.5:
+                sequence.append(generator.choice(jsd.AMINO_ACIDS[:-1]))
+            else:
+                sequence.append(letter)
+        result.append("".join(sequence))
+    return ["".join(query)] + result
+
+
+def _write_alignment(file_name, sequences, line_width=60):
+    with open(file_name, "w", newline="\n") as stream:
+        for index, sequence in enumerate(sequences):
+            stream.write(f">sequence_{index}\n")
+            for start in range(0, len(sequence), line_width):
+                stream.write(sequence[start : start + line_width] + "\n")
+
+
+def _read_score_file(file_name):
+    scores = []
+    columns = []
+    with open(file_name) as stream:
+        for line in stream:
+            if line.startswith("#") or len(line.strip()) == 0:
+                continue
+            _, score, column = line.rstrip("\n").split("\t")
+            scores.append(float(score))
+            columns.append(column)
+    return scores, columns
+
+
+class TestJensenShannonDivergence(unittest.TestCase):
+    ALIGNMENTS = {
+        "identical": ["ACDEFGHIKLMNPQRSTVWY"] * 5,
+        "short": ["MKV", "MRV", "MKI"],
+        "gaps": ["MKV-LLAC", "M-VALLAC", "MKVAL-AC", "--VALLAC", "MKVALLA-"],
+        "iupac": ["MKBZXLAJ", "MKDQ-LA.", "MkdqalAC"],
+        "random-small": _random_alignment(1, 10, 50, 0.1),
+        "random-gappy": _random_alignment(2, 30, 120, 0.35),
+        "random-large": _random_alignment(3, 70, 400, 0.05),
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parity_with_reference(self):
+        for name, sequences in self.ALIGNMENTS.items():
+            with self.subTest(alignment=name):
+                input_file = os.path.join(self.directory, name + ".fasta")
+                output_file = os.path.join(self.directory, name + ".score")
+                _write_alignment(input_file, sequences)
+                jsd.compute_jensen_shannon_divergence(input_file, output_file)
+                expected_scores, expected_columns = reference_scores(input_file)
+                actual_scores, actual_columns = _read_score_file(output_file)
+                self.assertEqual(expected_columns, actual_columns)
+                self.assertEqual(len(expected_scores), len(actual_scores))
+                for expected, actual in zip(expected_scores, actual_scores):
+                    self.assertAlmostEqual(expected, actual, delta=1e-5)
+
+    def test_output_format(self):
+        input_file = os.path.join(self.directory, "msa")
+        output_file = os.path.join(self.directory, "msa.score")
+        _write_alignment(input_file, ["MKV-LLAC", "M-VALLAC", "MKVAL-AC"])
+        jsd.compute_jensen_shannon_divergence(input_file, output_file)
+        with open(output_file) as stream:
+            lines = stream.read().split("\n")
+        self.assertTrue(lines[0].startswith(f"# {input_file} -- js_divergence"))
+        self.assertEqual("# align_column_number\tscore\tcolumn", lines[1])
+        self.assertEqual("", lines[2])
+        self.assertRegex(lines[3], r"^0\t-?\d+\.\d{5}\tMMM$")
+
+    def test_different_lengths(self):
+        input_file = os.path.join(self.directory, "msa")
+        _write_alignment(input_file, ["MKV", "MK"])
+        with self.assertRaises(Exception):
+            jsd.read_msa_columns(input_file)
+
+    def test_fixture_files(self):
+        # Fixtures are parity checks only when REFERENCE_SOURCE_FILE exists,
+        # otherwise they are not generated by the script.
+        names = [
+            file_name[: -len(".fasta")]
+            for file_name in sorted(os.listdir(FIXTURES_DIR))
+            if file_name.endswith(".fasta")
+        ]
+        self.assertGreater(len(names), 0)
+        # The header contains the input path as given, so we use the same
+        # relative paths as when the fixtures were created.
+        working_dir = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            for name in names:
+                with self.subTest(alignment=name):
+                    shutil.copy(os.path.join(FIXTURES_DIR, name + ".fasta"), "./")
+                    jsd.compute_jensen_shannon_divergence(
+                        name + ".fasta", name + ".score"
+                    )
+                    with open(name + ".score", "rb") as stream:
+                        actual = stream.read()
+                    with open(
+                        os.path.join(FIXTURES_DIR, name + ".score"), "rb"
+                    ) as stream:
+                        expected = stream.read()
+                    self.assertEqual(expected, actual)
+        finally:
+            os.chdir(working_dir)
+
+    @unittest.skipIf(
+        not _is_reference_script_available(),
+        "Reference score_conservation.py is not available.",
+    )
+    def test_parity_with_reference_script(self):
+        for name, sequences in self.ALIGNMENTS.items():
+            with self.subTest(alignment=name):
+                input_file = os.path.join(self.directory, name + ".fasta")
+                expected_file = os.path.join(self.directory, name + ".expected")
+                actual_file = os.path.join(self.directory, name + ".score")
+                _write_alignment(input_file, sequences)
+                subprocess.run(
+                    f"cd {JENSE_SHANNON_DIVERGANCE_DIR} && python2 "
+                    f"score_conservation.py {input_file} > {expected_file}",
+                    shell=True,
+                    check=True,
+                )
+                jsd.compute_jensen_shannon_divergence(input_file, actual_file)
+                expected_scores, expected_columns = _read_score_file(expected_file)
+                actual_scores, actual_columns = _read_score_file(actual_file)
+                self.assertEqual(expected_columns, actual_columns)
+                for expected, actual in zip(expected_scores, actual_scores):
+                    self.assertAlmostEqual(expected, actual, places=4)
+
+
+def update_fixtures():
+    """Write alignments and scores of the reference script into FIXTURES_DIR."""
+    if not _is_reference_script_available():
+        raise Exception(
+            "Fixtures must be generated by score_conservation.py, "
+            "set JENSE_SHANNON_DIVERGANCE_DIR, see reference.Dockerfile."
+        )
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    script = os.path.join(JENSE_SHANNON_DIVERGANCE_DIR, "score_conservation.py")
+    # The header contains the input path as given, so we execute the script
+    # next to the input with a link to the matrices it loads.
+    working_dir = tempfile.mkdtemp()
+    try:
+        os.symlink(
+            os.path.join(JENSE_SHANNON_DIVERGANCE_DIR, "matrix"),
+            os.path.join(working_dir, "matrix"),
+        )
+        for name, sequences in TestJensenShannonDivergence.ALIGNMENTS.items():
+            if name in FIXTURES_SKIPPED:
+                continue
+            input_file = os.path.join(FIXTURES_DIR, name + ".fasta")
+            _write_alignment(input_file, sequences)
+            shutil.copy(input_file, working_dir)
+            with open(os.path.join(FIXTURES_DIR, name + ".score"), "wb") as stream:
+                subprocess.run(
+                    ["python2", script, name + ".fasta"],
+                    cwd=working_dir,
+                    stdout=stream,
+                    check=True,
+                )
+    finally:
+        shutil.rmtree(working_dir)
+    with open(script, "rb") as stream:
+        checksum = hashlib.sha256(stream.read()).hexdigest()
+    with open(REFERENCE_SOURCE_FILE, "w", newline="\n") as stream:
+        stream.write(f"{REFERENCE_SCRIPT_URL}\n")
+        stream.write(f"score_conservation.py sha256: {checksum}\n")
+        stream.write(
+            "python2 $JENSE_SHANNON_DIVERGANCE_DIR/score_conservation.py"
+            " {name}.fasta > {name}.score, executed next to the alignment"
+            " with a link to $JENSE_SHANNON_DIVERGANCE_DIR/matrix\n"
+        )
+
+
+if __name__ == "__main__":
+    if "--update-fixtures" in sys.argv:
+        update_fixtures()
+    else:
+        unittest.main()
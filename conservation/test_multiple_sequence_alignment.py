@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for merging of PSI-BLAST results searched per database volume and
+# for the streaming search, PSI-BLAST and blastdbcmd are replaced by shell
+# commands.
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+import multiple_sequence_alignment as msa
+
+
+def _format_hit(target: str, evalue: float, bitscore: float, start: int = 1) -> str:
+    return f"{target}\t90\t50.0\t{start}\t{start + 10}\t{evalue}\t{bitscore}\n"
+
+
+class TestMergeVolumeResults(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _merge(self, volumes) -> list:
+        input_files = []
+        for index, hits in enumerate(volumes):
+            input_file = os.path.join(self.directory, f"volume-{index}")
+            with open(input_file, "w") as stream:
+                stream.writelines(hits)
+            input_files.append(input_file)
+        output_file = os.path.join(self.directory, "merged")
+        msa._merge_volume_results(input_files, output_file)
+        with open(output_file) as stream:
+            return [line.split("\t") for line in stream.read().splitlines()]
+
+    def test_order_by_evalue_then_bitscore(self):
+        merged = self._merge(
+            [
+                [_format_hit("A", 1e-10, 50), _format_hit("B", 1e-30, 90)],
+                [_format_hit("C", 1e-10, 60), _format_hit("D", 1e-20, 70)],
+            ]
+        )
+        self.assertEqual(["B", "D", "C", "A"], [hit[0] for hit in merged])
+        # Columns with E-value and bit score are removed.
+        self.assertEqual(["B", "90", "50.0", "1", "11"], merged[0])
+
+    def test_keep_all_hits_of_kept_targets(self):
+        merged = self._merge(
+            [
+                [_format_hit("A", 1e-30, 90, 1), _format_hit("A", 1e-5, 30, 100)],
+                [_format_hit("B", 1e-20, 70)],
+            ]
+        )
+        self.assertEqual(
+            [("A", "1"), ("B", "1"), ("A", "100")],
+            [(hit[0], hit[3]) for hit in merged],
+        )
+
+    def test_limit_number_of_targets(self):
+        with unittest.mock.patch.object(msa, "PSIBLAST_MAXIMUM_TARGETS", 2):
+            merged = self._merge(
+                [
+                    [_format_hit("A", 1e-10, 50), _format_hit("B", 1e-30, 90)],
+                    [_format_hit("C", 1e-20, 70), _format_hit("B", 1e-5, 30, 50)],
+                ]
+            )
+        self.assertEqual(["B", "C", "B"], [hit[0] for hit in merged])
+
+
+# Writes hits one by one and keeps running for a while after the last one.
+FAKE_PSIBLAST = """
+while read line; do echo "$line"; sleep 0.01; done < {hits}
+sleep 0.5
+"""
+
+FAKE_BLASTDBCMD = """
+while read identifier; do printf '>%s\\nMKV\\n' "$identifier"; done > {output}
+"""
+
+
+class TestStreamingSearch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.hits_file = os.path.join(self.directory, "hits")
+        self.psiblast = None
+        self.blastdb_started = []
+        self.config = msa.MsaConfiguration()
+        self.config.working_dir = self.directory
+        self.config.minimum_sequence_count = 3
+        self.config.minimum_coverage = 50
+        self.config.start_psiblast = self._start_psiblast
+        self.config.start_blastdb = self._start_blastdb
+        self.config.execute_blastdb = unittest.mock.Mock()
+
+    def _write_hits(self, count: int):
+        with open(self.hits_file, "w") as stream:
+            for index in range(count):
+                stream.write(f"sp|P{index:05}|\t90\t50.0\t1\t10\n")
+            # Filtered out by identity.
+            stream.write("sp|Q00000|\t90\t99.0\t1\t10\n")
+
+    def _start_psiblast(self, input_file: str, database: str) -> subprocess.Popen:
+        self.psiblast = subprocess.Popen(
+            ["bash", "-c", FAKE_PSIBLAST.format(hits=self.hits_file)],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            start_new_session=True,
+        )
+        return self.psiblast
+
+    def _start_blastdb(self, output_file: str, database: str) -> subprocess.Popen:
+        # Record whether PSI-BLAST was still running.
+        self.blastdb_started.append(self.psiblast.poll() is None)
+        return subprocess.Popen(
+            ["bash", "-c", FAKE_BLASTDBCMD.format(output=output_file)],
+            stdin=subprocess.PIPE,
+            universal_newlines=True,
+            start_new_session=True,
+        )
+
+    def _search(self) -> msa.SearchResult:
+        return msa._search_database_streaming(
+            "input.fasta", self.config, "swissprot", "-swissprot", None
+        )
+
+    def test_feed_blastdbcmd_while_searching(self):
+        self._write_hits(5)
+        result = self._search()
+        self.assertEqual(5, result.count)
+        self.assertEqual([True], self.blastdb_started)
+        with open(result.sequences_file) as stream:
+            headers = [line for line in stream if line.startswith(">")]
+        self.assertEqual([f">sp|P{index:05}|\n" for index in range(5)], headers)
+
+    def test_not_enough_sequences(self):
+        self._write_hits(2)
+        result = self._search()
+        self.assertEqual(2, result.count)
+        self.assertIsNone(result.sequences_file)
+        self.assertEqual([], self.blastdb_started)
+
+    def test_retrieve_from_sequence_store(self):
+        self._write_hits(5)
+        self.config.retrieve_sequences = unittest.mock.Mock(return_value=True)
+        result = self._search()
+        self.assertEqual(5, result.count)
+        self.assertIsNone(result.sequences_file)
+        self.assertEqual([], self.blastdb_started)
+        with open(result.filtered_file) as stream:
+            self.assertEqual(5, len(stream.readlines()))
+        output_file = os.path.join(self.directory, "sequences")
+        msa._retrieve_sequences(
+            result.filtered_file, output_file, self.config, "swissprot"
+        )
+        self.config.retrieve_sequences.assert_called_once_with(
+            result.filtered_file, output_file, "swissprot"
+        )
+        self.config.execute_blastdb.assert_not_called()
+        # Sequences not in the store are retrieved using blastdbcmd.
+        self.config.retrieve_sequences.return_value = False
+        msa._retrieve_sequences(
+            result.filtered_file, output_file, self.config, "swissprot"
+        )
+        self.config.execute_blastdb.assert_called_once_with(
+            result.filtered_file, output_file, "swissprot"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
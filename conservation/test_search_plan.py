@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for search_plan, a plan is shared only by near-identical sequences.
+#
+
+import random
+import shutil
+import tempfile
+import unittest
+
+import search_plan
+
+DATABASES = ["swissprot", "uniref50", "uniref90"]
+
+PARAMETERS = {"minimum_sequence_count": 30}
+
+
+def _random_sequence(generator: random.Random, length: int) -> str:
+    return "".join(generator.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(length))
+
+
+def _share_band(left: str, right: str) -> bool:
+    left_keys = search_plan._plan_keys(left, PARAMETERS)[1:]
+    right_keys = search_plan._plan_keys(right, PARAMETERS)[1:]
+    return len(set(left_keys) & set(right_keys)) > 0
+
+
+class TestSearchPlan(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        generator = random.Random(1)
+        self.sequence = _random_sequence(generator, 200)
+        self.other = _random_sequence(generator, 200)
+        search_plan.record_search(
+            self.directory, self.sequence, PARAMETERS, ["swissprot"], {"swissprot": 5}
+        )
+
+    def _plan_search(self, sequence: str):
+        return search_plan.plan_search(self.directory, sequence, DATABASES, PARAMETERS)
+
+    def test_same_sequence(self):
+        self.assertEqual(["swissprot"], self._plan_search(self.sequence.lower()))
+
+    def test_near_identical_sequence(self):
+        position = 100
+        residue = "A" if self.sequence[position] != "A" else "C"
+        mutant = self.sequence[:position] + residue + self.sequence[position + 1 :]
+        self.assertTrue(_share_band(self.sequence, mutant))
+        self.assertEqual(["swissprot"], self._plan_search(mutant))
+
+    def test_fragment_does_not_inherit_plan(self):
+        fragment = self.sequence[:120]
+        self.assertTrue(_share_band(self.sequence, fragment))
+        self.assertEqual([], self._plan_search(fragment))
+
+    def test_chimera_does_not_inherit_plan(self):
+        chimera = self.sequence[:150] + self.other[150:]
+        self.assertTrue(_share_band(self.sequence, chimera))
+        self.assertEqual([], self._plan_search(chimera))
+
+    def test_statistics(self):
+        self._plan_search(self.sequence)
+        self._plan_search(self.other)
+        statistics = search_plan.load_statistics(self.directory)
+        self.assertEqual(2, statistics["lookups"])
+        self.assertEqual(1, statistics["exact_hits"])
+        self.assertEqual(1, statistics["misses"])
+        self.assertEqual(5, statistics["saved_seconds"])
+
+
+if __name__ == "__main__":
+    unittest.main()
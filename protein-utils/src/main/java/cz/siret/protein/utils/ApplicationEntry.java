@@ -3,6 +3,7 @@ package cz.siret.protein.utils;
 import cz.siret.protein.utils.command.Command;
 import cz.siret.protein.utils.command.prepareforp2rank.PrepareForP2Rank;
 import cz.siret.protein.utils.command.prepareforprankweb.PrepareForPrankWeb;
+import cz.siret.protein.utils.command.server.Server;
 import org.slf4j.Logger;
 import org.slf4j.LoggerFactory;
 
@@ -10,6 +11,7 @@ import java.time.Duration;
 import java.time.Instant;
 import java.util.Arrays;
 import java.util.List;
+import java.util.function.Supplier;
 
 
 public class ApplicationEntry {
@@ -17,9 +19,10 @@ public class ApplicationEntry {
     private static final Logger LOG =
             LoggerFactory.getLogger(ApplicationEntry.class);
 
-    private static final List<Command> COMMANDS = Arrays.asList(
-            new PrepareForP2Rank(),
-            new PrepareForPrankWeb()
+    private static final List<Supplier<Command>> COMMANDS = Arrays.asList(
+            PrepareForP2Rank::new,
+            PrepareForPrankWeb::new,
+            () -> new Server(ApplicationEntry::createCommand)
     );
 
     public static void main(String[] args) {
@@ -62,8 +65,12 @@ public class ApplicationEntry {
     }
 
     private Command getCommand(String args[]) {
-        String commandName = args[0];
-        for (Command command : COMMANDS) {
+        return createCommand(args[0]);
+    }
+
+    private static Command createCommand(String commandName) {
+        for (Supplier<Command> supplier : COMMANDS) {
+            Command command = supplier.get();
             if (command.getName().equals(commandName)) {
                 return command;
             }
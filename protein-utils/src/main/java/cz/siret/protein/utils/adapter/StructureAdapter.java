@@ -22,6 +22,16 @@ public class StructureAdapter {
 
     public Structure loadStructure(
             File structureFile) throws IOException {
+        Structure result = StructureCache.get(structureFile);
+        if (result == null) {
+            result = loadStructureFile(structureFile);
+            StructureCache.put(structureFile, result);
+        }
+        return result;
+    }
+
+    private Structure loadStructureFile(
+            File structureFile) throws IOException {
         String fileName = structureFile.getName().toLowerCase();
         if (fileName.endsWith(PDB_EXTENSION)
                 || fileName.endsWith(PDB_GZ_EXTENSION)) {
@@ -0,0 +1,58 @@
+package cz.siret.protein.utils.adapter;
+
+import org.biojava.nbio.structure.Structure;
+
+import java.io.File;
+import java.io.IOException;
+import java.util.LinkedHashMap;
+import java.util.Map;
+
+/**
+ * Cache of parsed structures shared by all commands executed in one JVM,
+ * so commands of one task do not parse the same structure again. The
+ * cache is disabled unless capacity is set. Structures are identified by
+ * path, size and modification time of the file.
+ */
+public class StructureCache {
+
+    private static int capacity = 0;
+
+    private static final Map<String, Structure> CACHE =
+            new LinkedHashMap<>(16, 0.75f, true) {
+                @Override
+                protected boolean removeEldestEntry(
+                        Map.Entry<String, Structure> eldest) {
+                    return size() > capacity;
+                }
+            };
+
+    public static synchronized void setCapacity(int value) {
+        capacity = value;
+        CACHE.clear();
+    }
+
+    /**
+     * Cached structures are shared, so they must not be modified.
+     */
+    static synchronized Structure get(File file) throws IOException {
+        if (capacity == 0) {
+            return null;
+        }
+        return CACHE.get(createKey(file));
+    }
+
+    static synchronized void put(File file, Structure structure)
+            throws IOException {
+        if (capacity == 0) {
+            return;
+        }
+        CACHE.put(createKey(file), structure);
+    }
+
+    private static String createKey(File file) throws IOException {
+        return file.getCanonicalPath()
+                + ":" + file.length()
+                + ":" + file.lastModified();
+    }
+
+}
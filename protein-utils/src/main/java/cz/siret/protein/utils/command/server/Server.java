@@ -0,0 +1,132 @@
+package cz.siret.protein.utils.command.server;
+
+import com.fasterxml.jackson.databind.ObjectMapper;
+import cz.siret.protein.utils.adapter.StructureCache;
+import cz.siret.protein.utils.command.Command;
+import org.apache.commons.cli.CommandLine;
+import org.apache.commons.cli.Options;
+import org.slf4j.Logger;
+import org.slf4j.LoggerFactory;
+
+import java.io.BufferedReader;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStreamWriter;
+import java.io.Writer;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.nio.charset.StandardCharsets;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.function.Function;
+
+/**
+ * Execute other commands for local clients, so the JVM stays warm and
+ * parsed structures are cached between commands. Each connection sends
+ * one JSON line with {@link ServerRequest} and receives one JSON line
+ * with {@link ServerResponse}.
+ */
+public class Server extends Command {
+
+    private static final Logger LOG = LoggerFactory.getLogger(Server.class);
+
+    private final Function<String, Command> commandFactory;
+
+    private ServerConfiguration configuration;
+
+    private final ObjectMapper mapper = new ObjectMapper();
+
+    public Server(Function<String, Command> commandFactory) {
+        this.commandFactory = commandFactory;
+    }
+
+    @Override
+    public String getName() {
+        return "Server";
+    }
+
+    @Override
+    public String getDescription() {
+        return "Execute commands for clients connected to a local port.";
+    }
+
+    @Override
+    public void execute(String[] args) throws IOException {
+        CommandLine commandLine = parseArgs(args);
+        if (commandLine == null) {
+            LOG.error("Can't parse command line arguments.");
+            return;
+        }
+        loadConfiguration(commandLine);
+        StructureCache.setCapacity(configuration.cacheSize);
+        ExecutorService executor =
+                Executors.newFixedThreadPool(configuration.threads);
+        try (ServerSocket serverSocket = new ServerSocket(
+                configuration.port, 50, InetAddress.getLoopbackAddress())) {
+            LOG.info("Listening on port {}.", configuration.port);
+            while (true) {
+                Socket socket = serverSocket.accept();
+                executor.submit(() -> handleConnection(socket));
+            }
+        } finally {
+            executor.shutdown();
+        }
+    }
+
+    private CommandLine parseArgs(String[] args) {
+        Options options = new Options();
+        options.addOption(null, "port", true, "Port to listen on.");
+        options.addOption(null, "threads", true, "Number of threads.");
+        options.addOption(
+                null, "cache-size", true, "Number of cached structures.");
+        return parseCommandLine(options, args);
+    }
+
+    private void loadConfiguration(CommandLine commandLine) {
+        configuration = new ServerConfiguration();
+        configuration.port = Integer.parseInt(
+                commandLine.getOptionValue("port", "8021"));
+        configuration.threads = Integer.parseInt(commandLine.getOptionValue(
+                "threads",
+                String.valueOf(Runtime.getRuntime().availableProcessors())));
+        configuration.cacheSize = Integer.parseInt(
+                commandLine.getOptionValue("cache-size", "16"));
+    }
+
+    private void handleConnection(Socket socket) {
+        try (socket;
+             BufferedReader reader = new BufferedReader(new InputStreamReader(
+                     socket.getInputStream(), StandardCharsets.UTF_8));
+             Writer writer = new OutputStreamWriter(
+                     socket.getOutputStream(), StandardCharsets.UTF_8)) {
+            ServerRequest request =
+                    mapper.readValue(reader.readLine(), ServerRequest.class);
+            ServerResponse response = executeRequest(request);
+            writer.write(mapper.writeValueAsString(response));
+            writer.write("\n");
+            writer.flush();
+        } catch (Exception ex) {
+            LOG.error("Can't handle connection.");
+            LOG.info("Reason:", ex);
+        }
+    }
+
+    private ServerResponse executeRequest(ServerRequest request) {
+        // Commands keep state, so we need a new instance for each request.
+        Command command = commandFactory.apply(request.command);
+        if (command == null || command instanceof Server) {
+            return new ServerResponse(1, "Invalid command: " + request.command);
+        }
+        LOG.info("Running command: {}", command.getName());
+        try {
+            command.execute(request.arguments.toArray(new String[0]));
+            return new ServerResponse(0, null);
+        } catch (Exception ex) {
+            LOG.error("Command execution failed.");
+            LOG.info("Reason:", ex);
+            return new ServerResponse(1, ex.toString());
+        }
+    }
+
+}
@@ -0,0 +1,20 @@
+package cz.siret.protein.utils.command.server;
+
+public class ServerConfiguration {
+
+    /**
+     * Port to listen on, only local connections are accepted.
+     */
+    public int port;
+
+    /**
+     * Number of concurrently executed commands.
+     */
+    public int threads;
+
+    /**
+     * Number of cached parsed structures.
+     */
+    public int cacheSize;
+
+}
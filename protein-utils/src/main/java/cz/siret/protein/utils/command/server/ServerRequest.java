@@ -0,0 +1,18 @@
+package cz.siret.protein.utils.command.server;
+
+import java.util.ArrayList;
+import java.util.List;
+
+public class ServerRequest {
+
+    /**
+     * Name of the command to execute.
+     */
+    public String command;
+
+    /**
+     * Command line arguments of the command.
+     */
+    public List<String> arguments = new ArrayList<>();
+
+}
@@ -0,0 +1,20 @@
+package cz.siret.protein.utils.command.server;
+
+public class ServerResponse {
+
+    /**
+     * Zero on success, same as exit code of the command line interface.
+     */
+    public int result;
+
+    public String message;
+
+    public ServerResponse() {
+    }
+
+    public ServerResponse(int result, String message) {
+        this.result = result;
+        this.message = message;
+    }
+
+}
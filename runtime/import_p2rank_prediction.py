@@ -13,7 +13,7 @@ import subprocess
 import shutil
 import typing
 
-import requests
+import structure_fetcher
 
 
 def _read_arguments() -> typing.Dict[str, str]:
@@ -174,15 +174,7 @@ def create_status(path: str, task):
 def download_structure(path: str, pdb: str):
     if os.path.exists(path):
         return
-    url = "https://files.rcsb.org/download/" + pdb + ".pdb"
-    download(url, path)
-
-
-def download(url: str, destination: str) -> None:
-    logging.debug(f"Downloading '{url}' to '{destination}' ...")
-    response = requests.get(url)
-    with open(destination, "wb") as stream:
-        stream.write(response.content)
+    structure_fetcher.fetch_structure(pdb, path)
 
 
 def predictions_file(input_directory: str, pdb: str) -> str:
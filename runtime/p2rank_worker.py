@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Long-lived p2rank worker with a client used by run_p2rank_task.py .
+#
+# Jobs are spooled in P2RANK_WORKER_DIR. The client writes the job into
+# a job directory and renames the job file into the queue. Each worker
+# process claims queued jobs by renaming them, collects jobs that arrive
+# in a short time window and predicts all jobs with the same p2rank
+# configuration using one p2rank execution over a dataset file. So the
+# JVM start and model loading are paid once per batch instead of once
+# per task. Outputs are renamed back to the layout of a single structure
+# prediction, so they are identical to the one-shot execution. Run-level
+# outputs, like logs and parameters, describe the whole batch, so they are
+# not copied to the job outputs.
+#
+# Layout:
+#   {worker}/queue/{job}.json
+#   {worker}/running/{job}.json
+#   {worker}/jobs/{job}/              : job inputs and output
+#   {worker}/jobs/{job}/status.json   : written once the job is finished,
+#                                       or empty when it was cancelled
+#   {worker}/running/{job}.status     : status before it is published
+#   {worker}/heartbeat/{pid}          : updated by running workers
+#
+# The status file is created exclusively, by the worker when the job is
+# finished or by the client when it cancels a running job. The one who
+# fails to create it knows the other side is done with the job directory,
+# so exactly one of them removes it.
+#
+# Start the worker pool:
+#   python3 p2rank_worker.py --workers 2
+#
+
+import os
+import typing
+import logging
+import argparse
+import json
+import shutil
+import subprocess
+import time
+import uuid
+import threading
+import multiprocessing
+
+# Directory with spooled jobs, when not set the worker is not used.
+P2RANK_WORKER_DIR = os.environ.get("P2RANK_WORKER_DIR", None)
+
+# Maximum time in seconds the client waits for the worker.
+P2RANK_WORKER_TIMEOUT = float(os.environ.get("P2RANK_WORKER_TIMEOUT", "600"))
+
+# Maximum number of jobs predicted by one p2rank execution.
+P2RANK_WORKER_BATCH_SIZE = int(os.environ.get("P2RANK_WORKER_BATCH_SIZE", "16"))
+
+# Time in seconds the worker waits for more jobs to predict them together.
+P2RANK_WORKER_BATCH_WAIT = float(os.environ.get("P2RANK_WORKER_BATCH_WAIT", "0.5"))
+
+# Number of threads used by p2rank, 0 for number of CPUs.
+P2RANK_WORKER_THREADS = int(os.environ.get("P2RANK_WORKER_THREADS", "0"))
+
+# Name of the structure file in one-shot execution, used to name outputs.
+STRUCTURE_NAME = "structure"
+
+POLL_INTERVAL = 0.2
+
+_EXCLUSIVE_CREATE = os.O_CREAT | os.O_EXCL | os.O_WRONLY
+
+# Worker with older heartbeat is considered not running.
+HEARTBEAT_TIMEOUT = 30
+
+# Running worker updates the heartbeat in this interval, also during
+# a prediction.
+HEARTBEAT_INTERVAL = 5
+
+JOB_PREFIX = "job_"
+
+STATUS_FILE = "status.json"
+
+# Outputs that can contain name of the structure file.
+TEXT_FILE_EXTENSIONS = (".pml", ".csv")
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(description="Run p2rank worker pool.")
+    parser.add_argument(
+        "--directory", default=P2RANK_WORKER_DIR, help="Job spool directory."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes."
+    )
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+    )
+    if arguments["directory"] is None:
+        raise Exception("Missing worker directory.")
+    for name in ["queue", "running", "jobs", "heartbeat"]:
+        os.makedirs(os.path.join(arguments["directory"], name), exist_ok=True)
+    _recover_jobs(arguments["directory"])
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(arguments["directory"],))
+        for _ in range(arguments["workers"])
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+# region Worker
+
+
+def run_worker(worker_dir: str):
+    heartbeat = os.path.join(worker_dir, "heartbeat", str(os.getpid()))
+    logging.info("Worker %s is running.", os.getpid())
+    _touch(heartbeat)
+    # Update the heartbeat in a thread, as a prediction can take longer
+    # than HEARTBEAT_TIMEOUT.
+    stop = threading.Event()
+    heartbeat_thread = threading.Thread(
+        target=_update_heartbeat, args=(heartbeat, stop), daemon=True
+    )
+    heartbeat_thread.start()
+    try:
+        while True:
+            jobs = _claim_jobs(worker_dir)
+            if len(jobs) == 0:
+                time.sleep(POLL_INTERVAL)
+                continue
+            for (p2rank_dir, configuration), group in _group_jobs(jobs).items():
+                logging.info("Predicting %s jobs ...", len(group))
+                try:
+                    errors = predict_dataset(
+                        p2rank_dir,
+                        configuration,
+                        {job_id: job["input"] for job_id, job in group.items()},
+                        os.path.join(worker_dir, "batch-" + str(os.getpid())),
+                        P2RANK_WORKER_THREADS or os.cpu_count() or 1,
+                        {job_id: job["output"] for job_id, job in group.items()},
+                    )
+                except Exception as error:
+                    # Fail only this batch, the worker keeps running.
+                    logging.exception("Prediction of %s jobs failed.", len(group))
+                    errors = {job_id: str(error) or repr(error) for job_id in group}
+                for job_id in group:
+                    _finish_job(worker_dir, job_id, errors.get(job_id, None))
+    finally:
+        stop.set()
+        heartbeat_thread.join()
+        os.remove(heartbeat)
+
+
+def _update_heartbeat(heartbeat: str, stop: threading.Event):
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        _touch(heartbeat)
+
+
+def _claim_jobs(worker_dir: str) -> typing.Dict[str, typing.Dict]:
+    """Move queued jobs to running, wait a moment for more jobs."""
+    queue_dir = os.path.join(worker_dir, "queue")
+    result = {}
+    deadline = None
+    while len(result) < P2RANK_WORKER_BATCH_SIZE:
+        for file_name in sorted(os.listdir(queue_dir)):
+            if len(result) >= P2RANK_WORKER_BATCH_SIZE:
+                break
+            running_file = os.path.join(worker_dir, "running", file_name)
+            try:
+                os.rename(os.path.join(queue_dir, file_name), running_file)
+            except FileNotFoundError:
+                # Claimed by other worker.
+                continue
+            with open(running_file, encoding="utf-8") as stream:
+                result[file_name[: -len(".json")]] = json.load(stream)
+        if len(result) == 0:
+            return result
+        if deadline is None:
+            deadline = time.time() + P2RANK_WORKER_BATCH_WAIT
+        if time.time() >= deadline:
+            break
+        time.sleep(POLL_INTERVAL)
+    return result
+
+
+def _group_jobs(
+    jobs: typing.Dict[str, typing.Dict],
+) -> typing.Dict[typing.Tuple[str, str], typing.Dict[str, typing.Dict]]:
+    result = {}
+    for job_id, job in jobs.items():
+        key = (job["p2rank"], job["configuration"])
+        result.setdefault(key, {})[job_id] = job
+    return result
+
+
+def _finish_job(worker_dir: str, job_id: str, error: typing.Optional[str]):
+    job_dir = os.path.join(worker_dir, "jobs", job_id)
+    os.remove(os.path.join(worker_dir, "running", job_id + ".json"))
+    status = {"status": "failed" if error else "done", "error": error}
+    temp_file = os.path.join(worker_dir, "running", job_id + ".status")
+    _save_json(temp_file, status)
+    try:
+        # Link fails when the file exists, so the client never reads
+        # a partial status and a cancelled job is never published.
+        os.link(temp_file, os.path.join(job_dir, STATUS_FILE))
+    except FileExistsError:
+        # Cancelled by the client.
+        shutil.rmtree(job_dir)
+    finally:
+        os.remove(temp_file)
+
+
+def _recover_jobs(worker_dir: str):
+    """Return jobs interrupted by previous workers to the queue."""
+    running_dir = os.path.join(worker_dir, "running")
+    for file_name in os.listdir(running_dir):
+        if not file_name.endswith(".json"):
+            # Status of a job that was not published.
+            os.remove(os.path.join(running_dir, file_name))
+            continue
+        os.rename(
+            os.path.join(running_dir, file_name),
+            os.path.join(worker_dir, "queue", file_name),
+        )
+
+
+# endregion
+
+# region Dataset prediction
+
+
+def predict_dataset(
+    p2rank_dir: str,
+    configuration: str,
+    input_dirs: typing.Dict[str, str],
+    working_dir: str,
+    threads: int,
+    output_dirs: typing.Dict[str, str],
+) -> typing.Dict[str, str]:
+    """
+    Predict all structures using one p2rank execution. Input directory
+    contains structure.pdb and conservation files as for one-shot
+    execution. Return error for every failed structure, output directory
+    is created only for successful ones.
+    """
+    # Structures are named by identifiers so p2rank outputs are unique.
+    dataset_dir = os.path.join(working_dir, "dataset")
+    shutil.rmtree(working_dir, ignore_errors=True)
+    os.makedirs(dataset_dir)
+    for identifier, input_dir in input_dirs.items():
+        for file_name in os.listdir(input_dir):
+            if not file_name.startswith(STRUCTURE_NAME):
+                continue
+            target_name = identifier + file_name[len(STRUCTURE_NAME) :]
+            os.symlink(
+                os.path.abspath(os.path.join(input_dir, file_name)),
+                os.path.join(dataset_dir, target_name),
+            )
+    dataset_file = os.path.join(working_dir, "dataset.ds")
+    with open(dataset_file, "w") as stream:
+        for identifier in input_dirs:
+            stream.write(f"dataset/{identifier}.pdb\n")
+    output_dir = os.path.join(working_dir, "output")
+    command = [
+        os.path.join(p2rank_dir, "p2rank.sh"),
+        "predict",
+        "-c",
+        os.path.join(p2rank_dir, "config", configuration),
+        "-threads",
+        str(threads),
+        dataset_file,
+        "-o",
+        output_dir,
+        "--log_to_console",
+        "1",
+    ]
+    result = subprocess.run(command, env=os.environ.copy())
+    errors = {}
+    for identifier in input_dirs:
+        if result.returncode != 0:
+            errors[identifier] = f"p2rank failed with {result.returncode}"
+        elif not os.path.exists(
+            os.path.join(output_dir, f"{identifier}.pdb_predictions.csv")
+        ):
+            errors[identifier] = "Missing p2rank predictions."
+        else:
+            _split_output(output_dir, identifier, output_dirs[identifier])
+    shutil.rmtree(working_dir)
+    return errors
+
+
+def _split_output(output_dir: str, identifier: str, target_dir: str):
+    """
+    Copy outputs of the structure, with identifier replaced by the structure
+    name, into the target directory. Outputs of other structures and
+    run-level outputs, without an identifier in the name, are skipped.
+    """
+    for root, _, file_names in os.walk(output_dir):
+        relative_dir = os.path.relpath(root, output_dir)
+        for file_name in file_names:
+            if identifier not in file_name:
+                continue
+            target_name = file_name.replace(identifier, STRUCTURE_NAME)
+            target = os.path.join(target_dir, relative_dir, target_name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            source = os.path.join(root, file_name)
+            if file_name.endswith(TEXT_FILE_EXTENSIONS):
+                # Visualization scripts reference other files by name.
+                with open(source, encoding="utf-8") as stream:
+                    content = stream.read()
+                with open(target, "w", encoding="utf-8") as stream:
+                    stream.write(content.replace(identifier, STRUCTURE_NAME))
+            else:
+                shutil.copy(source, target)
+
+
+# endregion
+
+# region Client
+
+
+def is_worker_available(worker_dir: typing.Optional[str] = P2RANK_WORKER_DIR) -> bool:
+    """Return True if there is a worker with recent heartbeat."""
+    if worker_dir is None:
+        return False
+    heartbeat_dir = os.path.join(worker_dir, "heartbeat")
+    if not os.path.isdir(heartbeat_dir):
+        return False
+    now = time.time()
+    for file_name in os.listdir(heartbeat_dir):
+        try:
+            modified = os.path.getmtime(os.path.join(heartbeat_dir, file_name))
+        except FileNotFoundError:
+            continue
+        if now - modified < HEARTBEAT_TIMEOUT:
+            return True
+    return False
+
+
+def predict(
+    p2rank_dir: str,
+    configuration: str,
+    input_dir: str,
+    output_dir: str,
+    worker_dir: str = P2RANK_WORKER_DIR,
+    timeout: float = P2RANK_WORKER_TIMEOUT,
+) -> bool:
+    """
+    Predict using the worker, input directory contains structure.pdb and
+    conservation files. Return False, and leave the output directory
+    untouched, when the worker fails or does not finish in time.
+    """
+    job_id = JOB_PREFIX + uuid.uuid4().hex
+    job_dir = os.path.join(worker_dir, "jobs", job_id)
+    os.makedirs(job_dir)
+    job = {
+        "p2rank": os.path.abspath(p2rank_dir),
+        "configuration": configuration,
+        "input": os.path.abspath(input_dir),
+        "output": os.path.join(job_dir, "output"),
+    }
+    # Write and rename, so the worker never reads partial job.
+    _save_json(os.path.join(job_dir, "job.json"), job)
+    os.rename(
+        os.path.join(job_dir, "job.json"),
+        os.path.join(worker_dir, "queue", job_id + ".json"),
+    )
+    status_file = os.path.join(job_dir, STATUS_FILE)
+    deadline = time.time() + timeout
+    while not os.path.exists(status_file):
+        if time.time() > deadline:
+            logging.warning("p2rank worker did not finish job %s in time.", job_id)
+            _cancel_job(worker_dir, job_id)
+            return False
+        time.sleep(POLL_INTERVAL)
+    with open(status_file, encoding="utf-8") as stream:
+        status = json.load(stream)
+    if status["status"] != "done":
+        logging.warning("p2rank worker failed job %s: %s", job_id, status["error"])
+        shutil.rmtree(job_dir)
+        return False
+    shutil.move(job["output"], output_dir)
+    shutil.rmtree(job_dir)
+    return True
+
+
+def _cancel_job(worker_dir: str, job_id: str):
+    job_dir = os.path.join(worker_dir, "jobs", job_id)
+    try:
+        os.remove(os.path.join(worker_dir, "queue", job_id + ".json"))
+    except FileNotFoundError:
+        # The job is running, create empty status so the worker removes
+        # the job once finished.
+        try:
+            os.close(os.open(os.path.join(job_dir, STATUS_FILE), _EXCLUSIVE_CREATE))
+            return
+        except FileExistsError:
+            # The worker finished the job in the meantime.
+            pass
+    shutil.rmtree(job_dir)
+
+
+# endregion
+
+
+def _touch(file: str):
+    with open(file, "a"):
+        os.utime(file)
+
+
+def _save_json(file: str, content: typing.Dict):
+    temp_file = file + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as stream:
+        json.dump(content, stream)
+    os.replace(temp_file, file)
+
+
+if __name__ == "__main__":
+    main(_read_arguments())
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Cache of finished predictions.
+#
+# The key is computed from the normalized structure file, selected chains,
+# conservation options and p2rank version and configuration, see
+# run_p2rank_task.create_prediction_key. Cached files are hard links to
+# the files of the public directory of the task that computed them, and
+# they are hard linked into public directories of later tasks, so a hit
+# does not copy any data. Entries not used for PREDICTION_CACHE_MAX_AGE
+# are removed, then least recently used entries are removed until the
+# cache is smaller than PREDICTION_CACHE_MAX_SIZE. Only files not linked
+# from any public directory count into the size, as only they are freed
+# by the eviction. Entries are renamed before they are removed, so a task
+# never restores a partially removed entry.
+#
+# Layout:
+#   {cache}/{key[:2]}/{key}/files/   : copy of the public directory
+#   {cache}/{key[:2]}/{key}/used     : modification time is last use
+#   {cache}/tmp-{uuid}/              : entry being stored or removed
+#
+
+import os
+import typing
+import logging
+import hashlib
+import json
+import shutil
+import time
+import uuid
+
+# Directory with cached predictions, when not set the cache is not used.
+PREDICTION_CACHE_DIR = os.environ.get("PREDICTION_CACHE_DIR", None)
+
+# Maximum size of the cache in MB.
+PREDICTION_CACHE_MAX_SIZE = float(os.environ.get("PREDICTION_CACHE_MAX_SIZE", "10240"))
+
+# Maximum time in days since last use of an entry.
+PREDICTION_CACHE_MAX_AGE = float(os.environ.get("PREDICTION_CACHE_MAX_AGE", "30"))
+
+FILES_DIR = "files"
+
+USED_FILE = "used"
+
+
+def create_key(content: typing.Dict) -> str:
+    """Return key for JSON serializable content."""
+    serialized = json.dumps(content, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(serialized).hexdigest()
+
+
+def hash_structure_file(file: str) -> str:
+    """
+    Return hash of the structure file ignoring line endings and trailing
+    whitespace, which are not significant in PDB and mmCIF files.
+    """
+    result = hashlib.sha256()
+    with open(file, "rb") as stream:
+        for line in stream:
+            result.update(line.rstrip())
+            result.update(b"\n")
+    return result.hexdigest()
+
+
+def hash_file(file: str) -> str:
+    result = hashlib.sha256()
+    with open(file, "rb") as stream:
+        for block in iter(lambda: stream.read(1024 * 1024), b""):
+            result.update(block)
+    return result.hexdigest()
+
+
+def restore(cache_dir: str, key: str, output_dir: str) -> bool:
+    """Link cached files into the output directory, return False on miss."""
+    entry_dir = _entry_directory(cache_dir, key)
+    files_dir = os.path.join(entry_dir, FILES_DIR)
+    if not os.path.isdir(files_dir):
+        return False
+    linked = []
+    try:
+        _link_tree(files_dir, output_dir, linked)
+        _touch(os.path.join(entry_dir, USED_FILE))
+    except FileNotFoundError:
+        # Evicted while we were linking it, the prediction is computed
+        # into the output directory, so we remove what we linked.
+        for path in reversed(linked):
+            if os.path.isdir(path):
+                os.rmdir(path)
+            else:
+                os.remove(path)
+        return False
+    logging.info("Restored prediction '%s' from the cache.", key)
+    return True
+
+
+def store(cache_dir: str, key: str, output_dir: str):
+    """Add files of the output directory to the cache and evict old entries."""
+    entry_dir = _entry_directory(cache_dir, key)
+    if os.path.isdir(entry_dir):
+        return
+    temp_dir = os.path.join(cache_dir, "tmp-" + uuid.uuid4().hex)
+    _link_tree(output_dir, os.path.join(temp_dir, FILES_DIR))
+    _touch(os.path.join(temp_dir, USED_FILE))
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+    try:
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        # Other task stored the same prediction.
+        shutil.rmtree(temp_dir)
+        return
+    evict(cache_dir)
+
+
+def evict(
+    cache_dir: str,
+    max_size: float = PREDICTION_CACHE_MAX_SIZE,
+    max_age: float = PREDICTION_CACHE_MAX_AGE,
+):
+    """Remove entries older than max_age days and keep size under max_size MB."""
+    entries = []
+    for prefix in os.listdir(cache_dir):
+        prefix_dir = os.path.join(cache_dir, prefix)
+        if prefix.startswith("tmp-") or not os.path.isdir(prefix_dir):
+            continue
+        for key in os.listdir(prefix_dir):
+            entry_dir = os.path.join(prefix_dir, key)
+            try:
+                used = os.path.getmtime(os.path.join(entry_dir, USED_FILE))
+                entries.append((used, _directory_size(entry_dir), entry_dir))
+            except FileNotFoundError:
+                continue
+    entries.sort()
+    size = sum(entry[1] for entry in entries)
+    oldest = time.time() - max_age * 24 * 3600
+    for used, entry_size, entry_dir in entries:
+        if used >= oldest and size <= max_size * 1024 * 1024:
+            break
+        logging.info("Removing cached prediction '%s'.", entry_dir)
+        temp_dir = os.path.join(cache_dir, "tmp-" + uuid.uuid4().hex)
+        try:
+            os.rename(entry_dir, temp_dir)
+        except FileNotFoundError:
+            # Removed by other task.
+            pass
+        else:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        size -= entry_size
+
+
+def _link_tree(
+    source_dir: str, target_dir: str, linked: typing.Optional[typing.List] = None
+):
+    """Link files, created directories and files are added to linked."""
+    if linked is None:
+        linked = []
+    for root, _, file_names in os.walk(source_dir, onerror=_raise):
+        directory = os.path.join(target_dir, os.path.relpath(root, source_dir))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            linked.append(directory)
+        for file_name in file_names:
+            source = os.path.join(root, file_name)
+            target = os.path.join(directory, file_name)
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(source, target)
+            except OSError:
+                # Hard links do not work across file systems.
+                shutil.copy2(source, target)
+            linked.append(target)
+
+
+def _raise(error: OSError):
+    # Walk ignores errors, a missing directory must not look empty.
+    raise error
+
+
+def _directory_size(directory: str) -> int:
+    """Return size of files that are not linked from other directories."""
+    result = 0
+    for root, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            stat = os.stat(os.path.join(root, file_name))
+            if stat.st_nlink == 1:
+                result += stat.st_size
+    return result
+
+
+def _entry_directory(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def _touch(file: str):
+    with open(file, "a"):
+        os.utime(file)
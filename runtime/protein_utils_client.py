@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Client of protein-utils server, see the Server command of protein-utils.
+#
+# The server keeps the JVM running and caches parsed structures, so the
+# commands of one task parse the structure only once. Start the server:
+#   protein-utils Server --port 8021
+# and set PROTEIN_UTILS_SERVER=localhost:8021 .
+#
+
+import os
+import typing
+import logging
+import socket
+import json
+
+# Address of the server as host:port, when not set the server is not used.
+PROTEIN_UTILS_SERVER = os.environ.get("PROTEIN_UTILS_SERVER", None)
+
+# Maximum time in seconds we wait for a command to finish.
+PROTEIN_UTILS_TIMEOUT = float(os.environ.get("PROTEIN_UTILS_TIMEOUT", "600"))
+
+CONNECT_TIMEOUT = 5
+
+
+def execute(arguments: typing.List[str], server: str = PROTEIN_UTILS_SERVER) -> bool:
+    """
+    Execute command using the server, the first argument is name of the
+    command. Paths in arguments must be absolute. Return False when the
+    server is not available, raise when the command fails.
+    """
+    if server is None:
+        return False
+    host, port = server.rsplit(":", 1)
+    try:
+        connection = socket.create_connection((host, int(port)), CONNECT_TIMEOUT)
+    except OSError:
+        logging.warning("protein-utils server '%s' is not available.", server)
+        return False
+    request = {"command": arguments[0], "arguments": arguments[1:]}
+    with connection:
+        connection.settimeout(PROTEIN_UTILS_TIMEOUT)
+        connection.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with connection.makefile("r", encoding="utf-8") as stream:
+            line = stream.readline()
+    if len(line) == 0:
+        logging.warning("protein-utils server closed connection.")
+        return False
+    response = json.loads(line)
+    if response["result"] != 0:
+        raise Exception(
+            f"protein-utils {arguments[0]} failed: {response.get('message', None)}"
+        )
+    return True
@@ -55,7 +55,10 @@ def main(arguments):
     }
     structure = p2rank_task.prepare_structure(arguments, configuration)
     conservation_files = p2rank_task.prepare_conservation(
-        configuration, arguments, structure
+        configuration,
+        arguments,
+        structure,
+        p2rank_task.prepare_blast_databases(configuration),
     )
     p2rank_output = p2rank_task.execute_p2rank(
         arguments, structure.file, configuration, conservation_files
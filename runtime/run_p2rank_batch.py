@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Run p2rank for many structures, designed for whole-archive runs.
+#
+# Inputs of a batch are prepared as for run_p2rank.py, then the batch is
+# predicted by one multi-threaded p2rank execution over a dataset file.
+# Output for each structure is in {output}/{name} with the same layout as
+# the output of run_p2rank.py. When p2rank fails for the whole batch, the
+# batch is split and predicted again, so one broken structure does not
+# fail the others. Status of all structures is in {output}/report.json .
+#
+# Example:
+#   python3 run_p2rank_batch.py --pdb 1abc 2xyz --pdb-file ./3abc.pdb
+#
+
+import os
+import argparse
+import logging
+import typing
+import json
+import shutil
+import uuid
+
+import conservation
+import run_p2rank_task as p2rank_task
+import p2rank_worker
+
+
+def _read_arguments() -> typing.Dict[str, str]:
+    parser = argparse.ArgumentParser(description="Run p2rank for many structures.")
+    parser.add_argument("--pdb", nargs="+", default=[], help="PDB codes.")
+    parser.add_argument("--pdb-file", nargs="+", default=[], help="PDB files.")
+    parser.add_argument(
+        "--list", help="File with a PDB code or a PDB file on each line."
+    )
+    parser.add_argument("--output", default="./", help="Output directory.")
+    parser.add_argument("--conservation", action="store_true", help="Use conservation.")
+    parser.add_argument(
+        "--p2rank",
+        default="/opt/p2rank/default",
+        help="p2rank directory with run_p2rank.sh file.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=200,
+        help="Maximum number of structures predicted by one p2rank execution.",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=os.cpu_count() or 1, help="p2rank threads."
+    )
+    return vars(parser.parse_args())
+
+
+def main(arguments):
+    p2rank_task.init_logging()
+    conservation.execute_command = p2rank_task.execute_command
+    os.makedirs(arguments["output"], exist_ok=True)
+    structures = _collect_structures(arguments)
+    report = {}
+    names = list(structures.keys())
+    for start in range(0, len(names), arguments["batch_size"]):
+        batch = {
+            name: structures[name]
+            for name in names[start : start + arguments["batch_size"]]
+        }
+        logging.info(
+            "Predicting structures %s to %s of %s ...",
+            start + 1,
+            start + len(batch),
+            len(names),
+        )
+        report.update(predict_batch(arguments, batch))
+    with open(os.path.join(arguments["output"], "report.json"), "w") as stream:
+        json.dump(report, stream, indent=2)
+    failed = [name for name, item in report.items() if item["status"] != "done"]
+    logging.info("Predicted %s structures, failed %s.", len(report), len(failed))
+
+
+def _collect_structures(arguments) -> typing.Dict[str, typing.Dict]:
+    """Return structure configuration for each name."""
+    codes = list(arguments["pdb"])
+    files = list(arguments["pdb_file"])
+    if arguments["list"] is not None:
+        with open(arguments["list"]) as stream:
+            for line in stream:
+                item = line.strip()
+                if len(item) == 0:
+                    continue
+                elif os.path.exists(item):
+                    files.append(item)
+                else:
+                    codes.append(item)
+    result = {}
+    for code in codes:
+        result[code] = {"code": code, "file": None, "chains": None}
+    for file in files:
+        name = os.path.basename(file).split(".")[0]
+        if name in result:
+            raise Exception(f"Duplicate structure name '{name}' for '{file}'.")
+        result[name] = {"code": None, "file": os.path.abspath(file), "chains": None}
+    return result
+
+
+def predict_batch(
+    arguments, structures: typing.Dict[str, typing.Dict]
+) -> typing.Dict[str, typing.Dict]:
+    """Prepare inputs, predict and collect outputs, return status for each."""
+    report = {}
+    prepared = {}
+    for name, structure_configuration in structures.items():
+        try:
+            prepared[name] = _prepare_structure(
+                arguments, name, structure_configuration
+            )
+        except Exception as ex:
+            logging.exception("Can't prepare structure '%s'.", name)
+            report[name] = {"status": "failed", "error": str(ex)}
+            shutil.rmtree(
+                os.path.join(arguments["output"], name, "working"), ignore_errors=True
+            )
+    try:
+        _predict_prepared(arguments, prepared, report)
+    finally:
+        # Remove working directories on every path, including p2rank errors.
+        for item in prepared.values():
+            shutil.rmtree(item["arguments"]["working"], ignore_errors=True)
+    return report
+
+
+def _predict_prepared(
+    arguments, prepared: typing.Dict[str, typing.Dict], report: typing.Dict
+):
+    """Predict the prepared structures and collect outputs into the report."""
+    # Use unique identifiers, so they can't be confused in p2rank outputs.
+    identifiers = {
+        p2rank_worker.JOB_PREFIX + uuid.uuid4().hex: name for name in prepared
+    }
+    errors = predict_dataset(
+        arguments,
+        {
+            identifier: prepared[name]["input_dir"]
+            for identifier, name in identifiers.items()
+        },
+        {
+            identifier: prepared[name]["p2rank_output"]
+            for identifier, name in identifiers.items()
+        },
+    )
+    for identifier, name in identifiers.items():
+        item = prepared[name]
+        if identifier in errors:
+            report[name] = {"status": "failed", "error": errors[identifier]}
+            continue
+        try:
+            p2rank_task.collect_download_data(
+                item["p2rank_output"],
+                item["structure"],
+                item["conservation_files"],
+                item["arguments"]["output"],
+            )
+            report[name] = {"status": "done", "error": None}
+        except Exception as ex:
+            logging.exception("Can't collect outputs of '%s'.", name)
+            report[name] = {"status": "failed", "error": str(ex)}
+
+
+def _prepare_structure(arguments, name: str, structure_configuration) -> typing.Dict:
+    structure_arguments = {
+        "input": "./",
+        "output": os.path.join(arguments["output"], name),
+        "working": os.path.join(arguments["output"], name, "working"),
+        "p2rank": arguments["p2rank"],
+    }
+    p2rank_task.prepare_directories(structure_arguments)
+    configuration = {
+        "structure": structure_configuration,
+        "conservation": {
+            "compute": arguments["conservation"],
+            "msaFile": None,
+            "hsspCode": None,
+        },
+    }
+    structure = p2rank_task.prepare_structure(structure_arguments, configuration)
+    conservation_files = p2rank_task.prepare_conservation(
+        configuration,
+        structure_arguments,
+        structure,
+        p2rank_task.prepare_blast_databases(configuration),
+    )
+    input_dir = p2rank_task.prepare_p2rank_input(
+        structure_arguments, structure.file, conservation_files
+    )
+    return {
+        "arguments": structure_arguments,
+        "structure": structure,
+        "conservation_files": conservation_files,
+        "input_dir": input_dir,
+        "p2rank_output": os.path.join(structure_arguments["working"], "p2rank-output"),
+    }
+
+
+def predict_dataset(
+    arguments, input_dirs: typing.Dict[str, str], output_dirs: typing.Dict[str, str]
+) -> typing.Dict[str, str]:
+    """
+    Predict the structures, when p2rank fails for all of them we split
+    the structures into halves and try again. Return errors.
+    """
+    if len(input_dirs) == 0:
+        return {}
+    errors = p2rank_worker.predict_dataset(
+        arguments["p2rank"],
+        p2rank_task.select_p2rank_configuration(
+            {"conservation": {"compute": arguments["conservation"]}}
+        ),
+        input_dirs,
+        os.path.join(arguments["output"], "p2rank-batch"),
+        arguments["threads"],
+        output_dirs,
+    )
+    if len(input_dirs) == 1 or len(errors) < len(input_dirs):
+        return errors
+    logging.info("p2rank failed for %s structures, splitting.", len(input_dirs))
+    identifiers = list(input_dirs.keys())
+    half = len(identifiers) // 2
+    result = {}
+    for part in [identifiers[:half], identifiers[half:]]:
+        result.update(
+            predict_dataset(
+                arguments,
+                {identifier: input_dirs[identifier] for identifier in part},
+                {identifier: output_dirs[identifier] for identifier in part},
+            )
+        )
+    return result
+
+
+if __name__ == "__main__":
+    main(_read_arguments())
@@ -14,16 +14,95 @@ import shutil
 import zipfile
 import gzip
 import collections
-
-import requests
+import multiprocessing
 
 import conservation
-import blast_database
+import conservation_cache
+import conservation_reuse
+import conservation_service
+import fasta
+import database_manager
+import sequence_store
+import search_plan
+import kmer_index
+import hssp_store
+import p2rank_worker
+import protein_utils_client
+import structure_fetcher
+import prediction_cache
+import task_graph
 
 PROTEIN_UTILS_CMD = os.environ["PROTEIN_UTILS_CMD"]
 
 HSSP_DATABASE_DIR = os.environ["HSSPTDB"]
 
+# Set to "1" to search all BLAST databases concurrently.
+CONSERVATION_CONCURRENT_SEARCH = (
+    os.environ.get("CONSERVATION_CONCURRENT_SEARCH", "0") == "1"
+)
+
+# Maximum number of concurrent BLAST searches, 0 for number of CPUs.
+CONSERVATION_MAX_SEARCHES = int(os.environ.get("CONSERVATION_MAX_SEARCHES", "0"))
+
+# Set to "1" to filter PSI-BLAST output as it is produced.
+CONSERVATION_STREAMING_SEARCH = (
+    os.environ.get("CONSERVATION_STREAMING_SEARCH", "0") == "1"
+)
+
+# Number of processes used to compute conservation for different chains.
+CONSERVATION_WORKERS = int(os.environ.get("CONSERVATION_WORKERS", "1"))
+
+# Maximum number of concurrently running conservation tools (PSI-BLAST,
+# blastdbcmd, CD-HIT, MUSCLE) in one task, 0 for no limit.
+CONSERVATION_TOOLS_LIMIT = int(os.environ.get("CONSERVATION_TOOLS_LIMIT", "0"))
+
+# Set to "1" to search sequences of all chains using one PSI-BLAST
+# execution per database.
+CONSERVATION_BATCH_SEARCH = os.environ.get("CONSERVATION_BATCH_SEARCH", "0") == "1"
+
+# Set to "1" to select MUSCLE options based on the query length
+# and number of found sequences.
+CONSERVATION_ADAPTIVE_ALIGNMENT = (
+    os.environ.get("CONSERVATION_ADAPTIVE_ALIGNMENT", "0") == "1"
+)
+
+# Time budget for adaptive alignment in seconds, 0 for no limit.
+CONSERVATION_ALIGNMENT_BUDGET = float(
+    os.environ.get("CONSERVATION_ALIGNMENT_BUDGET", "0")
+)
+
+# Set to "1" to record completed conservation stages, so restarted task
+# does not execute them again.
+CONSERVATION_CHECKPOINTS = os.environ.get("CONSERVATION_CHECKPOINTS", "0") == "1"
+
+# Set to "1" to cut found sequences to the region aligned to the query.
+CONSERVATION_TRIM_HITS = os.environ.get("CONSERVATION_TRIM_HITS", "0") == "1"
+
+# Number of residues kept around the aligned region.
+CONSERVATION_TRIM_FLANK = int(os.environ.get("CONSERVATION_TRIM_FLANK", "20"))
+
+# Set to "1" to search volumes of a database in parallel.
+CONSERVATION_SHARDED_SEARCH = os.environ.get("CONSERVATION_SHARDED_SEARCH", "0") == "1"
+
+# Maximum number of concurrently searched volumes, 0 for number of CPUs.
+CONSERVATION_MAX_VOLUME_SEARCHES = int(
+    os.environ.get("CONSERVATION_MAX_VOLUME_SEARCHES", "0")
+)
+
+# Comma separated list of databases searched only in candidates selected
+# using k-mer index, requires KMER_INDEX_DIR.
+CONSERVATION_PREFILTER_DATABASES = [
+    database
+    for database in os.environ.get("CONSERVATION_PREFILTER_DATABASES", "").split(",")
+    if len(database) > 0
+]
+
+# Maximum number of concurrently executed task stages.
+TASK_MAX_STAGES = int(os.environ.get("TASK_MAX_STAGES", "2"))
+
+# BLAST databases used to compute conservation, when they are ready.
+BLAST_DATABASES = ["swissprot", "uniref50", "uniref90"]
+
 StructureTuple = collections.namedtuple(
     "StructureTuple", ["raw_file", "file", "fasta_files", "chains"]
 )
@@ -44,15 +123,92 @@ def _read_arguments() -> typing.Dict[str, str]:
 def main(arguments):
     initialize(arguments)
     configuration = load_json(arguments["configuration"])
-    structure = prepare_structure(arguments, configuration)
-    conservation_files = prepare_conservation(configuration, arguments, structure)
-    p2rank_output = execute_p2rank(
-        arguments, structure.file, configuration, conservation_files
-    )
-    prepare_download_data(arguments, p2rank_output, structure, conservation_files)
-    prepare_p2rank_web_data(
-        p2rank_output, structure, conservation_files, arguments["output"]
+    values = {
+        "arguments": arguments,
+        "configuration": configuration,
+        "output_dir": arguments["output"],
+    }
+    values = task_graph.execute_stages(
+        create_preparation_stages(configuration), values, TASK_MAX_STAGES
     )
+    cache_dir = prediction_cache.PREDICTION_CACHE_DIR
+    if cache_dir is not None:
+        conservation_configuration = None
+        if values["blast_databases"] is not None:
+            conservation_configuration = create_conservation_configuration(
+                values["blast_databases"]
+            )
+        cache_key = create_prediction_key(
+            arguments,
+            configuration,
+            values["raw_structure_file"],
+            conservation_configuration,
+        )
+        if prediction_cache.restore(cache_dir, cache_key, arguments["output"]):
+            return
+    task_graph.execute_stages(create_prediction_stages(), values, TASK_MAX_STAGES)
+    if cache_dir is not None:
+        prediction_cache.store(cache_dir, cache_key, arguments["output"])
+
+
+def create_preparation_stages(configuration) -> typing.List[task_graph.Stage]:
+    """Stages needed before we can look for the prediction in the cache."""
+    return [
+        task_graph.Stage(
+            "raw-structure",
+            lambda arguments, configuration: prepare_raw_structure_file(
+                arguments, configuration["structure"]
+            ),
+            ["arguments", "configuration"],
+            ["raw_structure_file"],
+        ),
+        # Fail before the structure is prepared when there is no database.
+        task_graph.Stage(
+            "blast-databases",
+            prepare_blast_databases,
+            ["configuration"],
+            ["blast_databases"],
+        ),
+    ]
+
+
+def create_prediction_stages() -> typing.List[task_graph.Stage]:
+    return [
+        task_graph.Stage(
+            "structure",
+            prepare_structure,
+            ["arguments", "configuration", "raw_structure_file"],
+            ["structure"],
+        ),
+        task_graph.Stage(
+            "conservation",
+            prepare_conservation,
+            ["configuration", "arguments", "structure", "blast_databases"],
+            ["conservation_files"],
+        ),
+        task_graph.Stage(
+            "p2rank",
+            lambda arguments, configuration, structure, conservation_files: (
+                execute_p2rank(
+                    arguments, structure.file, configuration, conservation_files
+                )
+            ),
+            ["arguments", "configuration", "structure", "conservation_files"],
+            ["p2rank_output"],
+        ),
+        task_graph.Stage(
+            "download-data",
+            prepare_download_data,
+            ["arguments", "p2rank_output", "structure", "conservation_files"],
+            [],
+        ),
+        task_graph.Stage(
+            "web-data",
+            prepare_p2rank_web_data,
+            ["p2rank_output", "structure", "conservation_files", "output_dir"],
+            [],
+        ),
+    ]
 
 
 def initialize(arguments) -> None:
@@ -78,17 +234,24 @@ def load_json(file: str) -> typing.Dict:
         return json.load(stream)
 
 
-def prepare_structure(arguments, configuration) -> StructureTuple:
+def prepare_structure(
+    arguments, configuration, raw_structure_file: typing.Optional[str] = None
+) -> StructureTuple:
     logging.info("Preparing structure ...")
-    raw_structure_file = prepare_raw_structure_file(
-        arguments, configuration["structure"]
-    )
+    if raw_structure_file is None:
+        raw_structure_file = prepare_raw_structure_file(
+            arguments, configuration["structure"]
+        )
     chains = configuration["structure"].get("chains", None)
-    execute_command(
-        f"{PROTEIN_UTILS_CMD} PrepareForP2Rank"
-        f" --input {raw_structure_file}"
-        f" --output {arguments['working']}"
-        + (" --chains=" + ",".join(chains) if chains is not None else "")
+    execute_protein_utils(
+        [
+            "PrepareForP2Rank",
+            "--input",
+            os.path.abspath(raw_structure_file),
+            "--output",
+            os.path.abspath(arguments["working"]),
+        ]
+        + (["--chains=" + ",".join(chains)] if chains is not None else [])
     )
     structure_info = load_json(
         os.path.join(arguments["working"], "structure-info.json")
@@ -101,11 +264,68 @@ def prepare_structure(arguments, configuration) -> StructureTuple:
     )
 
 
+def create_prediction_key(
+    arguments,
+    configuration,
+    raw_structure_file: str,
+    conservation_configuration: typing.Optional[
+        conservation.ConservationConfiguration
+    ] = None,
+) -> str:
+    """
+    Return key of the prediction for the prediction cache, the conservation
+    configuration is required when the conservation is computed.
+    """
+    conservation_options = configuration.get("conservation", {})
+    content = {
+        "structure": prediction_cache.hash_structure_file(raw_structure_file),
+        "chains": sorted(configuration["structure"].get("chains", None) or []),
+        "conservation": conservation_options,
+        "p2rank": get_p2rank_version(arguments["p2rank"]),
+        "p2rankConfiguration": select_p2rank_configuration(configuration),
+    }
+    if conservation_options.get("msaFile", None) is not None:
+        content["msa"] = prediction_cache.hash_file(
+            os.path.join(arguments["input"], conservation_options["msaFile"])
+        )
+    if conservation_configuration is not None:
+        # Conservation depends on search options and database versions.
+        content["conservationConfiguration"] = conservation_cache.create_key_content(
+            conservation_configuration
+        )
+        if conservation_reuse.CONSERVATION_REUSE:
+            content["conservationReuse"] = [
+                conservation_reuse.CONSERVATION_REUSE_IDENTITY,
+                conservation_reuse.CONSERVATION_REUSE_COVERAGE,
+            ]
+    return prediction_cache.create_key(content)
+
+
+def get_p2rank_version(p2rank_dir: str) -> typing.Dict:
+    """Identify p2rank installation by its jar file, configurations and models."""
+    result = {}
+    for file in [
+        "bin/p2rank.jar",
+        "config/default.groovy",
+        "config/conservation.groovy",
+    ]:
+        path = os.path.join(p2rank_dir, file)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            result[file] = [stat.st_size, stat.st_mtime]
+    # Models can be replaced keeping size and time, so we hash them.
+    models_dir = os.path.join(p2rank_dir, "models")
+    for root, _, file_names in os.walk(models_dir):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            result[os.path.relpath(path, p2rank_dir)] = prediction_cache.hash_file(path)
+    return result
+
+
 def prepare_raw_structure_file(arguments, structure):
     structure_file = os.path.join(arguments["working"], "structure-raw.pdb")
     if structure.get("code", None) is not None:
-        url = "https://files.rcsb.org/download/" + structure["code"] + ".pdb"
-        download(url, structure_file)
+        structure_fetcher.fetch_structure(structure["code"], structure_file)
     elif structure.get("file", None) is not None:
         input_path = os.path.join(arguments["input"], structure["file"])
         shutil.copy(input_path, structure_file)
@@ -114,13 +334,6 @@ def prepare_raw_structure_file(arguments, structure):
     return structure_file
 
 
-def download(url: str, destination: str) -> None:
-    logging.debug(f"Downloading '{url}' to '{destination}' ...")
-    response = requests.get(url)
-    with open(destination, "wb") as stream:
-        stream.write(response.content)
-
-
 def filter_amino_chains(structure_info, chains) -> typing.Dict[str, str]:
     """
     Check that all required chains are in the structure info file.
@@ -175,8 +388,18 @@ def execute_command(command: str):
     result.check_returncode()
 
 
+def execute_protein_utils(arguments: typing.List[str]):
+    """Use protein-utils server if available, else start protein-utils."""
+    if protein_utils_client.execute(arguments):
+        return
+    execute_command(" ".join([PROTEIN_UTILS_CMD] + arguments))
+
+
 def prepare_conservation(
-    configuration, arguments, structure: StructureTuple
+    configuration,
+    arguments,
+    structure: StructureTuple,
+    blast_databases: typing.Optional[typing.List[str]],
 ) -> typing.Dict[str, ConservationTuple]:
     if should_use_conservation(configuration):
         logging.info("No conservation is used.")
@@ -194,7 +417,25 @@ def prepare_conservation(
             arguments["working"],
         )
     else:
-        return compute_conservations(arguments, structure)
+        return compute_conservations(arguments, structure, blast_databases)
+
+
+def prepare_blast_databases(configuration) -> typing.Optional[typing.List[str]]:
+    """Return databases to compute conservation with, None if not computed."""
+    if not should_compute_conservation(configuration):
+        return None
+    return select_blast_databases(BLAST_DATABASES)
+
+
+def should_compute_conservation(configuration) -> bool:
+    """Return True when conservation is computed using BLAST databases."""
+    if should_use_conservation(configuration):
+        return False
+    conservation_options = configuration["conservation"]
+    return (
+        conservation_options.get("hssp", None) is None
+        and conservation_options.get("msaFile", None) is None
+    )
 
 
 def should_use_conservation(configuration) -> bool:
@@ -209,11 +450,14 @@ def prepare_conservation_from_hssp(
     hssp_code = conservation_options["hssp"]
     result = {}
     for chain in chains:
-        source_file = os.path.join(
-            HSSP_DATABASE_DIR, f"{hssp_code}{chain}.hssp.fasta.scores.gz"
-        )
         target_file = os.path.join(working_dir, f"structure_{chain}.score")
-        gunzip_file(source_file, target_file)
+        if hssp_store.HSSP_STORE_DIR is None or not hssp_store.write_record(
+            hssp_store.HSSP_STORE_DIR, hssp_code, chain, target_file
+        ):
+            source_file = os.path.join(
+                HSSP_DATABASE_DIR, f"{hssp_code}{chain}{hssp_store.HSSP_FILE_SUFFIX}"
+            )
+            gunzip_file(source_file, target_file)
         result[chain] = ConservationTuple(target_file, None)
     return result
 
@@ -234,21 +478,20 @@ def prepare_conservation_from_msa(
     chain = next(iter(chains))
     msa_file = os.path.join(input_dir, options["msaFile"])
     target_file = os.path.join(working_root_dir, f"structure_{chain}.score")
-    configuration = conservation.ConservationConfiguration()
-    configuration.execute_command = execute_command
-    conservation.compute_jensen_shannon_divergence(msa_file, target_file, configuration)
+    conservation.compute_jensen_shannon_divergence(msa_file, target_file)
     return {chain: ConservationTuple(target_file, msa_file)}
 
 
 def compute_conservations(
-    arguments, structure: StructureTuple
+    arguments, structure: StructureTuple, blast_databases: typing.List[str]
 ) -> typing.Dict[str, ConservationTuple]:
-    # As chains may have same sequences, we collect map sequence to chain.
-    result = {}
-    sequence_to_chain = {}
+    # As chains may have same sequences, we collect map sequence to chain
+    # and compute the conservation only for the first chain.
+    chain_to_sequence = {}
+    tasks = {}
     for chain, fasta_file_name in structure.fasta_files.items():
         fasta_file = os.path.join(arguments["working"], fasta_file_name)
-        sequences = _read_fasta_file(fasta_file)
+        sequences = fasta.read_fasta_file(fasta_file)
         if len(sequences) > 1:
             raise Exception(
                 "The fasta file must contains only one sequence not {}".format(
@@ -256,58 +499,197 @@ def compute_conservations(
                 )
             )
         sequence = sequences[0][1]
-        # If we see the sequence for the first time we compute the conservation.
-        if sequence not in sequence_to_chain:
-            conservation = compute_from_structure_for_chain(
-                chain, fasta_file_name, arguments
+        chain_to_sequence[chain] = sequence
+        if sequence not in tasks:
+            tasks[sequence] = (
+                chain,
+                sequence,
+                fasta_file_name,
+                arguments,
+                blast_databases,
+                None,
             )
-            sequence_to_chain[sequence] = conservation
-        # We use the computed conservation for given chain.
-        result[chain] = sequence_to_chain[sequence]
-    return result
+    if CONSERVATION_BATCH_SEARCH and len(tasks) > 1:
+        tasks = search_in_batch(arguments, tasks, blast_databases)
+    if CONSERVATION_WORKERS > 1 and len(tasks) > 1:
+        conservations = compute_in_parallel(list(tasks.values()))
+    else:
+        conservations = [compute_or_load_for_chain(*task) for task in tasks.values()]
+    sequence_to_conservation = dict(zip(tasks.keys(), conservations))
+    # We use the computed conservation for given chain.
+    return {
+        chain: sequence_to_conservation[sequence]
+        for chain, sequence in chain_to_sequence.items()
+    }
+
+
+def search_in_batch(arguments, tasks, blast_databases: typing.List[str]):
+    """
+    Run PSI-BLAST for all sequences that are not in the cache at once,
+    return tasks with the PSI-BLAST results.
+    """
+    configuration = create_conservation_configuration(blast_databases)
+    cache_dir = conservation_cache.CONSERVATION_CACHE_DIR
+    fasta_files = {}
+    for chain, sequence, fasta_file_name, _, _, _ in tasks.values():
+        if cache_dir is not None and conservation_cache.contains(
+            cache_dir, conservation_cache.create_key(sequence, configuration)
+        ):
+            continue
+        fasta_files[chain] = os.path.join(arguments["working"], fasta_file_name)
+    if len(fasta_files) < 2:
+        return tasks
+    logging.info("Searching for %s sequences in batch ...", len(fasta_files))
+    working_dir = os.path.join(arguments["working"], "conservation-batch")
+    os.makedirs(working_dir, exist_ok=True)
+    psiblast_results = conservation.search_in_batch(
+        fasta_files, working_dir, configuration
+    )
+    return {
+        sequence: (
+            chain,
+            sequence,
+            fasta_file_name,
+            arguments,
+            blast_databases,
+            psiblast_results.get(chain),
+        )
+        for sequence, (chain, _, fasta_file_name, _, _, _) in tasks.items()
+    }
+
+
+def compute_in_parallel(tasks) -> typing.List[ConservationTuple]:
+    """Compute conservations in a process pool, keep order of the tasks."""
+    workers = min(CONSERVATION_WORKERS, len(tasks))
+    logging.info("Computing conservation using %s processes ...", workers)
+    # We run in a stage thread next to other stages, forking a process with
+    # running threads can deadlock on locks held by the other threads.
+    context = multiprocessing.get_context("spawn")
+    tools_limit = None
+    if CONSERVATION_TOOLS_LIMIT > 0:
+        tools_limit = context.BoundedSemaphore(CONSERVATION_TOOLS_LIMIT)
+    with context.Pool(
+        workers, initializer=_initialize_worker, initargs=(tools_limit,)
+    ) as pool:
+        return pool.starmap(compute_or_load_for_chain, tasks)
+
+
+# Limit for concurrently running tools shared by the worker processes.
+_tools_limit = None
+
+
+def _initialize_worker(tools_limit) -> None:
+    global _tools_limit
+    _tools_limit = tools_limit
+    # Spawned processes do not inherit the logging configuration.
+    init_logging()
 
 
-def _read_fasta_file(input_file: str) -> typing.List[typing.Tuple[str, str]]:
-    header = None
-    result = []
-    sequence = ""
-    with open(input_file) as in_stream:
-        for line in in_stream:
-            line = line.rstrip()
-            if line.startswith(">"):
-                if header is None:
-                    header = line[1:]
-                else:
-                    result.append((header, sequence))
-                    header = line[1:]
-                    sequence = ""
-            else:
-                sequence += line
-    if header is not None:
-        result.append((header, sequence))
+def compute_or_load_for_chain(
+    chain: str,
+    sequence: str,
+    fasta_file_name: str,
+    arguments,
+    blast_databases: typing.List[str],
+    psiblast_results: typing.Optional[typing.Dict[str, str]] = None,
+) -> ConservationTuple:
+    """Use conservation cache if available, else compute the conservation."""
+    cache_dir = conservation_cache.CONSERVATION_CACHE_DIR
+    if cache_dir is None:
+        return compute_from_structure_for_chain(
+            chain, fasta_file_name, arguments, blast_databases, psiblast_results
+        )
+    configuration = create_conservation_configuration(blast_databases)
+    key = conservation_cache.create_key(sequence, configuration)
+    working_dir = os.path.join(arguments["working"], f"conservation-{chain}")
+    os.makedirs(working_dir, exist_ok=True)
+    target_file = os.path.join(working_dir, f"chain_{chain}_conservation.score")
+    msa_file = os.path.join(working_dir, "msa")
+    if conservation_cache.load(cache_dir, key, target_file, msa_file):
+        return ConservationTuple(target_file, msa_file)
+    if conservation_reuse.CONSERVATION_REUSE:
+        reused_key = conservation_reuse.create_reused_key(sequence, configuration)
+        if conservation_cache.load(cache_dir, reused_key, target_file, msa_file):
+            return ConservationTuple(target_file, msa_file)
+        reused_msa_file = conservation_reuse.reuse_conservation(
+            cache_dir,
+            os.path.join(arguments["working"], fasta_file_name),
+            working_dir,
+            target_file,
+            configuration,
+        )
+        if reused_msa_file is not None:
+            # Stored under its own key, so the exact key is left for the
+            # computed conservation. Reused entries are not indexed, so
+            # we never reuse them again.
+            conservation_cache.store(
+                cache_dir,
+                reused_key,
+                target_file,
+                reused_msa_file,
+                conservation_cache.CONSERVATION_CACHE_SIZE,
+            )
+            return ConservationTuple(target_file, reused_msa_file)
+    result = compute_from_structure_for_chain(
+        chain, fasta_file_name, arguments, blast_databases, psiblast_results
+    )
+    conservation_cache.store(
+        cache_dir,
+        key,
+        result.file,
+        result.msa_file,
+        conservation_cache.CONSERVATION_CACHE_SIZE,
+    )
+    conservation_cache.add_sequence(cache_dir, key, sequence, configuration)
     return result
 
 
 def compute_from_structure_for_chain(
-    chain: str, fasta_file_name: str, arguments
+    chain: str,
+    fasta_file_name: str,
+    arguments,
+    blast_databases: typing.List[str],
+    psiblast_results: typing.Optional[typing.Dict[str, str]] = None,
 ) -> ConservationTuple:
     working_dir = os.path.join(arguments["working"], f"conservation-{chain}")
     fasta_file = os.path.join(arguments["working"], fasta_file_name)
     os.makedirs(working_dir, exist_ok=True)
     target_file = os.path.join(working_dir, f"chain_{chain}_conservation.score")
-    configuration = conservation.ConservationConfiguration()
-    configuration.execute_command = execute_command
-    configuration.blast_databases = prepare_blast_databases()
-    msa_file = conservation.compute_conservation(
+    configuration = create_conservation_configuration(blast_databases)
+    configuration.psiblast_results = psiblast_results
+    msa_file = conservation_service.compute_conservation(
         fasta_file, working_dir, target_file, configuration
     )
     return ConservationTuple(target_file, msa_file)
 
 
-def prepare_blast_databases() -> typing.List[str]:
-    databases = ["swissprot", "uniref50", "uniref90"]
-    blast_database.prepare_databases(execute_command, databases)
-    return databases
+def create_conservation_configuration(
+    blast_databases: typing.List[str],
+) -> conservation.ConservationConfiguration:
+    result = conservation.ConservationConfiguration()
+    result.execute_command = execute_command
+    result.blast_databases = blast_databases
+    result.msa_concurrent_database_search = CONSERVATION_CONCURRENT_SEARCH
+    result.msa_maximum_concurrent_searches = CONSERVATION_MAX_SEARCHES
+    result.msa_streaming_search = CONSERVATION_STREAMING_SEARCH
+    result.msa_adaptive_alignment = CONSERVATION_ADAPTIVE_ALIGNMENT
+    result.msa_alignment_time_budget = CONSERVATION_ALIGNMENT_BUDGET
+    result.msa_checkpoints = CONSERVATION_CHECKPOINTS
+    result.msa_sharded_search = CONSERVATION_SHARDED_SEARCH
+    result.msa_maximum_volume_searches = CONSERVATION_MAX_VOLUME_SEARCHES
+    result.msa_trim_hits = CONSERVATION_TRIM_HITS
+    result.msa_trim_flank = CONSERVATION_TRIM_FLANK
+    result.sequence_store_dir = sequence_store.SEQUENCE_STORE_DIR
+    result.search_plan_dir = search_plan.CONSERVATION_SEARCH_PLAN_DIR
+    result.kmer_index_dir = kmer_index.KMER_INDEX_DIR
+    result.msa_prefilter_databases = CONSERVATION_PREFILTER_DATABASES
+    result.tools_limit = _tools_limit
+    return result
+
+
+def select_blast_databases(databases: typing.List[str]) -> typing.List[str]:
+    """Return ready databases, we never wait for a database to be built."""
+    return database_manager.select_databases(databases)
 
 
 def execute_p2rank(
@@ -317,16 +699,19 @@ def execute_p2rank(
     conservation_files: typing.Dict[str, ConservationTuple],
 ) -> str:
     """Execute p2rank and return output directory."""
-
-    # Prepare inputs.
-    input_dir = os.path.join(arguments["working"], "p2rank-input")
-    os.makedirs(input_dir, exist_ok=True)
+    input_dir = prepare_p2rank_input(arguments, structure_file, conservation_files)
     input_structure_file = os.path.join(input_dir, "structure.pdb")
-    shutil.copy(structure_file, input_structure_file)
-    prepare_p2rank_conservation_files(input_dir, conservation_files)
 
-    # Prepare command.
     output_dir = os.path.join(arguments["working"], "p2rank-output")
+    if p2rank_worker.is_worker_available() and p2rank_worker.predict(
+        arguments["p2rank"],
+        select_p2rank_configuration(configuration),
+        input_dir,
+        output_dir,
+    ):
+        return output_dir
+
+    # Prepare command.
     p2rank_sh = os.path.join(arguments["p2rank"], "p2rank.sh")
     p2rank_config = os.path.join(
         arguments["p2rank"], "config", select_p2rank_configuration(configuration)
@@ -346,6 +731,20 @@ def execute_p2rank(
     return output_dir
 
 
+def prepare_p2rank_input(
+    arguments,
+    structure_file: str,
+    conservation_files: typing.Dict[str, ConservationTuple],
+) -> str:
+    """Prepare directory with structure and conservation for p2rank."""
+    input_dir = os.path.join(arguments["working"], "p2rank-input")
+    os.makedirs(input_dir, exist_ok=True)
+    input_structure_file = os.path.join(input_dir, "structure.pdb")
+    shutil.copy(structure_file, input_structure_file)
+    prepare_p2rank_conservation_files(input_dir, conservation_files)
+    return input_dir
+
+
 def prepare_p2rank_conservation_files(
     p2rank_input_dir: str, conservation_files: typing.Dict[str, ConservationTuple]
 ):
@@ -433,23 +832,21 @@ def prepare_p2rank_web_data(
 
     shutil.copy(structure.file, os.path.join(output_directory, "structure.pdb"))
 
-    conservation_args = ""
-    if len(conservation_files) > 0:
-        conservation_args = " --conservation " + " --conservation ".join(
-            [f"{chain}={item.file}" for chain, item in conservation_files.items()]
-        )
-
-    command = (
-        f"{PROTEIN_UTILS_CMD} PrepareForPrankWeb"
-        f" --structure={structure.raw_file}"
-        f" --prediction={predictions_file}"
-        f" --residues={residues_file}"
-        f" --output={output_directory}"
-        f" {conservation_args}"
+    conservation_args = []
+    for chain, item in conservation_files.items():
+        conservation_args += ["--conservation", f"{chain}={os.path.abspath(item.file)}"]
+
+    execute_protein_utils(
+        [
+            "PrepareForPrankWeb",
+            f"--structure={os.path.abspath(structure.raw_file)}",
+            f"--prediction={os.path.abspath(predictions_file)}",
+            f"--residues={os.path.abspath(residues_file)}",
+            f"--output={os.path.abspath(output_directory)}",
+        ]
+        + conservation_args
     )
 
-    execute_command(command)
-
 
 if __name__ == "__main__":
     main(_read_arguments())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Fetch PDB structures using a shared on-disk cache.
+#
+# Structures are downloaded compressed, as {code}.pdb.gz, from PDB_MIRROR
+# and streamed to the cache. Cached structures older than
+# PDB_CACHE_REVALIDATE seconds are revalidated with the mirror using
+# ETag and Last-Modified, when the mirror is not reachable stale files
+# are used. The mirror can be an HTTP URL, a file:// URL or a directory.
+#
+# Layout:
+#   {cache}/{code[1:3]}/{code}.pdb.gz
+#   {cache}/{code[1:3]}/{code}.json    - source validators and fetch time
+#
+
+import os
+import typing
+import logging
+import json
+import gzip
+import shutil
+import time
+import urllib.parse
+import uuid
+
+import requests
+
+# Base URL of the archive with {code}.pdb.gz files.
+PDB_MIRROR = os.environ.get("PDB_MIRROR", "https://files.rcsb.org/download/")
+
+# Directory with cached structures, when not set the cache is not used.
+PDB_CACHE_DIR = os.environ.get("PDB_CACHE_DIR", None)
+
+# Age in seconds after which cached structures are revalidated.
+PDB_CACHE_REVALIDATE = float(os.environ.get("PDB_CACHE_REVALIDATE", "86400"))
+
+DOWNLOAD_TIMEOUT = 60
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Session shared by all downloads, so connections are reused.
+_session: typing.Optional[requests.Session] = None
+
+
+def fetch_structure(
+    code: str,
+    destination: str,
+    cache_dir: typing.Optional[str] = PDB_CACHE_DIR,
+    mirror: str = PDB_MIRROR,
+):
+    """Write uncompressed PDB file for the code to the destination."""
+    code = code.lower()
+    if cache_dir is None:
+        archive = destination + ".gz"
+        _download(_structure_url(mirror, code), archive, {})
+        _gunzip(archive, destination)
+        os.remove(archive)
+        return
+    archive = _fetch_to_cache(cache_dir, mirror, code)
+    _gunzip(archive, destination)
+
+
+def _fetch_to_cache(cache_dir: str, mirror: str, code: str) -> str:
+    """Return path to cached compressed structure, fetch it when needed."""
+    directory = os.path.join(cache_dir, code[1:3])
+    archive = os.path.join(directory, code + ".pdb.gz")
+    metadata_file = os.path.join(directory, code + ".json")
+    metadata = _load_json(metadata_file)
+    url = _structure_url(mirror, code)
+    if metadata is not None and os.path.exists(archive):
+        if time.time() - metadata["fetched"] < PDB_CACHE_REVALIDATE:
+            return archive
+        try:
+            validators = _download(url, archive, metadata["validators"])
+        except (OSError, requests.RequestException):
+            logging.warning("Can't revalidate '%s', using cached file.", code)
+            return archive
+    else:
+        os.makedirs(directory, exist_ok=True)
+        validators = _download(url, archive, {})
+    _save_json(metadata_file, {"validators": validators, "fetched": time.time()})
+    return archive
+
+
+def _download(url: str, target: str, validators: typing.Dict) -> typing.Dict:
+    """
+    Download the file unless it matches the validators, return validators
+    of the current version. Target is replaced only by a complete file.
+    """
+    path = _local_path(url)
+    if path is not None:
+        stat = os.stat(path)
+        current = {"size": stat.st_size, "modified": stat.st_mtime}
+        if current != validators:
+            temp_file = f"{target}.{uuid.uuid4().hex}"
+            shutil.copyfile(path, temp_file)
+            os.replace(temp_file, target)
+        return current
+    headers = {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last-modified" in validators:
+        headers["If-Modified-Since"] = validators["last-modified"]
+    logging.debug("Downloading '%s' ...", url)
+    with _get_session().get(
+        url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as response:
+        if response.status_code == 304:
+            return validators
+        response.raise_for_status()
+        temp_file = f"{target}.{uuid.uuid4().hex}"
+        with open(temp_file, "wb") as stream:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                stream.write(chunk)
+        os.replace(temp_file, target)
+        return {
+            key.lower(): value
+            for key, value in response.headers.items()
+            if key.lower() in ["etag", "last-modified"]
+        }
+
+
+def _get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def _structure_url(mirror: str, code: str) -> str:
+    return mirror.rstrip("/") + "/" + code + ".pdb.gz"
+
+
+def _local_path(url: str) -> typing.Optional[str]:
+    """Return path for file URL or a path, else None."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        return urllib.parse.unquote(parsed.path)
+    if parsed.scheme == "":
+        return url
+    return None
+
+
+def _gunzip(source: str, target: str):
+    with gzip.open(source, "rb") as in_stream, open(target, "wb") as out_stream:
+        shutil.copyfileobj(in_stream, out_stream, DOWNLOAD_CHUNK_SIZE)
+
+
+def _load_json(file: str) -> typing.Optional[typing.Dict]:
+    try:
+        with open(file, encoding="utf-8") as stream:
+            return json.load(stream)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _save_json(file: str, content: typing.Dict):
+    # Write and rename, so the file is never partially written.
+    temp_file = f"{file}.{uuid.uuid4().hex}"
+    with open(temp_file, "w", encoding="utf-8") as stream:
+        json.dump(content, stream)
+    os.replace(temp_file, file)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Execute task stages declared as a graph.
+#
+# Each stage names the values it reads and the values it produces. A stage
+# is started once all its inputs are available, so independent stages run
+# concurrently in a thread pool. When a stage fails no further stages are
+# started, running stages are awaited and the error is raised.
+#
+# Example:
+#   values = execute_stages([
+#       Stage("structure", prepare, ["arguments"], ["structure"]),
+#       Stage("zip", pack, ["arguments", "structure"], []),
+#   ], {"arguments": arguments}, 2)
+#
+
+import typing
+import logging
+import collections
+import concurrent.futures
+import time
+
+Stage = collections.namedtuple("Stage", ["name", "function", "inputs", "outputs"])
+
+
+def execute_stages(
+    stages: typing.List[Stage], values: typing.Dict[str, typing.Any], max_workers: int
+) -> typing.Dict[str, typing.Any]:
+    """Execute the stages, return given values with values produced by stages."""
+    _check_stages(stages, values.keys())
+    values = dict(values)
+    pending = list(stages)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max(1, max_workers)) as executor:
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                for stage in _select_ready(pending, values):
+                    pending.remove(stage)
+                    future = executor.submit(
+                        _execute_stage, stage, [values[name] for name in stage.inputs]
+                    )
+                    running[future] = stage
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    stage = running.pop(future)
+                    values.update(zip(stage.outputs, future.result()))
+        except BaseException:
+            # We can't stop running stages, but we do not start new ones.
+            if len(pending) > 0:
+                logging.info(
+                    "Cancelling stages: %s",
+                    ", ".join(stage.name for stage in pending),
+                )
+            for future in running:
+                future.cancel()
+            raise
+    return values
+
+
+def _check_stages(stages: typing.List[Stage], names: typing.Iterable[str]):
+    """Check that every input is produced, exactly once, and there is no cycle."""
+    available = set(names)
+    for stage in stages:
+        for name in stage.outputs:
+            if name in available:
+                raise Exception(f"Value '{name}' of stage '{stage.name}' is duplicate.")
+            available.add(name)
+    produced = set(names)
+    pending = list(stages)
+    while len(pending) > 0:
+        ready = _select_ready(pending, produced)
+        if len(ready) == 0:
+            raise Exception(
+                "Missing inputs or cycle for stages: "
+                + ", ".join(stage.name for stage in pending)
+            )
+        for stage in ready:
+            pending.remove(stage)
+            produced.update(stage.outputs)
+
+
+def _select_ready(
+    stages: typing.List[Stage], values: typing.Container[str]
+) -> typing.List[Stage]:
+    return [stage for stage in stages if all(name in values for name in stage.inputs)]
+
+
+def _execute_stage(stage: Stage, arguments: typing.List[typing.Any]) -> typing.Tuple:
+    """Execute the stage and return its outputs as a tuple."""
+    start = time.time()
+    try:
+        result = stage.function(*arguments)
+    except BaseException:
+        logging.error("Stage '%s' failed.", stage.name)
+        raise
+    logging.info("Stage '%s' finished in %.1f s.", stage.name, time.time() - start)
+    if len(stage.outputs) == 0:
+        return ()
+    elif len(stage.outputs) == 1:
+        return (result,)
+    else:
+        return tuple(result)
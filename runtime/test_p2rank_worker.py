@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for p2rank_worker, outputs split from a dataset prediction must be
+# the same as outputs of one-shot predictions. p2rank is replaced by
+# a script producing outputs in the p2rank layout.
+#
+
+import os
+import filecmp
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import p2rank_worker
+
+FAKE_P2RANK = """#!/bin/bash
+# predict -c config -threads n (-f file | dataset.ds) -o output
+inputs=()
+output=""
+shift
+while [ $# -gt 0 ]; do
+  case $1 in
+    -c|-threads|--log_to_console) shift;;
+    -f) inputs+=("$2"); shift;;
+    -o) output=$2; shift;;
+    *.ds) while read line; do inputs+=("$(dirname $1)/$line"); done < $1;;
+  esac
+  shift
+done
+mkdir -p $output/visualizations/data
+echo "inputs: ${inputs[@]}" > $output/params.txt
+for file in "${inputs[@]}"; do
+  name=$(basename $file)
+  echo "predicting $name" >> $output/run.log
+  echo "name,rank,score,$name,$(cat ${file%.pdb}.hom)" > $output/${name}_predictions.csv
+  echo "chain,residue,$name" > $output/${name}_residues.csv
+  echo "load data/$name" > $output/visualizations/$name.pml
+  gzip -nc $file > $output/visualizations/data/$name.gz
+done
+"""
+
+
+def _list_files(directory: str):
+    return sorted(
+        os.path.relpath(os.path.join(root, file_name), directory)
+        for root, _, file_names in os.walk(directory)
+        for file_name in file_names
+    )
+
+
+class TestP2rankWorker(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.p2rank_dir = os.path.join(self.directory, "p2rank")
+        os.makedirs(os.path.join(self.p2rank_dir, "config"))
+        p2rank_sh = os.path.join(self.p2rank_dir, "p2rank.sh")
+        with open(p2rank_sh, "w") as stream:
+            stream.write(FAKE_P2RANK)
+        os.chmod(p2rank_sh, 0o755)
+
+    def _create_input(self, index: int) -> str:
+        input_dir = os.path.join(self.directory, f"input-{index}")
+        os.makedirs(input_dir)
+        with open(os.path.join(input_dir, "structure.pdb"), "w") as stream:
+            stream.write(f"HEADER    PROTEIN {index}\nEND\n")
+        with open(os.path.join(input_dir, "structure.hom"), "w") as stream:
+            stream.write(f"conservation {index}\n")
+        return input_dir
+
+    def _predict_one_shot(self, input_dir: str) -> str:
+        output_dir = input_dir + "-one-shot"
+        subprocess.run(
+            [
+                os.path.join(self.p2rank_dir, "p2rank.sh"),
+                "predict",
+                "-c",
+                os.path.join(self.p2rank_dir, "config", "default"),
+                "-threads",
+                "1",
+                "-f",
+                os.path.join(input_dir, "structure.pdb"),
+                "-o",
+                output_dir,
+                "--log_to_console",
+                "1",
+            ],
+            check=True,
+        )
+        return output_dir
+
+    def test_split_output_is_same_as_one_shot(self):
+        names = ["job_aa", "job_bb", "job_cc"]
+        input_dirs = {
+            name: self._create_input(index) for index, name in enumerate(names)
+        }
+        output_dirs = {
+            name: os.path.join(self.directory, "output-" + name) for name in names
+        }
+        errors = p2rank_worker.predict_dataset(
+            self.p2rank_dir,
+            "default",
+            input_dirs,
+            os.path.join(self.directory, "batch"),
+            2,
+            output_dirs,
+        )
+        self.assertEqual({}, errors)
+        for name in names:
+            expected_dir = self._predict_one_shot(input_dirs[name])
+            # Run-level outputs describe the whole run.
+            expected = [
+                file
+                for file in _list_files(expected_dir)
+                if file not in ["params.txt", "run.log"]
+            ]
+            self.assertEqual(expected, _list_files(output_dirs[name]))
+            for file in expected:
+                self.assertTrue(
+                    filecmp.cmp(
+                        os.path.join(expected_dir, file),
+                        os.path.join(output_dirs[name], file),
+                        shallow=False,
+                    ),
+                    file,
+                )
+
+    def _create_worker_dir(self) -> str:
+        worker_dir = os.path.join(self.directory, "worker")
+        for name in ["queue", "running", "jobs", "heartbeat"]:
+            os.makedirs(os.path.join(worker_dir, name))
+        return worker_dir
+
+    def _queue_job(self, worker_dir: str, job_id: str, configuration: str) -> str:
+        job_dir = os.path.join(worker_dir, "jobs", job_id)
+        os.makedirs(job_dir)
+        job = {
+            "p2rank": self.p2rank_dir,
+            "configuration": configuration,
+            "input": self._create_input(len(os.listdir(self.directory))),
+            "output": os.path.join(job_dir, "output"),
+        }
+        p2rank_worker._save_json(
+            os.path.join(worker_dir, "queue", job_id + ".json"), job
+        )
+        return job_dir
+
+    def _read_status(self, job_dir: str):
+        with open(os.path.join(job_dir, p2rank_worker.STATUS_FILE)) as stream:
+            return json.load(stream)
+
+    def test_worker_survives_failed_batch(self):
+        worker_dir = self._create_worker_dir()
+        failing_dir = self._queue_job(worker_dir, "job_aa", "failing")
+        other_dir = self._queue_job(worker_dir, "job_bb", "default")
+        predict_dataset = p2rank_worker.predict_dataset
+
+        def predict(p2rank_dir, configuration, *arguments):
+            if configuration == "failing":
+                raise OSError("Broken p2rank.")
+            return predict_dataset(p2rank_dir, configuration, *arguments)
+
+        claimed = []
+
+        def claim_jobs(worker_dir):
+            if len(claimed) == 2:
+                raise KeyboardInterrupt()
+            claimed.append(len(claimed))
+            return claim_jobs_original(worker_dir)
+
+        claim_jobs_original = p2rank_worker._claim_jobs
+        with unittest.mock.patch.multiple(
+            p2rank_worker,
+            predict_dataset=predict,
+            _claim_jobs=claim_jobs,
+            P2RANK_WORKER_BATCH_WAIT=0,
+            POLL_INTERVAL=0,
+        ), self.assertRaises(KeyboardInterrupt):
+            p2rank_worker.run_worker(worker_dir)
+        self.assertEqual(
+            {"status": "failed", "error": "Broken p2rank."},
+            self._read_status(failing_dir),
+        )
+        self.assertEqual(
+            {"status": "done", "error": None}, self._read_status(other_dir)
+        )
+        self.assertEqual([], os.listdir(os.path.join(worker_dir, "running")))
+
+    def test_cancel_running_job(self):
+        worker_dir = self._create_worker_dir()
+        job_dir = self._queue_job(worker_dir, "job_aa", "default")
+        p2rank_worker._claim_jobs(worker_dir)
+        p2rank_worker._cancel_job(worker_dir, "job_aa")
+        self.assertTrue(os.path.exists(job_dir))
+        p2rank_worker._finish_job(worker_dir, "job_aa", None)
+        self.assertEqual([], os.listdir(os.path.join(worker_dir, "jobs")))
+        self.assertEqual([], os.listdir(os.path.join(worker_dir, "running")))
+
+    def test_cancel_job_finished_after_deadline(self):
+        worker_dir = self._create_worker_dir()
+        self._queue_job(worker_dir, "job_aa", "default")
+        p2rank_worker._claim_jobs(worker_dir)
+        # The worker finishes after the client gave up waiting.
+        p2rank_worker._finish_job(worker_dir, "job_aa", None)
+        p2rank_worker._cancel_job(worker_dir, "job_aa")
+        self.assertEqual([], os.listdir(os.path.join(worker_dir, "jobs")))
+        self.assertEqual([], os.listdir(os.path.join(worker_dir, "running")))
+
+    def test_heartbeat_is_updated(self):
+        heartbeat = os.path.join(self.directory, "heartbeat")
+        p2rank_worker._touch(heartbeat)
+        os.utime(heartbeat, (0, 0))
+        stop = threading.Event()
+        with unittest.mock.patch.object(p2rank_worker, "HEARTBEAT_INTERVAL", 0.05):
+            thread = threading.Thread(
+                target=p2rank_worker._update_heartbeat, args=(heartbeat, stop)
+            )
+            thread.start()
+            time.sleep(0.3)
+            stop.set()
+            thread.join()
+        self.assertLess(time.time() - os.path.getmtime(heartbeat), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for prediction_cache, a restored prediction must be byte
+# identical to the stored one and eviction must not leave partial
+# entries or partial outputs.
+#
+
+import os
+import filecmp
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import prediction_cache
+
+# Output of run_p2rank_task.
+PREDICTION_FILES = {
+    "visualizations.zip": b"PK\x03\x04" + bytes(range(256)) * 4,
+    "prediction.json": b'{"pockets": [{"name": "pocket1", "score": 12.5}]}\n',
+    "sequence.json": b'{"indices": ["A_1", "A_2"], "sequence": ["M", "K"]}\n',
+    "structure.pdb": b"ATOM      1  N   MET A   1\nEND\n" * 64,
+}
+
+
+def _write_prediction(directory: str):
+    for name, content in PREDICTION_FILES.items():
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as stream:
+            stream.write(content)
+
+
+def _list_files(directory: str):
+    return sorted(
+        os.path.relpath(os.path.join(root, file_name), directory)
+        for root, _, file_names in os.walk(directory)
+        for file_name in file_names
+    )
+
+
+class TestPredictionCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, "cache")
+        os.makedirs(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _store(self, key: str) -> str:
+        output_dir = os.path.join(self.directory, "output-" + key)
+        _write_prediction(output_dir)
+        prediction_cache.store(self.cache_dir, key, output_dir)
+        return output_dir
+
+    def test_restore_is_byte_identical(self):
+        key = prediction_cache.create_key({"structure": "1abc", "chains": ["A"]})
+        computed_dir = self._store(key)
+        restored_dir = os.path.join(self.directory, "restored")
+        self.assertTrue(prediction_cache.restore(self.cache_dir, key, restored_dir))
+        self.assertEqual(_list_files(computed_dir), _list_files(restored_dir))
+        for name in _list_files(computed_dir):
+            computed = os.path.join(computed_dir, name)
+            restored = os.path.join(restored_dir, name)
+            self.assertTrue(filecmp.cmp(computed, restored, shallow=False))
+            # Restored files are links, not copies.
+            self.assertEqual(os.stat(computed).st_ino, os.stat(restored).st_ino)
+
+    def test_miss(self):
+        self._store(prediction_cache.create_key({"structure": "1abc"}))
+        key = prediction_cache.create_key({"structure": "2xyz"})
+        restored_dir = os.path.join(self.directory, "restored")
+        self.assertFalse(prediction_cache.restore(self.cache_dir, key, restored_dir))
+        self.assertFalse(os.path.exists(restored_dir))
+
+    def test_key_ignores_order_and_line_endings(self):
+        self.assertEqual(
+            prediction_cache.create_key({"a": 1, "b": [2]}),
+            prediction_cache.create_key({"b": [2], "a": 1}),
+        )
+        unix_file = os.path.join(self.directory, "unix.pdb")
+        windows_file = os.path.join(self.directory, "windows.pdb")
+        with open(unix_file, "wb") as stream:
+            stream.write(b"ATOM      1  N   MET A   1\nEND\n")
+        with open(windows_file, "wb") as stream:
+            stream.write(b"ATOM      1  N   MET A   1  \r\nEND\r\n")
+        self.assertEqual(
+            prediction_cache.hash_structure_file(unix_file),
+            prediction_cache.hash_structure_file(windows_file),
+        )
+
+    def test_evict_by_age(self):
+        old_key = prediction_cache.create_key({"structure": "old"})
+        new_key = prediction_cache.create_key({"structure": "new"})
+        self._store(old_key)
+        self._store(new_key)
+        used_file = os.path.join(
+            self.cache_dir, old_key[:2], old_key, prediction_cache.USED_FILE
+        )
+        two_days_ago = time.time() - 2 * 24 * 3600
+        os.utime(used_file, (two_days_ago, two_days_ago))
+        prediction_cache.evict(self.cache_dir, max_size=1024, max_age=1)
+        restored_dir = os.path.join(self.directory, "restored")
+        self.assertFalse(
+            prediction_cache.restore(self.cache_dir, old_key, restored_dir)
+        )
+        self.assertTrue(prediction_cache.restore(self.cache_dir, new_key, restored_dir))
+
+    def test_evict_by_size(self):
+        keys = [prediction_cache.create_key({"structure": i}) for i in range(3)]
+        for index, key in enumerate(keys):
+            # Public directories of finished tasks were removed.
+            shutil.rmtree(self._store(key))
+            used_file = os.path.join(
+                self.cache_dir, key[:2], key, prediction_cache.USED_FILE
+            )
+            used = time.time() - 100 + index
+            os.utime(used_file, (used, used))
+        entry_size = sum(len(content) for content in PREDICTION_FILES.values())
+        # Keep room for two entries only.
+        max_size = (2 * entry_size + 10) / (1024 * 1024)
+        prediction_cache.evict(self.cache_dir, max_size=max_size, max_age=1e9)
+        restored_dir = os.path.join(self.directory, "restored")
+        self.assertFalse(
+            prediction_cache.restore(self.cache_dir, keys[0], restored_dir)
+        )
+        for key in keys[1:]:
+            self.assertTrue(prediction_cache.restore(self.cache_dir, key, restored_dir))
+
+    def test_files_linked_from_outputs_are_not_counted(self):
+        keys = [prediction_cache.create_key({"structure": i}) for i in range(2)]
+        output_dir = self._store(keys[0])
+        shutil.rmtree(self._store(keys[1]))
+        entry_size = sum(len(content) for content in PREDICTION_FILES.values())
+        self.assertEqual(
+            0,
+            prediction_cache._directory_size(
+                prediction_cache._entry_directory(self.cache_dir, keys[0])
+            ),
+        )
+        self.assertEqual(
+            entry_size,
+            prediction_cache._directory_size(
+                prediction_cache._entry_directory(self.cache_dir, keys[1])
+            ),
+        )
+        # Both entries fit, removing the first one would not free anything.
+        max_size = (entry_size + 10) / (1024 * 1024)
+        prediction_cache.evict(self.cache_dir, max_size=max_size, max_age=1e9)
+        restored_dir = os.path.join(self.directory, "restored")
+        for key in keys:
+            self.assertTrue(prediction_cache.restore(self.cache_dir, key, restored_dir))
+        self.assertTrue(os.path.isdir(output_dir))
+
+    def test_evicted_entry_is_renamed_before_removal(self):
+        key = prediction_cache.create_key({"structure": "1abc"})
+        shutil.rmtree(self._store(key))
+        entry_dir = prediction_cache._entry_directory(self.cache_dir, key)
+        removed = []
+        remove_tree = shutil.rmtree
+
+        def rmtree(path, **kwargs):
+            removed.append((path, os.path.exists(entry_dir)))
+            remove_tree(path, **kwargs)
+
+        with unittest.mock.patch.object(prediction_cache.shutil, "rmtree", rmtree):
+            prediction_cache.evict(self.cache_dir, max_size=0, max_age=1e9)
+        [(path, entry_exists)] = removed
+        self.assertTrue(os.path.basename(path).startswith("tmp-"))
+        self.assertFalse(entry_exists)
+        self.assertEqual([key[:2]], os.listdir(self.cache_dir))
+
+    def test_restore_of_evicted_entry_leaves_no_files(self):
+        key = prediction_cache.create_key({"structure": "1abc"})
+        self._store(key)
+        restored_dir = os.path.join(self.directory, "restored")
+        os.makedirs(restored_dir)
+        link = os.link
+        linked = []
+
+        def evict_during_link(source, target):
+            if len(linked) == 2:
+                prediction_cache.evict(self.cache_dir, max_size=0, max_age=0)
+            link(source, target)
+            linked.append(target)
+
+        with unittest.mock.patch.object(prediction_cache.os, "link", evict_during_link):
+            self.assertFalse(
+                prediction_cache.restore(self.cache_dir, key, restored_dir)
+            )
+        self.assertEqual(2, len(linked))
+        self.assertEqual([], os.listdir(restored_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
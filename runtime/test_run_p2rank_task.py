@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for run_p2rank_task, a prediction restored from the prediction cache
+# must be the same as one computed without the cache. p2rank and
+# protein-utils are replaced by scripts producing outputs in their layout.
+# Conservation modules must be on the PYTHONPATH, as they are in the
+# runtime image.
+#
+
+import os
+import filecmp
+import json
+import shutil
+import tempfile
+import typing
+import unittest
+import unittest.mock
+import zipfile
+
+# Required by run_p2rank_task, the tests replace protein-utils.
+os.environ.setdefault("PROTEIN_UTILS_CMD", "protein-utils")
+os.environ.setdefault("HSSPTDB", tempfile.gettempdir())
+
+import conservation
+import conservation_cache
+import conservation_reuse
+import prediction_cache
+import run_p2rank_task
+
+FAKE_PROTEIN_UTILS = """#!/bin/bash
+# command (--input file --output dir [--chains=...] | --structure=... --output=...)
+command=$1
+shift
+while [ $# -gt 0 ]; do
+  case $1 in
+    --input) input=$2; shift;;
+    --output) output=$2; shift;;
+    --output=*) output=${1#*=};;
+    --prediction=*) prediction=${1#*=};;
+  esac
+  shift
+done
+if [ "$command" = "PrepareForP2Rank" ]; then
+  cp $input $output/structure.pdb
+  echo '{"chains": [{"name": "A", "id": "A", "types": ["amino"]}]}' > $output/structure-info.json
+  printf '>A\\nMKV\\n' > $output/chain_A.fasta
+else
+  echo "{\\"prediction\\": \\"$(cat $prediction)\\"}" > $output/prediction.json
+  echo '{"sequence": ["M", "K", "V"]}' > $output/sequence.json
+fi
+"""
+
+FAKE_P2RANK = """#!/bin/bash
+# predict -c config -threads n -f file -o output
+shift
+while [ $# -gt 0 ]; do
+  case $1 in
+    -c|-threads|--log_to_console) shift;;
+    -f) input=$2; shift;;
+    -o) output=$2; shift;;
+  esac
+  shift
+done
+echo "predict" >> $(dirname $0)/calls
+mkdir -p $output/visualizations/data
+echo "pocket1,1,$(wc -c < $input)" > $output/structure.pdb_predictions.csv
+echo "A,1,pocket1" > $output/structure.pdb_residues.csv
+echo "load data/structure.pdb" > $output/visualizations/structure.pdb.pml
+cp $input $output/visualizations/data/structure.pdb
+"""
+
+
+def _write_script(path: str, content: str):
+    with open(path, "w") as stream:
+        stream.write(content)
+    os.chmod(path, 0o755)
+
+
+def _list_files(directory: str):
+    return sorted(
+        os.path.relpath(os.path.join(root, file_name), directory)
+        for root, _, file_names in os.walk(directory)
+        for file_name in file_names
+    )
+
+
+def _load_json(path: str):
+    with open(path, encoding="utf-8") as stream:
+        return json.load(stream)
+
+
+def _read_zip(path: str) -> typing.Dict[str, bytes]:
+    with zipfile.ZipFile(path) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+class TestRunP2rankTask(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.p2rank_dir = os.path.join(self.directory, "p2rank")
+        os.makedirs(os.path.join(self.p2rank_dir, "config"))
+        os.makedirs(os.path.join(self.p2rank_dir, "models"))
+        _write_script(os.path.join(self.p2rank_dir, "p2rank.sh"), FAKE_P2RANK)
+        self.model_file = os.path.join(self.p2rank_dir, "models", "default.model")
+        with open(self.model_file, "w") as stream:
+            stream.write("model 1\n")
+        protein_utils = os.path.join(self.directory, "protein-utils")
+        _write_script(protein_utils, FAKE_PROTEIN_UTILS)
+        self.input_dir = os.path.join(self.directory, "input")
+        os.makedirs(self.input_dir)
+        with open(os.path.join(self.input_dir, "structure.pdb"), "w") as stream:
+            stream.write("ATOM      1  N   MET A   1\nEND\n")
+        with open(os.path.join(self.input_dir, "configuration.json"), "w") as stream:
+            json.dump(
+                {
+                    "structure": {"file": "structure.pdb", "chains": ["A"]},
+                    "conservation": {"compute": False},
+                },
+                stream,
+            )
+        for target, value in [
+            (run_p2rank_task, {"PROTEIN_UTILS_CMD": protein_utils}),
+            (
+                prediction_cache,
+                {"PREDICTION_CACHE_DIR": os.path.join(self.directory, "cache")},
+            ),
+        ]:
+            patcher = unittest.mock.patch.multiple(target, **value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _run(self, name: str) -> str:
+        output_dir = os.path.join(self.directory, name)
+        run_p2rank_task.main(
+            {
+                "input": self.input_dir,
+                "working": os.path.join(self.directory, name + "-working"),
+                "output": output_dir,
+                "configuration": os.path.join(self.input_dir, "configuration.json"),
+                "p2rank": self.p2rank_dir,
+            }
+        )
+        return output_dir
+
+    def _count_p2rank_calls(self) -> int:
+        calls_file = os.path.join(self.p2rank_dir, "calls")
+        if not os.path.exists(calls_file):
+            return 0
+        with open(calls_file) as stream:
+            return len(stream.readlines())
+
+    def test_cached_prediction_is_same_as_computed(self):
+        self._run("computed")
+        self.assertEqual(1, self._count_p2rank_calls())
+        restored_dir = self._run("restored")
+        self.assertEqual(1, self._count_p2rank_calls())
+        # Restored files are links to the computed ones, so we compare them
+        # with an independent computation.
+        with unittest.mock.patch.object(prediction_cache, "PREDICTION_CACHE_DIR", None):
+            expected_dir = self._run("expected")
+        self.assertEqual(2, self._count_p2rank_calls())
+        self.assertEqual(
+            ["prediction.json", "sequence.json", "structure.pdb", "visualizations.zip"],
+            _list_files(expected_dir),
+        )
+        self.assertEqual(_list_files(expected_dir), _list_files(restored_dir))
+        for name in ["prediction.json", "sequence.json"]:
+            self.assertEqual(
+                _load_json(os.path.join(expected_dir, name)),
+                _load_json(os.path.join(restored_dir, name)),
+                name,
+            )
+        # Archives differ in timestamps, so we compare the members.
+        self.assertEqual(
+            _read_zip(os.path.join(expected_dir, "visualizations.zip")),
+            _read_zip(os.path.join(restored_dir, "visualizations.zip")),
+        )
+        self.assertTrue(
+            filecmp.cmp(
+                os.path.join(expected_dir, "structure.pdb"),
+                os.path.join(restored_dir, "structure.pdb"),
+                shallow=False,
+            )
+        )
+
+    def test_changed_model_is_a_miss(self):
+        self._run("computed")
+        stat = os.stat(self.model_file)
+        # Same size and modification time, different content.
+        with open(self.model_file, "w") as stream:
+            stream.write("model 2\n")
+        os.utime(self.model_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self._run("recomputed")
+        self.assertEqual(2, self._count_p2rank_calls())
+
+    def test_databases_are_selected_once_per_task(self):
+        configuration_file = os.path.join(self.input_dir, "configuration.json")
+        with open(configuration_file, "w") as stream:
+            json.dump(
+                {
+                    "structure": {"file": "structure.pdb", "chains": ["A"]},
+                    "conservation": {"compute": True},
+                },
+                stream,
+            )
+        searched = []
+
+        def compute_conservation(input_file, working_dir, output_file, config):
+            searched.append(config.blast_databases)
+            with open(output_file, "w") as stream:
+                stream.write("0\t0.5\tM\n")
+            return None
+
+        with unittest.mock.patch.object(
+            run_p2rank_task.database_manager,
+            "select_databases",
+            return_value=["swissprot"],
+        ) as select_databases, unittest.mock.patch.object(
+            run_p2rank_task.conservation_service,
+            "compute_conservation",
+            compute_conservation,
+        ):
+            self._run("computed")
+            self._run("restored")
+        self.assertEqual(2, select_databases.call_count)
+        self.assertEqual([["swissprot"]], searched)
+        self.assertEqual(1, self._count_p2rank_calls())
+
+    def test_reused_conservation_is_not_an_exact_hit(self):
+        cache_dir = os.path.join(self.directory, "conservation-cache")
+        arguments = {"working": os.path.join(self.directory, "working")}
+        os.makedirs(arguments["working"])
+        with open(os.path.join(arguments["working"], "chain_A.fasta"), "w") as stream:
+            stream.write(">A\nMKV\n")
+        computed = []
+
+        def reuse_conservation(cache_dir, input_file, working_dir, output_file, config):
+            with open(output_file, "w") as stream:
+                stream.write("# reused\n0\t0.1\tM\n")
+            msa_file = os.path.join(working_dir, "reused-msa")
+            with open(msa_file, "w") as stream:
+                stream.write(">A\nMKV\n")
+            return msa_file
+
+        def compute_conservation(input_file, working_dir, output_file, config):
+            computed.append(input_file)
+            with open(output_file, "w") as stream:
+                stream.write("0\t0.9\tM\n")
+            msa_file = os.path.join(working_dir, "computed-msa")
+            with open(msa_file, "w") as stream:
+                stream.write(">A\nMKV\n")
+            return msa_file
+
+        def compute_or_load(reuse: bool) -> str:
+            with unittest.mock.patch.multiple(
+                conservation_reuse,
+                CONSERVATION_REUSE=reuse,
+                reuse_conservation=unittest.mock.Mock(side_effect=reuse_conservation),
+            ):
+                result = run_p2rank_task.compute_or_load_for_chain(
+                    "A", "MKV", "chain_A.fasta", arguments, ["swissprot"]
+                )
+            with open(result.file) as stream:
+                return stream.read()
+
+        with unittest.mock.patch.object(
+            conservation_cache, "CONSERVATION_CACHE_DIR", cache_dir
+        ), unittest.mock.patch.object(
+            run_p2rank_task.conservation_service,
+            "compute_conservation",
+            compute_conservation,
+        ):
+            self.assertTrue(compute_or_load(True).startswith("# reused"))
+            configuration = run_p2rank_task.create_conservation_configuration(
+                ["swissprot"]
+            )
+            self.assertFalse(
+                conservation_cache.contains(
+                    cache_dir, conservation_cache.create_key("MKV", configuration)
+                )
+            )
+            # The reused conservation is loaded from the cache.
+            self.assertTrue(compute_or_load(True).startswith("# reused"))
+            self.assertEqual([], computed)
+            # Without reuse the conservation is computed and cached.
+            self.assertEqual("0\t0.9\tM\n", compute_or_load(False))
+            self.assertEqual(1, len(computed))
+            self.assertEqual("0\t0.9\tM\n", compute_or_load(True))
+            self.assertEqual(1, len(computed))
+
+    def test_key_depends_on_database_versions(self):
+        arguments = {"input": self.input_dir, "p2rank": self.p2rank_dir}
+        configuration = {
+            "structure": {"chains": ["A"]},
+            "conservation": {"compute": True},
+        }
+        structure_file = os.path.join(self.input_dir, "structure.pdb")
+        conservation_configuration = conservation.ConservationConfiguration()
+        conservation_configuration.blast_databases = ["swissprot"]
+        keys = []
+        for version in ["2024-01", "2024-01", "2024-02"]:
+            with unittest.mock.patch.object(
+                conservation,
+                "get_database_versions",
+                return_value={"swissprot": version},
+            ):
+                keys.append(
+                    run_p2rank_task.create_prediction_key(
+                        arguments,
+                        configuration,
+                        structure_file,
+                        conservation_configuration,
+                    )
+                )
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for structure_fetcher, the mirror is a local HTTP server
+# supporting ETag validation.
+#
+
+import os
+import gzip
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import http.server
+
+import structure_fetcher
+
+STRUCTURE = b"HEADER    TEST\nATOM      1  N   MET A   1\nEND\n"
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    """Serve files of the server, the ETag is the content version."""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        content = self.server.files.get(self.path.lstrip("/"))
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = f'"{self.server.versions[self.path.lstrip("/")]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestStructureFetcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache_dir = os.path.join(self.directory, "cache")
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MirrorHandler)
+        self.server.files = {}
+        self.server.versions = {}
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.mirror = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self._publish("1abc", STRUCTURE)
+
+    def _publish(self, code: str, content: bytes):
+        name = code + ".pdb.gz"
+        self.server.files[name] = gzip.compress(content)
+        self.server.versions[name] = self.server.versions.get(name, 0) + 1
+
+    def _fetch(self, code: str, mirror: str = None, cache_dir: str = "cache"):
+        destination = os.path.join(self.directory, f"{code}-{time.time()}.pdb")
+        structure_fetcher.fetch_structure(
+            code.upper(),
+            destination,
+            self.cache_dir if cache_dir == "cache" else cache_dir,
+            mirror or self.mirror,
+        )
+        with open(destination, "rb") as stream:
+            return stream.read()
+
+    def _expire_cache(self):
+        """Make all cached files older than the revalidation period."""
+        patcher = unittest.mock.patch.object(
+            structure_fetcher, "PDB_CACHE_REVALIDATE", -1
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_hit(self):
+        self.assertEqual(STRUCTURE, self._fetch("1abc"))
+        self.assertEqual(STRUCTURE, self._fetch("1abc"))
+        self.assertEqual(["/1abc.pdb.gz"], self.server.requests)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.cache_dir, "ab", "1abc.pdb.gz"))
+        )
+
+    def test_revalidate_not_modified(self):
+        self._fetch("1abc")
+        self._expire_cache()
+        archive = os.path.join(self.cache_dir, "ab", "1abc.pdb.gz")
+        inode = os.stat(archive).st_ino
+        self.assertEqual(STRUCTURE, self._fetch("1abc"))
+        self.assertEqual(2, len(self.server.requests))
+        # The file was not downloaded again.
+        self.assertEqual(inode, os.stat(archive).st_ino)
+
+    def test_revalidate_changed(self):
+        self._fetch("1abc")
+        changed = STRUCTURE.replace(b"TEST", b"CHANGED")
+        self._publish("1abc", changed)
+        self._expire_cache()
+        self.assertEqual(changed, self._fetch("1abc"))
+        self.assertEqual(changed, self._fetch("1abc"))
+        # Revalidated once more, the new version is not downloaded again.
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_stale_when_mirror_is_unreachable(self):
+        self._fetch("1abc")
+        self._expire_cache()
+        self.assertEqual(STRUCTURE, self._fetch("1abc", mirror="http://127.0.0.1:1/"))
+
+    def test_not_cached_when_mirror_is_unreachable(self):
+        with self.assertRaises(Exception):
+            self._fetch("2xyz", mirror="http://127.0.0.1:1/")
+
+    def test_without_cache(self):
+        self.assertEqual(STRUCTURE, self._fetch("1abc", cache_dir=None))
+        self.assertEqual(STRUCTURE, self._fetch("1abc", cache_dir=None))
+        self.assertEqual(2, len(self.server.requests))
+        self.assertFalse(os.path.exists(self.cache_dir))
+        # Only the uncompressed structures are left.
+        self.assertTrue(
+            all(file.endswith(".pdb") for file in os.listdir(self.directory))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
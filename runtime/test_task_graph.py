@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests for task_graph, stages must run once their inputs are available and
+# no stage may start after a failure.
+#
+
+import threading
+import time
+import unittest
+
+import task_graph
+
+
+class Recorder:
+    """Records start and end of stages."""
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def stage(self, name: str, result=None, duration: float = 0, error=None):
+        def function(*arguments):
+            with self.lock:
+                self.events.append(("start", name, arguments))
+            time.sleep(duration)
+            with self.lock:
+                self.events.append(("end", name, arguments))
+            if error is not None:
+                raise error
+            return result
+
+        return function
+
+    def started(self):
+        return [name for event, name, _ in self.events if event == "start"]
+
+    def index(self, event: str, name: str) -> int:
+        return [(item[0], item[1]) for item in self.events].index((event, name))
+
+
+class TestTaskGraph(unittest.TestCase):
+    def test_stages_run_after_their_inputs(self):
+        recorder = Recorder()
+        values = task_graph.execute_stages(
+            [
+                task_graph.Stage(
+                    "report", recorder.stage("report"), ["left", "right"], []
+                ),
+                task_graph.Stage(
+                    "left", recorder.stage("left", 1, 0.2), ["root"], ["left"]
+                ),
+                task_graph.Stage(
+                    "right",
+                    recorder.stage("right", (2, 3)),
+                    ["root"],
+                    ["right", "other"],
+                ),
+            ],
+            {"root": 0},
+            2,
+        )
+        self.assertEqual(
+            {"root": 0, "left": 1, "right": 2, "other": 3},
+            values,
+        )
+        self.assertEqual(["left", "report", "right"], sorted(recorder.started()))
+        report_start = recorder.index("start", "report")
+        self.assertLess(recorder.index("end", "left"), report_start)
+        self.assertLess(recorder.index("end", "right"), report_start)
+        # Independent stages run concurrently.
+        self.assertLess(recorder.index("start", "right"), recorder.index("end", "left"))
+        self.assertIn(("start", "report", (1, 2)), recorder.events)
+
+    def test_failure_stops_dependent_stages(self):
+        recorder = Recorder()
+        stages = [
+            task_graph.Stage(
+                "failing",
+                recorder.stage("failing", error=ValueError("failed")),
+                ["root"],
+                ["failed"],
+            ),
+            task_graph.Stage("running", recorder.stage("running", 1, 0.2), [], ["x"]),
+            task_graph.Stage("dependent", recorder.stage("dependent"), ["failed"], []),
+            task_graph.Stage("after", recorder.stage("after"), ["x"], []),
+        ]
+        with self.assertRaises(ValueError):
+            task_graph.execute_stages(stages, {"root": 0}, 2)
+        self.assertEqual(["failing", "running"], sorted(recorder.started()))
+        # Running stages are awaited.
+        self.assertIn(("end", "running", ()), recorder.events)
+
+    def test_missing_input(self):
+        recorder = Recorder()
+        with self.assertRaisesRegex(Exception, "Missing inputs or cycle"):
+            task_graph.execute_stages(
+                [
+                    task_graph.Stage("first", recorder.stage("first"), [], ["a"]),
+                    task_graph.Stage("second", recorder.stage("second"), ["b"], []),
+                ],
+                {},
+                2,
+            )
+        self.assertEqual([], recorder.started())
+
+    def test_cycle(self):
+        recorder = Recorder()
+        with self.assertRaisesRegex(Exception, "Missing inputs or cycle"):
+            task_graph.execute_stages(
+                [
+                    task_graph.Stage("first", recorder.stage("first"), ["b"], ["a"]),
+                    task_graph.Stage("second", recorder.stage("second"), ["a"], ["b"]),
+                ],
+                {},
+                2,
+            )
+        self.assertEqual([], recorder.started())
+
+    def test_duplicate_output(self):
+        with self.assertRaisesRegex(Exception, "duplicate"):
+            task_graph.execute_stages(
+                [task_graph.Stage("first", lambda: 1, [], ["a"])], {"a": 0}, 1
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()